@@ -5,13 +5,15 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from django.urls import path
 from backend.messenger_api import routing as messenger_routing 
 from .jwt_auth_middleware import TokenAuthMiddlewareStack 
+from .media_server import MediaServer
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.config.settings')
 
 django_asgi_app = get_asgi_application()
 
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    # MEDIA_URL отдается без Django (файлы, Range, ETag), остальное - Django
+    "http": MediaServer(django_asgi_app),
 
     # WebSocket запросы (отправляются в Channels)
     "websocket": TokenAuthMiddlewareStack(
@@ -0,0 +1,19 @@
+"""
+Неблокирующий вывод логов.
+
+QueueStreamHandler только кладет запись в очередь, а в поток вывода ее пишет
+отдельный поток QueueListener. Событийный цикл Daphne не ждет stderr
+(print и StreamHandler в консьюмере блокировали его на каждом сообщении).
+"""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class QueueStreamHandler(QueueHandler):
+    def __init__(self, stream=None):
+        super().__init__(queue.SimpleQueue())
+        self.listener = QueueListener(self.queue, logging.StreamHandler(stream))
+        self.listener.start()
+        atexit.register(self.listener.stop)
@@ -0,0 +1,226 @@
+"""
+Раздача MEDIA_ROOT прямо из ASGI, без Django-воркеров.
+
+MediaServer оборачивает HTTP-приложение Django: запросы к MEDIA_URL
+обслуживаются здесь, остальные уходят дальше.
+
+- Файл отдается через расширение сервера http.response.zerocopysend
+  (sendfile без копирования в Python) или http.response.pathsend, если сервер
+  их объявил в scope['extensions'], иначе читается блоками в потоке.
+- Range: один диапазон bytes=a-b / a- / -n, If-Range; несколько диапазонов - весь файл.
+- ETag строгий: у файлов с хэшем содержимого в имени (echo_api/storage.py)
+  это сам sha256, у остальных - размер и время изменения. If-None-Match -> 304.
+- Имена с хэшем содержимого никогда не меняют байты: Cache-Control immutable на год.
+- chat_avatars/ видят только участники чата: JWT в заголовке Authorization
+  или в ?token= (для <img src>).
+"""
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+from email.utils import formatdate
+from urllib.parse import parse_qs, unquote
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+HASHED_NAME = re.compile(r'^[0-9a-f]{64}$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _etag(name, info):
+    stem = os.path.splitext(os.path.basename(name))[0]
+    if HASHED_NAME.match(stem):
+        return f'"{stem}"', True
+    return f'"{info.st_size:x}-{info.st_mtime_ns:x}"', False
+
+
+def _etag_matches(header, etag):
+    if header is None:
+        return False
+    return header.strip() == '*' or etag in [tag.strip() for tag in header.split(',')]
+
+
+def _byte_range(header, size):
+    """(start, end) включительно; None - отдать файл целиком; ValueError - диапазон вне файла."""
+    match = RANGE.match(header.replace(' ', '')) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-n: последние n байт
+        length = int(last)
+        if length == 0:
+            raise ValueError
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError
+    return start, end
+
+
+@database_sync_to_async
+def _is_chat_member(token, name):
+    from django.db.models import Q
+    from rest_framework_simplejwt.exceptions import TokenError
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from backend.messenger_api.models import Chat
+
+    try:
+        user_id = AccessToken(token).get('user_id')
+    except TokenError:
+        return False
+    if not user_id:
+        return False
+
+    # Аватар или любая его уменьшенная копия (echo_api/media.py)
+    matches = Q(avatar=name)
+    for variant in settings.MEDIA_AVATAR_VARIANTS:
+        matches |= Q(**{f'avatar_variants__{variant}': name})
+    return Chat.objects.filter(matches, participants__id=user_id).exists()
+
+
+class MediaServer:
+    def __init__(self, inner):
+        self.inner = inner
+        self.prefix = settings.MEDIA_URL
+        self.root = os.path.realpath(settings.MEDIA_ROOT)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.inner(scope, receive, send)
+        return await self.serve(scope, send)
+
+    def _resolve(self, name):
+        # NUL в пути (/media/%00) os.path не принимает (ValueError) - такого файла нет
+        if '\x00' in name:
+            return None
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            return None
+        # Временные файлы хранилища (.blob-*, .part-*) наружу не отдаются
+        if any(part.startswith('.') for part in name.split('/')):
+            return None
+        return path
+
+    def _token(self, scope):
+        authorization = _header(scope, b'authorization')
+        if authorization and authorization.startswith('Bearer '):
+            return authorization[len('Bearer '):]
+        return parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+
+    async def start(self, send, status, headers):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(key.encode(), str(value).encode()) for key, value in headers],
+        })
+
+    async def respond(self, send, status, headers=(), body=b''):
+        await self.start(send, status, headers)
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def serve(self, scope, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            return await self.respond(send, 405, [('Allow', 'GET, HEAD')])
+
+        name = unquote(scope['path'][len(self.prefix):])
+        path = self._resolve(name)
+        try:
+            info = await asyncio.to_thread(os.stat, path) if path else None
+        except OSError:
+            info = None
+        if info is None or not stat.S_ISREG(info.st_mode):
+            return await self.respond(send, 404, [('Content-Type', 'text/plain')], b'Not Found')
+
+        private = any(name.startswith(prefix) for prefix in settings.MEDIA_PRIVATE_PREFIXES)
+        if private:
+            token = self._token(scope)
+            if not token or not await _is_chat_member(token, name):
+                return await self.respond(send, 404, [('Content-Type', 'text/plain')], b'Not Found')
+
+        etag, hashed = _etag(name, info)
+        if hashed:
+            cache_control = IMMUTABLE_CACHE
+        else:
+            cache_control = f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}'
+        if private:
+            cache_control = cache_control.replace('public', 'private')
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', cache_control),
+            ('Last-Modified', formatdate(info.st_mtime, usegmt=True)),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        if private:
+            # Один URL у разных пользователей - разный доступ
+            headers.append(('Vary', 'Authorization'))
+
+        if _etag_matches(_header(scope, b'if-none-match'), etag):
+            return await self.respond(send, 304, headers)
+
+        size = info.st_size
+        status, start, end = 200, 0, size - 1
+        if_range = _header(scope, b'if-range')
+        if if_range is None or if_range.strip() == etag:
+            try:
+                byte_range = _byte_range(_header(scope, b'range'), size)
+            except ValueError:
+                headers.append(('Content-Range', f'bytes */{size}'))
+                return await self.respond(send, 416, headers)
+            if byte_range is not None:
+                status, (start, end) = 206, byte_range
+                headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+
+        content_type, encoding = mimetypes.guess_type(name)
+        # .gz и т.п. отдаются как есть, без Content-Encoding
+        headers.append(('Content-Type', content_type if content_type and not encoding else 'application/octet-stream'))
+        count = end - start + 1 if size else 0
+        headers.append(('Content-Length', count))
+
+        await self.start(send, status, headers)
+        if scope['method'] == 'HEAD' or count == 0:
+            return await send({'type': 'http.response.body', 'body': b''})
+        await self.send_file(scope, send, path, start, count, whole=status == 200)
+
+    async def send_file(self, scope, send, path, offset, count, whole):
+        extensions = scope.get('extensions') or {}
+        if whole and 'http.response.pathsend' in extensions:
+            return await send({'type': 'http.response.pathsend', 'path': path})
+
+        file = await asyncio.to_thread(open, path, 'rb')
+        try:
+            if 'http.response.zerocopysend' in extensions:
+                return await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': file,
+                    'offset': offset,
+                    'count': count,
+                })
+
+            await asyncio.to_thread(file.seek, offset)
+            while count > 0:
+                block = await asyncio.to_thread(file.read, min(settings.MEDIA_SERVER_BLOCK_SIZE, count))
+                if not block:
+                    break
+                count -= len(block)
+                await send({'type': 'http.response.body', 'body': block, 'more_body': count > 0})
+            if count > 0:
+                # Файл укоротился во время отдачи
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await asyncio.to_thread(file.close)
@@ -147,6 +147,10 @@ MONGODB_DATABASE = {
     'username': config('MONGODB_USER', default=''),
     'password': config('MONGODB_PASS', default=''),
 }
+# Пул соединений MongoDB на процесс (свой у синхронного и асинхронного клиента)
+MONGODB_MAX_POOL_SIZE = config('MONGODB_MAX_POOL_SIZE', default=100, cast=int)
+MONGODB_MIN_POOL_SIZE = config('MONGODB_MIN_POOL_SIZE', default=5, cast=int)
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = 2000  # Сколько ждать свободное соединение из пула
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -189,6 +193,17 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Раздача медиа из ASGI (см. config/media_server.py)
+MEDIA_PRIVATE_PREFIXES = ('chat_avatars/',)  # Только для участников чата
+MEDIA_CACHE_MAX_AGE = 3600                   # Кэш файлов без хэша в имени, секунды
+MEDIA_SERVER_BLOCK_SIZE = 256 * 1024         # Блок чтения, если сервер не умеет sendfile
+
+# Медиа хранятся по хэшу содержимого со счетчиком ссылок (см. echo_api/storage.py)
+STORAGES = {
+    'default': {'BACKEND': 'backend.echo_api.storage.DedupStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -199,6 +214,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880 # 5 MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880 # 5 MB
 
+# Докачиваемая загрузка файлов постов кусками (см. echo_api/uploads.py)
+UPLOAD_CHUNK_ROOT = BASE_DIR / 'upload_chunks'  # Принятые куски, по имени sha256
+UPLOAD_CHUNK_SIZE = 1024 * 1024                 # Размер куска, байты
+UPLOAD_MAX_SIZE = 100 * 1024 * 1024             # Максимальный размер файла, байты
+UPLOAD_SESSION_TTL = 24 * 3600                  # Брошенная сессия удаляется через сутки
+
+# Уменьшенные копии картинок без EXIF (см. echo_api/media.py): имя варианта -> ширина, px
+MEDIA_POST_VARIANTS = {'thumb': 320, 'feed': 1080}
+MEDIA_AVATAR_VARIANTS = {'small': 128, 'large': 512}
+MEDIA_VARIANT_QUALITY = 80
+
 # Настройки жизненного цикла постов и комментариев (в часах)
 POST_LIFETIME_HOURS = 24       # Пост живет 24 часа
 COMMENT_LIFETIME_HOURS = 240   # Коммент живет 10 дней
@@ -208,6 +234,42 @@ DISECHO_REDUCE_HOURS = 1       # Дизлайк поста уменьшает ж
 COMMENT_ECHO_EXTEND_HOURS = 10    # Лайк комментария продлевает жизнь на 10 часов
 COMMENT_DISECHO_REDUCE_HOURS = 10 # Дизлайк комментария уменьшает жизнь на 10 часов
 
+# Счетчики Echo/DisEcho копятся в Redis и периодически сбрасываются в базу
+# (echo_api/counters.py), чтобы голоса за популярный пост не блокировали его строку
+ECHO_WRITE_BEHIND = True
+ECHO_FLUSH_BATCH_SIZE = 1000   # Объектов за один сброс
+ECHO_FLUSH_RETRY_AFTER = 60    # Через сколько секунд подбирать заявки упавшего сброса
+ECHO_CLAIM_LOG_TTL = 24 * 3600 # Сколько хранить записи о примененных заявках, секунды
+ECHO_BATCH_MAX_SIZE = 500      # Нажатий в одном запросе echos/batch/
+
+# Пагинация лент (курсорная, см. echo_api/pagination.py)
+FEED_PAGE_SIZE = 20       # Размер страницы по умолчанию
+FEED_MAX_PAGE_SIZE = 100  # Верхняя граница для ?page_size=
+
+# Кэш страниц общих лент (см. echo_api/feed_cache.py)
+FEED_CACHE_TIMEOUT = 30       # Максимальный TTL страницы, секунды
+FEED_CACHE_LOCK_TIMEOUT = 10  # Блокировка сборки страницы, секунды
+FEED_CACHE_LOCK_WAIT = 2      # Сколько ждать чужую сборку, прежде чем собрать самим
+
+# Дерево комментариев (posts/<id>/comments/?mode=tree, см. echo_api/threads.py)
+COMMENT_TREE_DEPTH = 3          # Уровней ответов под корнем по умолчанию (?depth=)
+COMMENT_TREE_MAX_DEPTH = 10
+COMMENT_TREE_BREADTH = 5        # Ответов у каждого узла по умолчанию (?breadth=)
+COMMENT_TREE_MAX_BREADTH = 50
+COMMENT_TREE_MAX_NODES = 1000   # Предел потомков на страницу корней, делится поровну между корнями
+
+# Лента друзей (таймлайны в Redis, см. echo_api/timelines.py)
+FRIEND_GRAPH_CACHE_TIMEOUT = 3600       # Кэш списка друзей, секунды
+FRIEND_FEED_FANOUT_LIMIT = 1000         # Больше друзей - посты автора не раскладываются, а дочитываются
+FRIEND_FEED_TIMELINE_SIZE = 800         # Максимум постов в одном таймлайне
+FRIEND_FEED_TIMELINE_TTL = 2 * 24 * 3600  # Неиспользуемый таймлайн удаляется через 2 дня
+
+# Удаление истекших постов (echo_api/tasks.py)
+POST_EXPIRY_BATCH_SIZE = 500    # Постов в одной транзакции
+POST_EXPIRY_TIME_BUDGET = 60    # Секунд на проход (меньше таймаута Django-Q)
+POST_EXPIRY_POLL_INTERVAL = 1.0 # Максимальная пауза воркера post_expiry_worker, секунды
+POST_EXPIRY_RETRY_DELAY = 5     # Через сколько секунд повторить пост, который не удалось убить
+
 # валидатор пароля 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -228,6 +290,45 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Логи приложений пишутся из отдельного потока (см. config/log_queue.py)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'queue': {'class': 'backend.config.log_queue.QueueStreamHandler', 'formatter': 'default'},
+    },
+    'loggers': {
+        'backend': {'handlers': ['queue'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+# Мессенджер
+CHAT_MEMBERS_CACHE_TIMEOUT = 300   # Кэш участников чата для WebSocket, секунды
+CHAT_MESSAGE_MAX_LENGTH = 5000     # Как у MessageSerializer.text
+CHAT_MUX_MAX_CHATS = 500           # Подписок на чаты у одного сокета ws/messenger/
+CHAT_HISTORY_PAGE_SIZE = 50        # Сообщений на странице истории по умолчанию
+CHAT_HISTORY_MAX_PAGE_SIZE = 200   # Верхняя граница ?limit=
+CHAT_UNREAD_COUNT_CAP = 99         # Непрочитанное считается до этого числа, дальше "99+"
+CHAT_HISTORY_OVERLAP_SECONDS = 5   # Запас after_id назад: сообщения пишутся не строго по _id
+CHAT_LIST_PAGE_SIZE = 50           # Чатов на странице списка (курсор по last_message_date)
+CHAT_LIST_MAX_PAGE_SIZE = 200      # Верхняя граница ?page_size=
+# Кэш профилей отправителей (см. messenger_api/senders.py)
+CHAT_SENDER_CACHE_SIZE = 10000     # Записей в памяти процесса
+CHAT_SENDER_LOCAL_TIMEOUT = 60     # Жизнь записи в памяти, секунды
+CHAT_SENDER_CACHE_TIMEOUT = 3600   # Жизнь записи в Redis, секунды
+
+# Пакетная запись сообщений в MongoDB (см. messenger_api/ingest.py)
+CHAT_INGEST_BATCH_SIZE = 500        # Максимум сообщений в одном insert_many
+CHAT_INGEST_FLUSH_INTERVAL = 0.005  # Сколько ждать добора пачки, секунды
+CHAT_INGEST_QUEUE_SIZE = 10000      # Больше - submit() ждет (обратное давление)
+CHAT_INGEST_MAX_IN_FLIGHT = 4       # Пачек, которые пишутся одновременно
+CHAT_INGEST_METRICS_INTERVAL = 60   # Как часто логировать metrics() (INFO), секунды
+# Как часто записанные сообщения обновляют Chat.last_message_* (см. messenger_api/last_message.py)
+CHAT_LAST_MESSAGE_FLUSH_INTERVAL = 1.0
+
 # --- КОНФИГУРАЦИЯ DJANGO-Q ---
 Q_CLUSTER = {
     'name': 'DjangOQ',
@@ -237,12 +338,34 @@ Q_CLUSTER = {
 
     'orm': 'default',
     'schedule': [
-        # Наш "будильник" для спасения комментариев
+        # Страховочный проход: посты в срок убивает воркер post_expiry_worker,
+        # а этот "будильник" добивает то, что выпало из расписания в Redis
         {
             'name': 'float_expired_posts',
             'func': 'echo_api.tasks.check_and_float_expired_posts', 
             'minutes': 60, # Запускать каждые 60 минут (1 час)
             'repeats': -1, # Повторять бесконечно
+        },
+        # Страховочный сброс счетчиков Echo (основной делает post_expiry_worker)
+        {
+            'name': 'flush_echo_counters',
+            'func': 'echo_api.tasks.flush_echo_counters',
+            'minutes': 1,
+            'repeats': -1,
+        },
+        # Уборка старых записей о примененных заявках счетчиков
+        {
+            'name': 'cleanup_echo_claims',
+            'func': 'echo_api.tasks.cleanup_echo_claims',
+            'minutes': 60,
+            'repeats': -1,
+        },
+        # Уборка брошенных загрузок и ничейных кусков
+        {
+            'name': 'cleanup_uploads',
+            'func': 'echo_api.tasks.cleanup_uploads',
+            'minutes': 60,
+            'repeats': -1,
         }
     ]
 }
\ No newline at end of file
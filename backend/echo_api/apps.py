@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class EchoAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'backend.echo_api'
\ No newline at end of file
+    name = 'backend.echo_api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
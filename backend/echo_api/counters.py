@@ -0,0 +1,381 @@
+"""
+Счетчики Echo/DisEcho с отложенной записью (write-behind).
+
+Голос не трогает горячую строку Post/Comment. Приращения echo_count,
+disecho_count и сдвиг expires_at (в секундах) копятся в Redis-хеше
+`echo:pending:<model>:<pk>` через HINCRBY, а объект попадает в множество
+`echo:dirty`. Воркер post_expiry_worker (и страховочная задача Django-Q)
+периодически вызывает flush(): забирает хеши и сворачивает их в базу одним
+UPDATE на модель.
+
+Каждый сброс забирает хеш под своим токеном - переименовывает его в заявку
+`echo:flushing:<model>:<pk>:<token>` (список заявок объекта - в
+`echo:claims:<model>:<pk>`). Заявка записывается в CounterClaim в той же
+транзакции, что и UPDATE, поэтому применяется ровно один раз: ни повтор
+после падения между коммитом и удалением ключа, ни параллельный сброс ее не
+удвоят. Заявки упавших сбросов подбираются через ECHO_FLUSH_RETRY_AFTER секунд.
+
+Чтение (merge_pending) добавляет к строке накопленный хеш и заявки, которых
+еще нет в CounterClaim, поэтому клиенты видят точные значения и до, и во
+время сброса.
+"""
+import logging
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DurationField, F, IntegerField, Value, When
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from . import expiry
+from .models import CounterClaim
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'echo:pending:{member}'
+FLUSHING_KEY = 'echo:flushing:{member}:{token}'
+CLAIMS_KEY = 'echo:claims:{member}'
+CLAIMED_KEY = 'echo:claimed'
+DIRTY_KEY = 'echo:dirty'
+DELTA_FIELDS = ('echo', 'disecho', 'seconds')
+
+COUNTER_ERRORS = (RedisError, NotImplementedError)
+
+# Забирает накопленное в новую заявку с токеном сброса и возвращает токены
+# всех невыгруженных заявок объекта (вместе с заявками упавших сбросов).
+# KEYS: pending, новая заявка, заявки объекта, объекты с заявками; ARGV: token, member
+_CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('SADD', KEYS[3], ARGV[1])
+    redis.call('SADD', KEYS[4], ARGV[2])
+end
+return redis.call('SMEMBERS', KEYS[3])
+"""
+
+# Удаляет примененные заявки объекта.
+# KEYS: заявки объекта, объекты с заявками, хеши заявок...; ARGV: member, токены...
+_RELEASE_SCRIPT = """
+for i = 3, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+redis.call('SREM', KEYS[1], unpack(ARGV, 2))
+if redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+"""
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def _member(model_name, pk):
+    return f'{model_name}:{pk}'
+
+
+def _new_token():
+    """Токен сброса: время заявки (для повтора брошенных) и случайная часть."""
+    return f'{int(time.time())}-{uuid.uuid4().hex[:12]}'
+
+
+def _claimed_at(token):
+    return int(token.split('-', 1)[0])
+
+
+def _claim_id(member, token):
+    return f'{member}:{token}'
+
+
+def _parse(flat):
+    """Плоский ответ HGETALL (или dict) -> {'echo': int, 'disecho': int, 'seconds': int}."""
+    if isinstance(flat, dict):
+        items = flat.items()
+    else:
+        items = zip(flat[::2], flat[1::2])
+    delta = dict.fromkeys(DELTA_FIELDS, 0)
+    for field, value in items:
+        field = field.decode() if isinstance(field, bytes) else field
+        if field in delta:
+            delta[field] += int(value)
+    return delta
+
+
+# -------------------- Запись --------------------
+
+def apply_deltas(model, deltas):
+    """
+    Применяет приращения к строкам model одним UPDATE.
+
+    deltas - {pk: (echo, disecho, seconds)}.
+    """
+    deltas = {pk: delta for pk, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return 0
+
+    def by_pk(index, wrap, output_field):
+        whens = [When(pk=pk, then=Value(wrap(delta[index]))) for pk, delta in deltas.items()]
+        return Case(*whens, default=Value(wrap(0)), output_field=output_field)
+
+    updates = {
+        'echo_count': F('echo_count') + by_pk(0, int, IntegerField()),
+        'disecho_count': F('disecho_count') + by_pk(1, int, IntegerField()),
+        'expires_at': F('expires_at') + by_pk(2, lambda s: timedelta(seconds=s), DurationField()),
+    }
+    if any(field.name == 'updated_at' for field in model._meta.fields):
+        updates['updated_at'] = timezone.now()
+    return model.objects.filter(pk__in=deltas).update(**updates)
+
+
+def add_deltas(model_name, deltas):
+    """
+    Копит приращения в Redis одним pipeline. deltas - {pk: (echo, disecho, seconds)}.
+    Сдвиг жизни поста сразу попадает в расписание истечения.
+    """
+    pipe = _redis().pipeline()
+    for pk, (echo, disecho, seconds) in deltas.items():
+        member = _member(model_name, pk)
+        key = PENDING_KEY.format(member=member)
+        pipe.hincrby(key, 'echo', echo)
+        pipe.hincrby(key, 'disecho', disecho)
+        pipe.hincrby(key, 'seconds', seconds)
+        pipe.sadd(DIRTY_KEY, member)
+        if model_name == 'post' and seconds:
+            # XX: не создаем запись, если поста нет в расписании
+            pipe.zadd(expiry.EXPIRY_KEY, {str(pk): seconds}, xx=True, incr=True)
+    pipe.execute()
+
+
+def add_delta(obj, echo, disecho, seconds):
+    add_deltas(obj._meta.model_name, {obj.pk: (echo, disecho, seconds)})
+
+
+def _apply_now(obj, echo, disecho, seconds):
+    apply_deltas(type(obj), {obj.pk: (echo, disecho, seconds)})
+    obj.refresh_from_db(fields=['echo_count', 'disecho_count', 'expires_at'])
+    if obj._meta.model_name == 'post':
+        obj.schedule_expiry()
+
+
+def _apply_many_now(model, deltas):
+    apply_deltas(model, deltas)
+    if model._meta.model_name != 'post':
+        return
+
+    expirations = dict(model.objects.filter(pk__in=deltas).values_list('id', 'expires_at'))
+
+    def schedule():
+        try:
+            expiry.schedule_posts(expirations)
+        except expiry.EXPIRY_ERRORS:
+            logger.exception("Не удалось обновить расписание истечения для %s постов", len(expirations))
+
+    transaction.on_commit(schedule)
+
+
+def record(obj, echo, disecho, shift):
+    """
+    Учитывает голос за obj: echo/disecho - приращения счетчиков, shift - сдвиг expires_at.
+
+    При ECHO_WRITE_BEHIND приращение уходит в Redis после коммита транзакции
+    голоса; если Redis недоступен - пишется в базу напрямую.
+    """
+    seconds = int(shift.total_seconds())
+    if not (echo or disecho or seconds):
+        return
+
+    if not settings.ECHO_WRITE_BEHIND:
+        _apply_now(obj, echo, disecho, seconds)
+        return
+
+    def push():
+        try:
+            add_delta(obj, echo, disecho, seconds)
+        except COUNTER_ERRORS:
+            logger.exception("Redis недоступен, счетчики %s пишутся напрямую", obj)
+            _apply_now(obj, echo, disecho, seconds)
+
+    transaction.on_commit(push)
+
+
+def record_many(model, deltas):
+    """То же, что record, для пачки объектов model: deltas - {pk: (echo, disecho, seconds)}."""
+    deltas = {pk: delta for pk, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+
+    if not settings.ECHO_WRITE_BEHIND:
+        _apply_many_now(model, deltas)
+        return
+
+    def push():
+        try:
+            add_deltas(model._meta.model_name, deltas)
+        except COUNTER_ERRORS:
+            logger.exception("Redis недоступен, счетчики %s объектов пишутся напрямую", len(deltas))
+            _apply_many_now(model, deltas)
+
+    transaction.on_commit(push)
+
+
+# -------------------- Чтение --------------------
+
+def merge_pending(instances):
+    """
+    Добавляет к загруженным Post/Comment еще не сброшенные приращения
+    (один pipeline на всю страницу, во время сброса - еще один и запрос к
+    CounterClaim). Повторный вызов для того же объекта ничего не делает.
+
+    Примененная заявка не добавляется, даже если ее ключ еще не удален:
+    счетчик может на мгновение отстать (строка прочитана до коммита сброса),
+    но не удвоится.
+    """
+    pending = [obj for obj in instances if not getattr(obj, '_pending_merged', False)]
+    if not pending or not settings.ECHO_WRITE_BEHIND:
+        return
+
+    members = [_member(obj._meta.model_name, obj.pk) for obj in pending]
+    try:
+        r = _redis()
+        # MULTI: хеш и список заявок - одним снимком, иначе переименование
+        # хеша между двумя чтениями посчитало бы его дважды
+        pipe = r.pipeline()
+        for member in members:
+            pipe.hgetall(PENDING_KEY.format(member=member))
+            pipe.smembers(CLAIMS_KEY.format(member=member))
+        results = pipe.execute()
+
+        claims = [
+            (index, member, token.decode())
+            for index, member in enumerate(members)
+            for token in results[2 * index + 1]
+        ]
+        if claims:
+            pipe = r.pipeline(transaction=False)
+            for _, member, token in claims:
+                pipe.hgetall(FLUSHING_KEY.format(member=member, token=token))
+            contents = pipe.execute()
+    except COUNTER_ERRORS:
+        return
+
+    deltas = [_parse(results[2 * index]) for index in range(len(pending))]
+    if claims:
+        applied = set(CounterClaim.objects.filter(
+            id__in=[_claim_id(member, token) for _, member, token in claims],
+        ).values_list('id', flat=True))
+        for (index, member, token), flat in zip(claims, contents):
+            if _claim_id(member, token) in applied:
+                continue
+            for field, value in _parse(flat).items():
+                deltas[index][field] += value
+
+    for obj, delta in zip(pending, deltas):
+        obj.echo_count += delta['echo']
+        obj.disecho_count += delta['disecho']
+        if delta['seconds'] and obj.expires_at is not None:
+            obj.expires_at += timedelta(seconds=delta['seconds'])
+        obj._pending_merged = True
+
+
+# -------------------- Сброс в базу --------------------
+
+def flush(objects=None, limit=None):
+    """
+    Сворачивает накопленные приращения в базу. Возвращает число обновленных объектов.
+
+    objects - необязательный список (model_name, pk): сбросить только их
+    (например, перед тем как решать, истек ли пост), включая заявки других
+    сбросов. Без objects, кроме грязных объектов, подбираются заявки,
+    брошенные сбросами больше ECHO_FLUSH_RETRY_AFTER секунд назад.
+    """
+    r = _redis()
+    limit = limit or settings.ECHO_FLUSH_BATCH_SIZE
+    token = _new_token()
+    if objects is None:
+        members = {member.decode() for member in r.spop(DIRTY_KEY, limit) or []}
+        members.update(member.decode() for member in r.srandmember(CLAIMED_KEY, limit) or [])
+        retry_before = time.time() - settings.ECHO_FLUSH_RETRY_AFTER
+    else:
+        members = {_member(model_name, pk) for model_name, pk in objects}
+        if members:
+            r.srem(DIRTY_KEY, *members)
+        retry_before = None
+    if not members:
+        return 0
+
+    pipe = r.pipeline(transaction=False)
+    for member in members:
+        pipe.eval(
+            _CLAIM_SCRIPT, 4,
+            PENDING_KEY.format(member=member), FLUSHING_KEY.format(member=member, token=token),
+            CLAIMS_KEY.format(member=member), CLAIMED_KEY, token, member,
+        )
+    claims = [
+        (member, claim)
+        for member, tokens in zip(members, pipe.execute())
+        for claim in (t.decode() for t in tokens)
+        if claim == token or retry_before is None or _claimed_at(claim) <= retry_before
+    ]
+    if not claims:
+        return 0
+
+    pipe = r.pipeline(transaction=False)
+    for member, claim in claims:
+        pipe.hgetall(FLUSHING_KEY.format(member=member, token=claim))
+    contents = {_claim_id(member, claim): flat for (member, claim), flat in zip(claims, pipe.execute())}
+
+    with transaction.atomic():
+        # Уже примененные заявки (и те, что сейчас применяет параллельный
+        # сброс - вставка дождется его коммита) вставка пропустит
+        CounterClaim.objects.bulk_create(
+            [CounterClaim(id=claim_id, batch=token) for claim_id in contents], ignore_conflicts=True,
+        )
+        owned = CounterClaim.objects.filter(id__in=contents, batch=token).values_list('id', flat=True)
+
+        by_model = defaultdict(dict)
+        for claim_id in owned:
+            model_name, pk, _ = claim_id.split(':')
+            delta = _parse(contents[claim_id])
+            current = by_model[model_name].get(int(pk), (0, 0, 0))
+            by_model[model_name][int(pk)] = tuple(
+                total + delta[field] for total, field in zip(current, DELTA_FIELDS)
+            )
+        updated = sum(
+            apply_deltas(apps.get_model('echo_api', model_name), deltas)
+            for model_name, deltas in by_model.items()
+        )
+        # Если транзакция откатится, заявки останутся в Redis до повтора
+        transaction.on_commit(lambda: release(claims))
+    return updated
+
+
+def release(claims):
+    """Удаляет из Redis заявки, которые уже записаны в CounterClaim."""
+    by_member = defaultdict(list)
+    for member, claim in claims:
+        by_member[member].append(claim)
+    try:
+        pipe = _redis().pipeline(transaction=False)
+        for member, tokens in by_member.items():
+            keys = [FLUSHING_KEY.format(member=member, token=claim) for claim in tokens]
+            pipe.eval(
+                _RELEASE_SCRIPT, 2 + len(keys),
+                CLAIMS_KEY.format(member=member), CLAIMED_KEY, *keys, member, *tokens,
+            )
+        pipe.execute()
+    except COUNTER_ERRORS:
+        # Не страшно: повторный сброс увидит их в CounterClaim и только удалит
+        logger.exception("Не удалось удалить %s примененных заявок счетчиков", len(claims))
+
+
+def cleanup():
+    """Удаляет записи CounterClaim старше ECHO_CLAIM_LOG_TTL секунд."""
+    threshold = timezone.now() - timedelta(seconds=settings.ECHO_CLAIM_LOG_TTL)
+    deleted, _ = CounterClaim.objects.filter(applied_at__lt=threshold).delete()
+    return deleted
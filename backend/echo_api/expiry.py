@@ -0,0 +1,55 @@
+"""
+Расписание истечения постов в Redis.
+
+Sorted set `posts:expiry`: member = id поста, score = expires_at (unix time).
+Post.save кладет туда пост при создании и при каждом изменении expires_at
+(в том числе из EchoToggleView), а воркер post_expiry_worker забирает
+созревшие посты за секунды, без сканирования таблицы Post.
+
+Redis здесь только ускоритель: если запись потерялась, пост добьет
+страховочный почасовой проход check_and_float_expired_posts.
+"""
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+EXPIRY_KEY = 'posts:expiry'
+
+# Ошибки Redis, которые не должны ронять запрос
+EXPIRY_ERRORS = (RedisError, NotImplementedError)
+
+# Атомарно забирает созревшие посты: два воркера не получат один и тот же id
+_POP_DUE_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #ids > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ids))
+end
+return ids
+"""
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def schedule_posts(expirations):
+    """Ставит (или переставляет) посты в расписание. expirations - {post_id: expires_at}."""
+    if expirations:
+        _redis().zadd(EXPIRY_KEY, {
+            str(post_id): expires_at.timestamp() for post_id, expires_at in expirations.items()
+        })
+
+
+def schedule_post(post_id, expires_at):
+    schedule_posts({post_id: expires_at})
+
+
+def pop_due_posts(now, limit):
+    """Забирает из расписания до limit постов, у которых expires_at <= now."""
+    ids = _redis().eval(_POP_DUE_SCRIPT, 1, EXPIRY_KEY, now.timestamp(), limit)
+    return [int(post_id) for post_id in ids]
+
+
+def next_due_at():
+    """Unix time ближайшего истечения или None, если расписание пусто."""
+    head = _redis().zrange(EXPIRY_KEY, 0, 0, withscores=True)
+    return head[0][1] if head else None
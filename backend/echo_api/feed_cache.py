@@ -0,0 +1,128 @@
+"""
+Кэш страниц публичных лент (feed/posts/, feed/floating/) в Redis.
+
+Ключ страницы: feed:<лента>:v<версия>:<хэш параметров запроса>. Версию
+ленты увеличивает только изменение ее состава (новый пост или плавучий
+комментарий, пачка истекших постов): старые страницы больше не читаются и
+доживают до TTL. Счетчики, срок жизни и число комментариев меняются без
+сброса - CachedFeedMixin читает их заново при каждой выдаче из кэша, там же
+выпадают удаленные объекты.
+
+TTL страницы не больше FEED_CACHE_TIMEOUT и не дольше, чем до истечения
+первого объекта на ней. Холодную страницу собирает один запрос (single-flight
+через cache.add), остальные ждут его результат до FEED_CACHE_LOCK_WAIT секунд.
+
+my_vote в кэше не хранится: он свой у каждого пользователя и тоже
+подставляется при чтении. Ссылки next/previous хранятся строкой запроса
+без хоста первого читателя (CachedFeedMixin.to_cache).
+"""
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+POSTS_FEED = 'posts'
+FLOATING_FEED = 'floating'
+
+VERSION_KEY = 'feed:{feed}:version'
+PAGE_KEY = 'feed:{feed}:v{version}:{params}'
+LOCK_KEY = '{page_key}:lock'
+
+# Ошибки кэша, при которых лента собирается из базы напрямую
+FEED_CACHE_ERRORS = (RedisError, ConnectionInterrupted)
+
+_LOCK_POLL_INTERVAL = 0.05
+
+
+def _version(feed):
+    key = VERSION_KEY.format(feed=feed)
+    version = cache.get(key)
+    if version is None:
+        # Начальная версия от часов: ключ мог быть вытеснен, и счет с 1
+        # снова открыл бы старые страницы
+        cache.add(key, time.time_ns() // 1000, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _page_key(feed, request):
+    params = urlencode(sorted(request.query_params.items()))
+    digest = hashlib.md5(params.encode(), usedforsecurity=False).hexdigest()
+    return PAGE_KEY.format(feed=feed, version=_version(feed), params=digest)
+
+
+def _page_timeout(data):
+    """Не дольше FEED_CACHE_TIMEOUT и не дольше, чем до первого истечения на странице."""
+    timeout = settings.FEED_CACHE_TIMEOUT
+    expirations = [
+        parse_datetime(item['expires_at']) for item in data.get('results', []) if item.get('expires_at')
+    ]
+    if expirations:
+        left = (min(expirations) - timezone.now()).total_seconds()
+        timeout = min(timeout, max(int(left), 1))
+    return timeout
+
+
+def get_or_build(feed, request, build):
+    """Данные страницы ленты из кэша; при промахе их собирает build() - один на весь кластер."""
+    try:
+        key = _page_key(feed, request)
+        data = cache.get(key)
+        if data is not None:
+            return data
+        acquired = cache.add(LOCK_KEY.format(page_key=key), 1, timeout=settings.FEED_CACHE_LOCK_TIMEOUT)
+    except FEED_CACHE_ERRORS:
+        logger.warning("Кэш ленты %s недоступен, собираем из базы", feed)
+        return build()
+
+    if not acquired:
+        # Страницу уже собирает другой запрос - ждем его результат
+        deadline = time.monotonic() + settings.FEED_CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(_LOCK_POLL_INTERVAL)
+            data = cache.get(key)
+            if data is not None:
+                return data
+        logger.warning("Не дождались сборки страницы ленты %s, собираем сами", feed)
+        return build()
+
+    try:
+        data = build()
+        try:
+            cache.set(key, data, timeout=_page_timeout(data))
+        except FEED_CACHE_ERRORS:
+            logger.exception("Не удалось сохранить страницу ленты %s", feed)
+    finally:
+        try:
+            cache.delete(LOCK_KEY.format(page_key=key))
+        except FEED_CACHE_ERRORS:
+            # Блокировка истечет сама через FEED_CACHE_LOCK_TIMEOUT
+            pass
+    return data
+
+
+def invalidate(*feeds):
+    """Сбрасывает страницы лент после коммита текущей транзакции."""
+    def bump():
+        for feed in feeds:
+            key = VERSION_KEY.format(feed=feed)
+            try:
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    # Версии еще нет: первое чтение заведет новую
+                    pass
+            except FEED_CACHE_ERRORS:
+                logger.exception("Не удалось сбросить кэш ленты %s", feed)
+
+    transaction.on_commit(bump)
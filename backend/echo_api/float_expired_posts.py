@@ -1,12 +1,9 @@
 from django.core.management.base import BaseCommand
-from backend.echo_api.models import Post
-from django.utils import timezone
+from backend.echo_api.tasks import check_and_float_expired_posts
 
 class Command(BaseCommand):
     help = 'Переводит комментарии истёкших постов в плавающие'
 
     def handle(self, *args, **kwargs):
-        expired_posts = Post.objects.filter(expires_at__lt=timezone.now())
-        for post in expired_posts:
-            post.kill_and_float_comments()
-        self.stdout.write(self.style.SUCCESS('Обработка завершена'))
\ No newline at end of file
+        metrics = check_and_float_expired_posts()
+        self.stdout.write(self.style.SUCCESS(f'Обработка завершена: {metrics}'))
\ No newline at end of file
@@ -0,0 +1,85 @@
+import threading
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from backend.echo_api import counters
+from backend.echo_api.models import Echo, Post
+from backend.echo_api.views import EchoToggleView
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест EchoToggleView: пропускная способность голосования '
+        'за один пост при разном числе одновременных голосующих'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', default='1,2,4,8,16,32', help='Уровни параллельности через запятую')
+        parser.add_argument('--duration', type=float, default=5.0, help='Секунд на один уровень')
+        parser.add_argument('--direct', action='store_true', help='Писать счетчики сразу в базу (ECHO_WRITE_BEHIND=False)')
+
+    def handle(self, *args, **options):
+        levels = [int(level) for level in options['voters'].split(',')]
+        duration = options['duration']
+        prefix = f'loadtest_{uuid.uuid4().hex[:8]}'
+
+        author = User.objects.create(username=f'{prefix}_author')
+        users = [User.objects.create(username=f'{prefix}_{i}') for i in range(max(levels))]
+        post = Post.objects.create(author=author, content='Нагрузочный тест Echo')
+
+        try:
+            with override_settings(ECHO_WRITE_BEHIND=not options['direct']):
+                mode = 'напрямую в базу' if options['direct'] else 'write-behind'
+                self.stdout.write(f'Пост {post.pk}, счетчики: {mode}, {duration} с на уровень')
+                for voters in levels:
+                    total = self.run_level(post, users[:voters], duration)
+                    rate = total / duration
+                    self.stdout.write(
+                        f'{voters:>4} голосующих: {rate:9.1f} голосов/с ({rate / voters:7.1f} на голосующего)'
+                    )
+                self.check_consistency(post)
+        finally:
+            post.delete()
+            User.objects.filter(username__startswith=prefix).delete()
+
+    def run_level(self, post, users, duration):
+        view = EchoToggleView.as_view()
+        factory = APIRequestFactory()
+        done = [0] * len(users)
+        deadline = time.monotonic() + duration
+
+        def vote(index, user):
+            try:
+                while time.monotonic() < deadline:
+                    request = factory.post(f'/echo_api/posts/{post.pk}/echo/')
+                    force_authenticate(request, user=user)
+                    view(request, pk=post.pk, content_type_model='post', is_echo_url_param=True)
+                    done[index] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=(i, user)) for i, user in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(done)
+
+    def check_consistency(self, post):
+        """Итоговый счетчик после сброса должен совпасть с числом строк Echo."""
+        try:
+            counters.flush()
+        except counters.COUNTER_ERRORS:
+            pass
+        post.refresh_from_db()
+        actual = Echo.objects.filter(object_id=post.pk, content_type__model='post', is_echo=True).count()
+        style = self.style.SUCCESS if post.echo_count == actual else self.style.ERROR
+        self.stdout.write(style(f'echo_count={post.echo_count}, строк Echo={actual}'))
@@ -0,0 +1,63 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+
+from backend.echo_api import expiry
+from backend.echo_api.tasks import float_due_posts, flush_echo_counters, rebuild_expiry_schedule
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Воркер истечения постов: убивает посты по расписанию из Redis в течение секунд '
+        'после expires_at и сбрасывает в базу накопленные счетчики Echo'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Перед запуском заполнить расписание всеми постами из базы',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            total = rebuild_expiry_schedule()
+            self.stdout.write(self.style.SUCCESS(f'Расписание восстановлено: {total} постов'))
+
+        self.stdout.write('Воркер истечения постов запущен')
+        while True:
+            try:
+                delay = self.step()
+            except expiry.EXPIRY_ERRORS as e:
+                self.stderr.write(f'Redis недоступен: {e}')
+                delay = settings.POST_EXPIRY_POLL_INTERVAL * 5
+            except DatabaseError as e:
+                self.stderr.write(f'Ошибка базы данных: {e}')
+                # Разорванное соединение откроется заново на следующем проходе
+                close_old_connections()
+                delay = settings.POST_EXPIRY_POLL_INTERVAL * 5
+            except Exception:
+                # Воркер не перезапускается сам: любая ошибка - пауза и новый проход
+                logger.exception("Сбой прохода воркера истечения постов")
+                delay = settings.POST_EXPIRY_POLL_INTERVAL * 5
+            if delay:
+                time.sleep(delay)
+
+    def step(self):
+        """Один проход воркера. Возвращает паузу до следующего, секунды (0 - работа еще есть)."""
+        flushed = flush_echo_counters()
+        if float_due_posts() or flushed >= settings.ECHO_FLUSH_BATCH_SIZE:
+            # Возможно, работы больше, чем влезло в одну пачку
+            return 0
+
+        # Спим до ближайшего истечения, но не дольше POST_EXPIRY_POLL_INTERVAL:
+        # новые посты и продления могут сдвинуть голову расписания
+        poll_interval = settings.POST_EXPIRY_POLL_INTERVAL
+        next_due = expiry.next_due_at()
+        if next_due is None:
+            return poll_interval
+        return min(poll_interval, max(next_due - time.time(), 0.05))
@@ -0,0 +1,27 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django_q.tasks import async_task
+
+from backend.echo_api import media
+
+
+class Command(BaseCommand):
+    help = 'Делает уменьшенные копии для файлов, загруженных до появления фоновой обработки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync', action='store_true', help='Обработать здесь, а не в воркерах Django-Q')
+
+    def handle(self, *args, **options):
+        for label, (field_name, variants_field, _) in media.MEDIA_FIELDS.items():
+            Model = apps.get_model(label)
+            queryset = Model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            total = 0
+            for instance in queryset.only('pk', field_name, variants_field).iterator():
+                if not media.needs_processing(instance):
+                    continue
+                if options['sync']:
+                    media.process(label, instance.pk)
+                else:
+                    async_task(media.process, label, instance.pk)
+                total += 1
+            self.stdout.write(f'{label}: {total}')
@@ -0,0 +1,153 @@
+"""
+Фоновая обработка картинок: уменьшенные копии (варианты) без EXIF.
+
+После загрузки PostFile.file, CustomUser.avatar или Chat.avatar сигнал ставит
+задачу в Django-Q (async_task). Задача открывает оригинал через Pillow,
+поворачивает по EXIF-ориентации, пережимает в WebP (JPEG, если Pillow собран
+без WebP) под каждую ширину из настроек и записывает пути в JSON-поле:
+
+    {"source": "post_files/ab/ab12...ef.jpg", "feed": "post_files/cd/cd34...90.webp", ...}
+
+"source" - имя оригинала, из которого сделаны варианты. Если файл заменили,
+а задача еще не отработала, source не совпадет и variant_url отдаст оригинал.
+Видео, анимации (GIF, WebP) и битые файлы пропускаются: в variants у них
+только source, отдается оригинал. Если файл убрали (аватар сброшен), варианты
+удаляются и variants становится пустым.
+
+Варианты хранятся в общем хранилище (echo_api/storage.py) со счетчиком ссылок:
+старые варианты снимаются, когда готовы новые.
+"""
+import logging
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.dispatch import Signal
+from django_q.tasks import async_task
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+logger = logging.getLogger(__name__)
+
+# Ошибки оригинала, при которых варианты не делаются
+IMAGE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError)
+
+# Отправляется, когда варианты записаны (sender - модель, pk - объект):
+# варианты пишутся через update(), post_save при этом не срабатывает
+variants_ready = Signal()
+
+MEDIA_FIELDS = {
+    # модель: (поле с файлом, поле с вариантами, настройка с ширинами)
+    'echo_api.postfile': ('file', 'variants', 'MEDIA_POST_VARIANTS'),
+    'users_api.customuser': ('avatar', 'avatar_variants', 'MEDIA_AVATAR_VARIANTS'),
+    'messenger_api.chat': ('avatar', 'avatar_variants', 'MEDIA_AVATAR_VARIANTS'),
+}
+
+
+def _spec(instance):
+    return MEDIA_FIELDS[instance._meta.label_lower]
+
+
+def _variant_format():
+    return ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+
+def variant_url(field_file, variants, name):
+    """URL варианта name, пока его нет - URL оригинала (None, если файла нет)."""
+    if not field_file:
+        return None
+    variants = variants or {}
+    if variants.get('source') == field_file.name and name in variants:
+        return field_file.storage.url(variants[name])
+    return field_file.url
+
+
+def needs_processing(instance):
+    field_name, variants_field, _ = _spec(instance)
+    source = getattr(instance, field_name).name or None
+    return (getattr(instance, variants_field) or {}).get('source') != source
+
+
+def schedule(instance):
+    """Ставит обработку в очередь после коммита, если файл новый."""
+    if not needs_processing(instance):
+        return
+    label = instance._meta.label_lower
+    pk = instance.pk
+    transaction.on_commit(lambda: async_task(process, label, pk, task_name=f'media:{label}:{pk}'))
+
+
+def _render(image, width, image_format):
+    copy = image.copy()
+    copy.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+    if image_format == 'JPEG' and copy.mode not in ('RGB', 'L'):
+        copy = copy.convert('RGB')
+    buffer = BytesIO()
+    # Метаданные не передаются - в варианте нет EXIF (геометки и т.п.)
+    copy.save(buffer, image_format, quality=settings.MEDIA_VARIANT_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def build_variants(field_file, widths):
+    """Делает варианты оригинала и возвращает словарь для JSON-поля."""
+    image_format, extension = _variant_format()
+    directory, filename = os.path.split(field_file.name)
+    stem = os.path.splitext(filename)[0]
+    storage = field_file.storage
+
+    with field_file.open('rb') as source, Image.open(source) as image:
+        if getattr(image, 'is_animated', False):
+            # Вариант был бы первым кадром: анимацию отдаем оригиналом
+            return {'source': field_file.name}
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        variants = {'source': field_file.name}
+        for name, width in widths.items():
+            # Картинку меньше варианта не растягиваем, но пережимаем без EXIF
+            data = _render(image, min(width, image.width), image_format)
+            path = f'{directory}/variants/{stem}_{name}.{extension}'
+            variants[name] = storage.save(path, ContentFile(data))
+    return variants
+
+
+def variant_names(variants):
+    return [path for name, path in (variants or {}).items() if name != 'source']
+
+
+def delete_variants(storage, variants):
+    for path in variant_names(variants):
+        storage.delete(path)
+
+
+def process(label, pk):
+    """Задача Django-Q: варианты для одного объекта из MEDIA_FIELDS."""
+    Model = apps.get_model(label)
+    field_name, variants_field, setting = MEDIA_FIELDS[label]
+    instance = Model.objects.filter(pk=pk).only('pk', field_name, variants_field).first()
+    if instance is None or not needs_processing(instance):
+        return None
+
+    field_file = getattr(instance, field_name)
+    old_variants = getattr(instance, variants_field)
+    if not field_file:
+        variants = {}
+    else:
+        try:
+            variants = build_variants(field_file, getattr(settings, setting))
+        except IMAGE_ERRORS:
+            # Не картинка (видео) или битый файл: так и отдаем оригинал
+            logger.info("Варианты не сделаны для %s %s: %s", label, pk, field_file.name)
+            variants = {'source': field_file.name}
+
+    # Оригинал могли заменить, пока шла обработка - тогда результат устарел
+    updated = Model.objects.filter(pk=pk, **{field_name: field_file.name}).update(**{variants_field: variants})
+    if updated:
+        delete_variants(field_file.storage, old_variants)
+        variants_ready.send(sender=Model, pk=pk)
+    else:
+        delete_variants(field_file.storage, variants)
+    return variants
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:11
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('echo_api', '0011_feed_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='echo',
+            index=models.Index(fields=['user', 'content_type', 'object_id'], include=('is_echo',), name='idx_echo_user_object'),
+        ),
+    ]
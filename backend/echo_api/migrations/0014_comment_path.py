@@ -0,0 +1,43 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+SEGMENT = 10
+BATCH_SIZE = 2000
+
+
+def fill_paths(apps, schema_editor):
+    """Родитель всегда создан раньше ответа, поэтому хватает одного прохода по id."""
+    Comment = apps.get_model('echo_api', 'Comment')
+    paths = {}
+    batch = []
+    for comment in Comment.objects.order_by('id').only('id', 'parent_comment_id').iterator(chunk_size=BATCH_SIZE):
+        comment.path = paths.get(comment.parent_comment_id, '') + f'{comment.id:0{SEGMENT}d}'
+        paths[comment.id] = comment.path
+        batch.append(comment)
+        if len(batch) >= BATCH_SIZE:
+            Comment.objects.bulk_update(batch, ['path'])
+            batch = []
+    Comment.objects.bulk_update(batch, ['path'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('echo_api', '0013_echo_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='idx_comment_post_path'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('echo_api', '0015_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postfile',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
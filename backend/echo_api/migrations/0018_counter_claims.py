@@ -0,0 +1,21 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('echo_api', '0017_media_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterClaim',
+            fields=[
+                ('id', models.CharField(max_length=80, primary_key=True, serialize=False)),
+                ('batch', models.CharField(max_length=32)),
+                ('applied_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:58
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('echo_api', '0018_counter_claims'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Сначала новый уникальный индекс, потом старые: оценки не остаются без уникальности
+        migrations.AddConstraint(
+            model_name='echo',
+            constraint=models.UniqueConstraint(fields=('user', 'content_type', 'object_id'), include=('is_echo',), name='uniq_echo_user_object'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='echo',
+            unique_together=set(),
+        ),
+        migrations.RemoveIndex(
+            model_name='echo',
+            name='idx_echo_user_object',
+        ),
+    ]
@@ -5,6 +5,52 @@ from datetime import timedelta
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction 
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import logging
+import uuid
+
+from . import expiry, feed_cache
+
+logger = logging.getLogger(__name__)
+
+
+class PostQuerySet(models.QuerySet):
+    def alive(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def for_feed(self):
+        """
+        Подгружает все, что читает PostSerializer: автора, файлы и число
+        не плавучих комментариев. Страница любого размера стоит 2 запроса.
+        """
+        return self.select_related('author').prefetch_related('files').with_comments_count()
+
+    def with_comments_count(self):
+        """non_floating_comments_count: число не плавучих комментариев, подзапросом в том же SELECT."""
+        comments_count = (
+            Comment.objects.filter(post=OuterRef('pk'), is_floating=False)
+            .order_by().values('post').annotate(count=Count('pk')).values('count')
+        )
+        return self.annotate(non_floating_comments_count=Coalesce(Subquery(comments_count), 0))
+
+
+class CommentQuerySet(models.QuerySet):
+    def alive(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def for_feed(self):
+        """Подгружает автора и родительский комментарий с его автором одним JOIN."""
+        return self.select_related('author', 'parent_comment__author')
+
+    def with_replies_count(self):
+        """replies_count: число прямых ответов, подзапросом в том же SELECT."""
+        replies = (
+            Comment.objects.filter(parent_comment=OuterRef('pk'), is_floating=False)
+            .order_by().values('parent_comment').annotate(count=Count('pk')).values('count')
+        )
+        return self.annotate(replies_count=Coalesce(Subquery(replies), 0))
+
 
 # --- Модель поста ---
 class Post(models.Model):
@@ -17,12 +63,40 @@ class Post(models.Model):
     disecho_count = models.IntegerField(default=0)
     is_floating = models.BooleanField(default=False) 
 
+    objects = PostQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Ключ курсорной пагинации лент: (created_at, id)
+            models.Index(fields=['-created_at', '-id'], name='idx_post_created'),
+            models.Index(fields=['author', '-created_at', '-id'], name='idx_post_author_created'),
+            # Поиск истекших постов
+            models.Index(fields=['expires_at'], name='idx_post_expires'),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.id: 
             initial_lifetime = timedelta(hours=settings.POST_LIFETIME_HOURS)
             self.expires_at = timezone.now() + initial_lifetime
         super().save(*args, **kwargs)
 
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'expires_at' in update_fields:
+            self.schedule_expiry()
+
+    def schedule_expiry(self):
+        """Ставит пост в расписание истечения (echo_api/expiry.py) после коммита."""
+        post_id, expires_at = self.pk, self.expires_at
+
+        def schedule():
+            try:
+                expiry.schedule_post(post_id, expires_at)
+            except expiry.EXPIRY_ERRORS:
+                # Не страшно: пост добьет почасовой проход
+                logger.exception("Не удалось поставить пост %s в расписание истечения", post_id)
+
+        transaction.on_commit(schedule)
+
     def add_echo(self):
         self.echo_count += 1
         self.expires_at += timedelta(hours=settings.ECHO_EXTEND_HOURS) 
@@ -38,15 +112,14 @@ class Post(models.Model):
     def kill_and_float_comments(self):
         """Убивает пост, открепляет его комментарии и удаляет сам пост."""
         
-        comments_count = self.comments.count()
-        
-        # Спасаем все комментарии
-        for comment in self.comments.all():
-            comment.make_floating() 
+        # Спасаем все комментарии одним UPDATE
+        comments_count = self.comments.update(is_floating=True, post=None)
             
         # Удаляем сам пост
         self.delete() 
-            
+
+        # Пост ушел из общей ленты, комментарии пришли в ленту плавучих
+        feed_cache.invalidate(feed_cache.POSTS_FEED, feed_cache.FLOATING_FEED)
         return comments_count
 
     def __str__(self):
@@ -57,6 +130,8 @@ class PostFile(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='files')
     file = models.FileField(upload_to='post_files/')
     order = models.PositiveIntegerField(default=0)
+    # Уменьшенные копии картинки (см. echo_api/media.py)
+    variants = models.JSONField(default=dict, blank=True, editable=False)
 
     class Meta:
         ordering = ['order']
@@ -65,6 +140,73 @@ class PostFile(models.Model):
     def __str__(self):
         return f"File for Post {self.post.id} (Order: {self.order})"
 
+
+class MediaBlob(models.Model):
+    """
+    Файл в хранилище с дедупликацией (echo_api/storage.py): имя - sha256
+    содержимого, refcount - сколько полей ссылается на этот файл.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} (refs: {self.refcount})"
+
+
+class CounterClaim(models.Model):
+    """
+    Примененная заявка сброса счетчиков Echo (см. echo_api/counters.py):
+    id - '<model>:<pk>:<token>' хеша в Redis. Пишется в одной транзакции
+    с UPDATE счетчиков, поэтому хеш не применяется дважды.
+    """
+    id = models.CharField(max_length=80, primary_key=True)
+    batch = models.CharField(max_length=32)  # Токен сброса, который применил заявку
+    applied_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.id
+
+
+class Upload(models.Model):
+    """
+    Сессия докачиваемой загрузки файла для поста (см. echo_api/uploads.py).
+
+    Клиент шлет файл кусками по chunk_size байт; chunks[i] - sha256 принятого
+    куска i или None. После complete собранный файл лежит в file, и пост
+    ссылается на него через upload_ids вместо повторной загрузки.
+    """
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    STATUS_CHOICES = [(PENDING, 'Загружается'), (COMPLETE, 'Собран')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    chunks = models.JSONField(default=list)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    file = models.FileField(upload_to='post_files/', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Уборка брошенных сессий
+            models.Index(fields=['status', 'created_at'], name='idx_upload_status_created'),
+        ]
+
+    @property
+    def chunks_total(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def received(self):
+        return [index for index, digest in enumerate(self.chunks) if digest]
+
+    def __str__(self):
+        return f"Upload {self.id} ({self.filename}, {self.status})"
+
 # --- Модель комментария ---
 class Comment(models.Model):
     post = models.ForeignKey(
@@ -86,6 +228,29 @@ class Comment(models.Model):
     is_toxic = models.BooleanField(default=False, verbose_name='Токсичный')
     
     is_floating = models.BooleanField(default=False)
+
+    # Материализованный путь: id предков и самого комментария по PATH_SEGMENT_LENGTH цифр.
+    # Сортировка по path дает обход дерева в глубину, поддерево - диапазон path.
+    path = models.CharField(max_length=255, default='', editable=False)
+
+    objects = CommentQuerySet.as_manager()
+
+    PATH_SEGMENT_LENGTH = 10
+    # Глубже path не влезет в max_length: 0 - корень, MAX_DEPTH - последний уровень ответов
+    MAX_DEPTH = 255 // PATH_SEGMENT_LENGTH - 1
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', 'is_floating', '-created_at', '-id'], name='idx_comment_post_created'),
+            models.Index(fields=['author', '-created_at', '-id'], name='idx_comment_author_created'),
+            # Лента плавучих комментариев
+            models.Index(
+                fields=['-created_at', '-id'], name='idx_comment_floating_created',
+                condition=models.Q(is_floating=True),
+            ),
+            # Ветки обсуждения: поддерево - один диапазон по path
+            models.Index(fields=['post', 'path'], name='idx_comment_post_path'),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.id: 
@@ -93,8 +258,36 @@ class Comment(models.Model):
             # Устанавливаем expires_at, если он не был установлен ранее
             if self.expires_at is None:
                  self.expires_at = timezone.now() + initial_lifetime
-            
-        super().save(*args, **kwargs)
+
+        if self.path:
+            super().save(*args, **kwargs)
+            return
+
+        # Новый комментарий стоит двух запросов: path строится из id, а id
+        # известен только после INSERT. Оба в одной транзакции, чтобы
+        # комментарий без path не был виден ни в одной ветке
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            parent_path = self.parent_comment.path if self.parent_comment_id else ''
+            self.path = parent_path + self.path_segment(self.pk)
+            Comment.objects.filter(pk=self.pk).update(path=self.path)
+
+    @classmethod
+    def path_segment(cls, pk):
+        return f'{pk:0{cls.PATH_SEGMENT_LENGTH}d}'
+
+    @property
+    def depth(self):
+        """0 - комментарий к посту, 1 - ответ на него и т.д."""
+        return len(self.path) // self.PATH_SEGMENT_LENGTH - 1
+
+    def subtree_path_range(self):
+        """
+        (нижняя, верхняя) граница path потомков, обе не включаются.
+        Путь из одних цифр: все потомки лежат между своим путем и путем следующего соседа.
+        """
+        own = int(self.path[-self.PATH_SEGMENT_LENGTH:])
+        return self.path, self.path[:-self.PATH_SEGMENT_LENGTH] + self.path_segment(own + 1)
         
     def add_echo(self):
         self.echo_count += 1
@@ -135,7 +328,18 @@ class Echo(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        unique_together = ('user', 'content_type', 'object_id')
+        constraints = [
+            # Одна оценка на объект. my_vote для страницы ленты читает is_echo
+            # прямо из этого индекса (INCLUDE есть только в PostgreSQL)
+            models.UniqueConstraint(
+                fields=['user', 'content_type', 'object_id'], include=['is_echo'],
+                name='uniq_echo_user_object',
+            ),
+        ]
+        indexes = [
+            # История оценок пользователя (my/echos/), ключ курсорной пагинации
+            models.Index(fields=['user', '-created_at', '-id'], name='idx_echo_user_created'),
+        ]
         
     def __str__(self):
         type_str = "Echo" if self.is_echo else "DisEcho"
@@ -1,7 +1,27 @@
 from rest_framework import serializers
+from django.conf import settings
+from django.db import models
 from django.contrib.contenttypes.models import ContentType
-from .models import Post, Comment, Echo, PostFile # Added PostFile
-from backend.users_api.serializers import UserSerializer 
+from .models import Post, Comment, Echo, PostFile, Upload
+from backend.users_api.serializers import NestedUserSerializer 
+from . import counters, media, votes
+
+
+def _request_user(context):
+    return getattr(context.get('request'), 'user', None)
+
+
+class FeedListSerializer(serializers.ListSerializer):
+    """
+    Готовит страницу ленты целиком: несброшенные счетчики Echo - одним запросом
+    к Redis, оценки текущего пользователя (my_vote) - одним запросом к Echo.
+    """
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        counters.merge_pending(items)
+        votes.load_my_votes(_request_user(self.context), items)
+        return super().to_representation(items)
+
 
 class ContentObjectSerializer(serializers.Serializer):
     """
@@ -27,7 +47,7 @@ class ContentObjectSerializer(serializers.Serializer):
         return super().to_representation(instance)
 
 class ParentCommentSerializer(serializers.ModelSerializer):
-    author_details = UserSerializer(source='author', read_only=True)
+    author_details = NestedUserSerializer(source='author', read_only=True)
     content = serializers.CharField(source='text', read_only=True)
     
     class Meta:
@@ -36,11 +56,12 @@ class ParentCommentSerializer(serializers.ModelSerializer):
         read_only_fields = fields
         
 class CommentSerializer(serializers.ModelSerializer):
-    author_details = UserSerializer(source='author', read_only=True)
+    author_details = NestedUserSerializer(source='author', read_only=True)
     is_expired = serializers.ReadOnlyField() 
     content = serializers.CharField(source='text') 
     parent_comment_details = ParentCommentSerializer(source='parent_comment', read_only=True)
     parent_comment_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
+    my_vote = serializers.SerializerMethodField()
 
 
     class Meta:
@@ -49,18 +70,28 @@ class CommentSerializer(serializers.ModelSerializer):
             'id', 'content', 'author_details', 
             'created_at', 'expires_at', 'is_expired', 
             'echo_count', 'disecho_count', 'is_floating', 'post', 'author',
-            'parent_comment_details', 'parent_comment_id'
+            'parent_comment_details', 'parent_comment_id', 'my_vote'
         ] 
         read_only_fields = [
             'author', 'post', 'created_at', 'expires_at', 
             'echo_count', 'disecho_count', 'is_floating', 'author_details', 
-            'is_expired', 'parent_comment_details'
+            'is_expired', 'parent_comment_details', 'my_vote'
         ]
         extra_kwargs = {
             'post': {'required': False, 'allow_null': True},
             'text': {'write_only': True}, 
         }
+        list_serializer_class = FeedListSerializer
+
+    def to_representation(self, instance):
+        counters.merge_pending([instance])
+        return super().to_representation(instance)
         
+    def get_my_vote(self, obj):
+        # В списке уже заполнено FeedListSerializer
+        votes.load_my_votes(_request_user(self.context), [obj])
+        return obj.my_vote
+
     def create(self, validated_data):
         parent_comment_id = validated_data.pop('parent_comment_id', None)
         return super().create(validated_data)
@@ -74,46 +105,92 @@ class PostFileSerializer(serializers.ModelSerializer):
         fields = ['id', 'file', 'order']
 
     def get_file(self, obj):
-        if obj.file:
-            return obj.file.url
-        return None
+        # Копия под ширину ленты; до обработки - оригинал
+        return media.variant_url(obj.file, obj.variants, 'feed')
 
 class PostSerializer(serializers.ModelSerializer):
-    author_details = UserSerializer(source='author', read_only=True)
+    author_details = NestedUserSerializer(source='author', read_only=True)
     is_expired = serializers.ReadOnlyField()
     comments_count = serializers.SerializerMethodField()
+    my_vote = serializers.SerializerMethodField()
     files = PostFileSerializer(many=True, read_only=True) # For reading files
     uploaded_files = serializers.ListField(
         child=serializers.FileField(allow_empty_file=False, use_url=False),
         write_only=True,
         required=False
     )
+    # Файлы, заранее загруженные кусками через uploads/ (см. echo_api/uploads.py)
+    upload_ids = serializers.ListField(
+        child=serializers.UUIDField(),
+        write_only=True,
+        required=False
+    )
 
     class Meta:
         model = Post
         fields = [
-            'id', 'author', 'author_details', 'content', 'files', 'uploaded_files',
+            'id', 'author', 'author_details', 'content', 'files', 'uploaded_files', 'upload_ids',
             'created_at', 'expires_at', 'is_expired',
             'echo_count', 'disecho_count', 'comments_count', 'is_floating',
-            'updated_at'
+            'updated_at', 'my_vote'
         ]
         read_only_fields = [
             'author', 'created_at', 'expires_at', 'is_expired',
-            'echo_count', 'disecho_count', 'is_floating', 'updated_at', 'files'
+            'echo_count', 'disecho_count', 'is_floating', 'updated_at', 'files', 'my_vote'
         ]
+        list_serializer_class = FeedListSerializer
+
+    def to_representation(self, instance):
+        counters.merge_pending([instance])
+        return super().to_representation(instance)
 
     def get_comments_count(self, obj):
+        # Аннотация из PostQuerySet.for_feed(); без нее - отдельный запрос
+        count = getattr(obj, 'non_floating_comments_count', None)
+        if count is not None:
+            return count
         return obj.comments.filter(is_floating=False).count()
 
+    def get_my_vote(self, obj):
+        # В списке уже заполнено FeedListSerializer
+        votes.load_my_votes(_request_user(self.context), [obj])
+        return obj.my_vote
+
+    def validate_upload_ids(self, value):
+        uploads = Upload.objects.in_bulk(
+            value, field_name='id'
+        ) if value else {}
+        user = _request_user(self.context)
+        for upload_id in value:
+            upload = uploads.get(upload_id)
+            if upload is None or upload.user_id != getattr(user, 'id', None) or upload.status != Upload.COMPLETE:
+                raise serializers.ValidationError(f"Загрузка {upload_id} не найдена или еще не собрана.")
+        # Порядок файлов в посте - порядок upload_ids
+        return [uploads[upload_id] for upload_id in dict.fromkeys(value)]
+
     def create(self, validated_data):
         uploaded_files = validated_data.pop('uploaded_files', [])
+        uploads = validated_data.pop('upload_ids', [])
         post = Post.objects.create(**validated_data)
         for i, file_data in enumerate(uploaded_files):
             PostFile.objects.create(post=post, file=file_data, order=i)
+        if uploads:
+            # Собранный файл уже лежит в post_files/: переносим только ссылку
+            post_files = PostFile.objects.bulk_create([
+                PostFile(post=post, file=upload.file.name, order=len(uploaded_files) + i)
+                for i, upload in enumerate(uploads)
+            ])
+            # bulk_create не шлет post_save
+            for post_file in post_files:
+                media.schedule(post_file)
+            # Ссылка на файл теперь у PostFile: сессия удаляется без файла
+            sessions = Upload.objects.filter(pk__in=[upload.pk for upload in uploads])
+            sessions.update(file='')
+            sessions.delete()
         return post
 
 class EchoSerializer(serializers.ModelSerializer):
-    user_details = UserSerializer(source='user', read_only=True)
+    user_details = NestedUserSerializer(source='user', read_only=True)
     
     content_object_details = ContentObjectSerializer(source='content_object', read_only=True)
     
@@ -122,8 +199,47 @@ class EchoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Echo
         fields = ['id', 'user', 'user_details', 'is_echo', 'created_at', 
-                  'content_object_details', 'content_type_model']
+                  'object_id', 'content_object_details', 'content_type_model']
         read_only_fields = fields 
 
     def get_content_type_model(self, obj):
-        return obj.content_type.model
\ No newline at end of file
+        # get_for_id берет ContentType из кэша процесса, без запроса на строку
+        return ContentType.objects.get_for_id(obj.content_type_id).model
+
+class VoteResultSerializer(serializers.Serializer):
+    """
+    Ответ на Echo/DisEcho: только поля, которые меняет голос.
+    my_vote - оценка пользователя после нажатия: true (Echo), false (DisEcho) или null.
+    """
+    id = serializers.IntegerField(read_only=True)
+    echo_count = serializers.IntegerField(read_only=True)
+    disecho_count = serializers.IntegerField(read_only=True)
+    expires_at = serializers.DateTimeField(read_only=True)
+    is_expired = serializers.ReadOnlyField()
+    my_vote = serializers.BooleanField(read_only=True, allow_null=True)
+
+
+class EchoOperationSerializer(serializers.Serializer):
+    content_type = serializers.ChoiceField(choices=['post', 'comment'])
+    id = serializers.IntegerField(min_value=1)
+    is_echo = serializers.BooleanField()
+
+
+class EchoBatchSerializer(serializers.Serializer):
+    """Пачка нажатий Echo/DisEcho в порядке, в котором их сделал пользователь."""
+    operations = EchoOperationSerializer(many=True, allow_empty=False, max_length=settings.ECHO_BATCH_MAX_SIZE)
+
+
+class UploadSerializer(serializers.ModelSerializer):
+    chunks_total = serializers.IntegerField(read_only=True)
+    received = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+
+    class Meta:
+        model = Upload
+        fields = ['id', 'filename', 'size', 'chunk_size', 'chunks_total', 'received', 'status', 'created_at']
+        read_only_fields = ['id', 'chunk_size', 'status', 'created_at']
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"Размер файла должен быть от 1 до {settings.UPLOAD_MAX_SIZE} байт.")
+        return value
@@ -0,0 +1,90 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from backend.friends_api.services import friend_graph_changed
+
+from . import feed_cache, media, storage, timelines
+from .models import Comment, Post, PostFile, Upload
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Post)
+def fan_out_new_post(sender, instance, created, **kwargs):
+    """Раскладывает новый пост по таймлайнам друзей после коммита."""
+    if not created:
+        return
+
+    def push():
+        try:
+            timelines.push_post(instance)
+        except timelines.TIMELINE_ERRORS:
+            # Лента друзей переживет: таймлайн пересоберется из базы
+            logger.exception("Не удалось разложить пост %s по таймлайнам", instance.pk)
+
+    transaction.on_commit(push)
+
+
+@receiver(post_save, sender=Post)
+def invalidate_post_feed(sender, instance, created, **kwargs):
+    # Кэш хранит только состав страниц: счетчики и срок жизни читаются живыми.
+    # Удаление не сбрасывает кэш здесь (иначе массовое удаление шло бы по
+    # строке): истечение сбрасывает ленты один раз на пачку, а удаленные
+    # посты выпадают из закэшированных страниц при чтении
+    if created:
+        feed_cache.invalidate(feed_cache.POSTS_FEED)
+
+
+@receiver(post_delete, sender=Post)
+def evict_deleted_post(sender, instance, **kwargs):
+    """Убирает удаленный пост из таймлайнов друзей автора после коммита."""
+    # После delete() у instance уже нет pk
+    post = (instance.pk, instance.author_id)
+
+    def evict():
+        try:
+            timelines.evict_posts([post])
+        except timelines.TIMELINE_ERRORS:
+            # Таймлайн переживет: удаленный id уберет чтение ленты
+            logger.exception("Не удалось убрать пост %s из таймлайнов", post[0])
+
+    transaction.on_commit(evict)
+
+
+@receiver(post_save, sender=Comment)
+def invalidate_floating_feed(sender, instance, created, **kwargs):
+    # Число комментариев поста читается живым; меняется только состав ленты плавучих
+    if created and instance.is_floating:
+        feed_cache.invalidate(feed_cache.FLOATING_FEED)
+
+
+@receiver(post_save, sender=PostFile)
+def process_post_file(sender, instance, update_fields=None, **kwargs):
+    """Новый файл поста: варианты сделает воркер Django-Q."""
+    if update_fields and 'file' not in update_fields:
+        return
+    media.schedule(instance)
+
+
+@receiver(post_delete, sender=PostFile)
+def release_post_file(sender, instance, **kwargs):
+    # В том числе каскадом от удаления истекшего поста
+    storage.release_on_commit([instance.file.name, *media.variant_names(instance.variants)])
+
+
+@receiver(post_delete, sender=Upload)
+def release_upload_file(sender, instance, **kwargs):
+    # Брошенная сессия, удаление пользователя и т.д.; переданный посту файл уже снят с сессии
+    storage.release_on_commit([instance.file.name])
+
+
+@receiver(friend_graph_changed)
+def reset_friend_timelines(sender, user_ids, **kwargs):
+    """Новые или удаленные друзья: таймлайны пересоберутся при следующем чтении."""
+    try:
+        timelines.reset_timelines(user_ids)
+    except timelines.TIMELINE_ERRORS:
+        logger.exception("Не удалось сбросить таймлайны %s", user_ids)
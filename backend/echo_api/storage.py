@@ -0,0 +1,145 @@
+"""
+Хранилище медиа с дедупликацией по содержимому.
+
+Файл при сохранении потоком пишется во временный файл и одновременно
+хэшируется; итоговое имя - sha256 содержимого внутри корневой папки
+upload_to: post_files/ab/ab12...ef.jpg. Одинаковый файл (репост мема,
+повторно загруженный аватар) хранится один раз, а одинаковое содержимое
+получает одинаковый URL, который можно кэшировать навсегда.
+
+Каждая ссылка на файл учитывается в MediaBlob.refcount: save() добавляет
+ссылку, delete() - снимает. Файл удаляется вместе с последней ссылкой.
+Владельцы ссылок (PostFile, аватары, варианты из echo_api/media.py) снимают
+их сигналами после коммита, в том числе при каскадном удалении истекших постов.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from collections import Counter
+
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+# Длина расширения, которое сохраняется в имени блоба
+MAX_EXTENSION_LENGTH = 10
+
+
+def content_name(name, digest):
+    """post_files/<что угодно>/photo.JPG -> post_files/ab/<sha256>.jpg"""
+    name = name.replace('\\', '/')
+    root = name.split('/', 1)[0] if '/' in name else ''
+    extension = os.path.splitext(name)[1].lower()
+    if len(extension) > MAX_EXTENSION_LENGTH or not extension[1:].isalnum():
+        extension = ''
+    return '/'.join(part for part in (root, digest[:2], digest + extension) if part)
+
+
+class DedupStorage(FileSystemStorage):
+    """FileSystemStorage, где имя файла - хэш содержимого, а удаление - снятие ссылки."""
+
+    def _save(self, name, content):
+        from .models import MediaBlob
+
+        directory = self.path('')
+        os.makedirs(directory, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.blob-', delete=False) as tmp:
+            try:
+                for chunk in content.chunks():
+                    sha.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+
+        name = content_name(name, sha.hexdigest())
+        path = self.path(name)
+        try:
+            with transaction.atomic():
+                # Блокировка строки: release() не удалит файл, пока мы кладем ту же копию
+                blob, _ = MediaBlob.objects.select_for_update().get_or_create(
+                    name=name, defaults={'size': size, 'refcount': 0}
+                )
+                if os.path.exists(path):
+                    os.unlink(tmp.name)
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    # Временный файл создается с правами 0600
+                    os.chmod(tmp.name, self.file_permissions_mode or 0o644)
+                    os.replace(tmp.name, path)
+                MediaBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Имя все равно заменит хэш содержимого, а одинаковые файлы и должны совпадать
+        return name
+
+    def delete(self, name):
+        if name:
+            release([name], storage=self)
+
+    def remove_file(self, name):
+        """Удаляет сам файл, минуя учет ссылок."""
+        super().delete(name)
+
+
+def release(names, storage=None):
+    """Снимает по ссылке за каждое имя в names; файлы без ссылок удаляются."""
+    # Модели импортируются лениво: хранилище создается раньше реестра приложений
+    from .models import MediaBlob
+
+    storage = storage or default_storage
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return
+
+    with transaction.atomic():
+        blobs = {
+            blob.name: blob
+            for blob in MediaBlob.objects.select_for_update().filter(name__in=counts).order_by('name')
+        }
+        for name, count in counts.items():
+            blob = blobs.get(name)
+            if blob is None:
+                # Файл загружен до появления учета ссылок - у него одна ссылка
+                storage.remove_file(name)
+            elif blob.refcount > count:
+                MediaBlob.objects.filter(pk=name).update(refcount=F('refcount') - count)
+            else:
+                storage.remove_file(name)
+                blob.delete()
+
+
+def release_on_commit(names, storage=None):
+    """release() после коммита: при откате транзакции ссылки остаются живыми."""
+    names = [name for name in names if name]
+    if names:
+        transaction.on_commit(lambda: release(names, storage=storage))
+
+
+def remember_old_file(instance, field_name, update_fields=None):
+    """pre_save: запоминает прежний файл поля, чтобы снять ссылку на него после замены."""
+    if instance._state.adding or (update_fields and field_name not in update_fields):
+        return
+    old_name = type(instance)._default_manager.filter(pk=instance.pk).values_list(field_name, flat=True).first()
+    # Новый файл еще не сохранен: save() возьмет на него ссылку, даже если
+    # содержимое (а значит, и имя) то же, что у прежнего
+    new_file = getattr(instance, field_name)
+    uploading = bool(new_file) and not new_file._committed
+    setattr(instance, f'_old_{field_name}', (old_name, uploading))
+
+
+def release_replaced_file(instance, field_name):
+    """post_save: снимает ссылку с прежнего файла поля, если его заменили."""
+    old_name, uploading = instance.__dict__.pop(f'_old_{field_name}', (None, False))
+    if old_name and (uploading or old_name != getattr(instance, field_name).name):
+        release_on_commit([old_name])
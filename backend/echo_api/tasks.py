@@ -1,38 +1,183 @@
 # echo_api/tasks.py
 
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
 from django.utils import timezone
 from django.db import transaction
 from .models import Post, Comment
+from . import counters, expiry, feed_cache, timelines, uploads
+
+logger = logging.getLogger(__name__)
 
 # Внимание: Если вы используете Celery, вам нужно добавить:
 # from celery import shared_task
 # и использовать декоратор @shared_task перед функцией.
 # Если вы используете Django-Q, используйте @job.
 
-def check_and_float_expired_posts():
+
+def expire_posts_batch(now, batch_size, post_ids=None):
+    """
+    Убивает одну пачку истекших постов тремя запросами.
+
+    Посты блокируются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому
+    параллельные воркеры разбирают разные пачки и не ждут друг друга.
+    Комментарии открепляются одним UPDATE, посты удаляются одним DELETE.
+
+    Возвращает (список пар (post_id, author_id), число спасенных комментариев).
+    """
+    with transaction.atomic():
+        expired = Post.objects.select_for_update(skip_locked=True).filter(expires_at__lte=now)
+        if post_ids is not None:
+            expired = expired.filter(id__in=post_ids)
+        rows = list(expired.order_by('expires_at').values_list('id', 'author_id')[:batch_size])
+        if not rows:
+            return [], 0
+
+        ids = [post_id for post_id, _ in rows]
+        floated = Comment.objects.filter(post_id__in=ids).update(is_floating=True, post=None)
+        Post.objects.filter(id__in=ids).delete()
+
+    feed_cache.invalidate(feed_cache.POSTS_FEED, feed_cache.FLOATING_FEED)
+
+    # Убираем истекшие посты из таймлайнов ленты друзей
+    try:
+        timelines.evict_posts(rows)
+    except timelines.TIMELINE_ERRORS:
+        logger.exception("Не удалось очистить таймлайны для %s постов", len(rows))
+
+    return rows, floated
+
+
+def check_and_float_expired_posts(batch_size=None):
     """
-    Регулярная задача: Находит все посты, у которых истек срок жизни, и 
+    Регулярная задача: Находит все посты, у которых истек срок жизни, и
     переводит их комментарии в 'плавучий' режим, удаляя родительский пост.
-    
-    Эту функцию нужно настроить на выполнение каждые 15-60 минут 
-    с помощью Celery Beat, Django-Q Scheduler или Cron Job.
+
+    Работает пачками по POST_EXPIRY_BATCH_SIZE постов; перед каждой пачкой
+    сбрасывает ее счетчики Echo (голоса в пути могли продлить пост).
+    Останавливается по истечении POST_EXPIRY_TIME_BUDGET секунд, чтобы
+    уложиться в таймаут Django-Q; остаток доберет следующий запуск.
+    Возвращает метрики прохода.
     """
-    
+    batch_size = batch_size or settings.POST_EXPIRY_BATCH_SIZE
+    started = time.monotonic()
     now = timezone.now()
-    # Ищем посты, у которых истек срок (expires_at <= now)
-    expired_posts = Post.objects.filter(expires_at__lte=now)
-    
-    processed_count = 0
-    
-    for post in expired_posts:
-        # Используем транзакцию, чтобы гарантировать: либо все комментарии спасены 
-        # и пост удален, либо ничего не происходит (в случае ошибки).
-        with transaction.atomic():
-            comments_count = post.kill_and_float_comments()
-            
-            # Логирование для отладки
-            print(f"Пост ID {post.id} убит. Переведено в 'плавание': {comments_count} комментариев.")
-            
-            processed_count += 1
-            
-    return f"Завершена проверка. Обработано {processed_count} постов."
\ No newline at end of file
+
+    metrics = {'batches': 0, 'posts': 0, 'comments_floated': 0, 'duration_ms': 0}
+
+    # Посты, которые не убиты: заняты другим воркером или продлены голосами
+    skipped = set()
+    flush_counters = True
+    while time.monotonic() - started < settings.POST_EXPIRY_TIME_BUDGET:
+        batch_started = time.monotonic()
+        candidates = list(
+            Post.objects.filter(expires_at__lte=now).exclude(id__in=skipped)
+            .order_by('expires_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not candidates:
+            break
+        if flush_counters:
+            # Несброшенные голоса могли продлить жизнь постов пачки, как в float_due_posts
+            try:
+                counters.flush(objects=[('post', post_id) for post_id in candidates])
+            except counters.COUNTER_ERRORS:
+                logger.warning("Счетчики Echo не сброшены перед проверкой: Redis недоступен")
+                flush_counters = False
+        rows, floated = expire_posts_batch(now, batch_size, post_ids=candidates)
+        skipped.update(set(candidates) - {post_id for post_id, _ in rows})
+        if not rows:
+            continue
+
+        metrics['batches'] += 1
+        metrics['posts'] += len(rows)
+        metrics['comments_floated'] += floated
+        logger.debug(
+            "Пачка истекших постов: posts=%s comments_floated=%s duration_ms=%.1f",
+            len(rows), floated, (time.monotonic() - batch_started) * 1000,
+        )
+
+    metrics['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+    logger.info(
+        "Проверка истекших постов: batches=%(batches)s posts=%(posts)s "
+        "comments_floated=%(comments_floated)s duration_ms=%(duration_ms)s",
+        metrics, extra={'metrics': metrics},
+    )
+    return metrics
+
+
+def float_due_posts(limit=None):
+    """
+    Один шаг воркера post_expiry_worker: забирает созревшие посты из
+    расписания в Redis и убивает их без сканирования таблицы Post.
+
+    Каждый забранный, но не убитый пост возвращается в расписание:
+    продленный (в базе expires_at > now) - на новое время, а занятый другим
+    воркером или не убитый из-за ошибки - через POST_EXPIRY_RETRY_DELAY
+    секунд. Возвращает число убитых постов.
+    """
+    limit = limit or settings.POST_EXPIRY_BATCH_SIZE
+    now = timezone.now()
+    due_ids = expiry.pop_due_posts(now, limit)
+    if not due_ids:
+        return 0
+
+    retry_at = now + timedelta(seconds=settings.POST_EXPIRY_RETRY_DELAY)
+    started = time.monotonic()
+    try:
+        # Несброшенные голоса могли продлить жизнь поста - сначала сворачиваем их
+        counters.flush(objects=[('post', post_id) for post_id in due_ids])
+        rows, floated = expire_posts_batch(now, len(due_ids), post_ids=due_ids)
+    except Exception:
+        expiry.schedule_posts(dict.fromkeys(due_ids, retry_at))
+        raise
+
+    expired_ids = {post_id for post_id, _ in rows}
+    # Удаленные за это время посты в расписание не возвращаются
+    left = dict(Post.objects.filter(id__in=set(due_ids) - expired_ids).values_list('id', 'expires_at'))
+    expiry.schedule_posts({
+        post_id: expires_at if expires_at > now else retry_at
+        for post_id, expires_at in left.items()
+    })
+
+    if rows:
+        logger.info(
+            "Истекшие посты по расписанию: posts=%s comments_floated=%s rescheduled=%s duration_ms=%.1f",
+            len(rows), floated, len(left), (time.monotonic() - started) * 1000,
+        )
+    return len(rows)
+
+
+def flush_echo_counters():
+    """Сворачивает накопленные в Redis счетчики Echo/DisEcho в базу."""
+    flushed = counters.flush()
+    if flushed:
+        logger.debug("Сброшены счетчики Echo: objects=%s", flushed)
+    return flushed
+
+
+def cleanup_echo_claims():
+    """Удаляет старые записи о примененных заявках сброса счетчиков."""
+    return counters.cleanup()
+
+
+def rebuild_expiry_schedule(chunk_size=5000):
+    """Заполняет расписание истечения всеми живыми постами (первый запуск, потеря Redis)."""
+    expirations = {}
+    total = 0
+    for post_id, expires_at in Post.objects.values_list('id', 'expires_at').iterator(chunk_size=chunk_size):
+        expirations[post_id] = expires_at
+        if len(expirations) >= chunk_size:
+            expiry.schedule_posts(expirations)
+            total += len(expirations)
+            expirations = {}
+    expiry.schedule_posts(expirations)
+    return total + len(expirations)
+
+
+def cleanup_uploads():
+    """Удаляет брошенные сессии докачиваемой загрузки и ничейные куски."""
+    sessions, chunks = uploads.cleanup()
+    return {'sessions': sessions, 'chunks': chunks}
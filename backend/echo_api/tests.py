@@ -0,0 +1,1031 @@
+import hashlib
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_redis import get_redis_connection
+from PIL import Image
+from redis.exceptions import RedisError
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backend.config.media_server import MediaServer
+from backend.friends_api.models import Friend
+from backend.friends_api.services import get_friend_ids
+from backend.messenger_api.models import Chat
+from backend.users_api.models import CustomUser
+from backend.users_api.serializers import NestedUserSerializer, UserSerializer
+
+from .models import Comment, CounterClaim, Echo, MediaBlob, Post, PostFile, Upload
+from . import counters, expiry, feed_cache, media, tasks, timelines, uploads, votes
+from .management.commands import post_expiry_worker
+from .pagination import KeysetPagination
+
+
+class QueryBudgetMixin:
+    """
+    assertQueryBudget: эндпоинт должен укладываться в фиксированное число SQL-запросов.
+
+    Бюджет не зависит от размера страницы, поэтому новое поле сериализатора,
+    которое ходит в базу на каждую строку (N+1), сразу уронит тест.
+    """
+
+    def assertQueryBudget(self, url, budget, method='get', **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400, response.content)
+        queries = '\n'.join(q['sql'] for q in ctx.captured_queries)
+        self.assertLessEqual(
+            len(ctx), budget,
+            f'{url}: {len(ctx)} запросов при бюджете {budget}:\n{queries}'
+        )
+        return response
+
+
+class RedisTestMixin:
+    """Тесты кода, который работает с Redis напрямую; без Redis - пропускаются."""
+    redis_patterns = ()
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.redis = get_redis_connection('default')
+            self.redis.ping()
+        except (NotImplementedError, RedisError):
+            self.skipTest('Нужен Redis (django-redis в CACHES)')
+        self.addCleanup(self.clear_redis)
+        self.clear_redis()
+
+    def clear_redis(self):
+        for pattern in self.redis_patterns:
+            keys = list(self.redis.scan_iter(pattern))
+            if keys:
+                self.redis.delete(*keys)
+
+
+class FeedQueryBudgetTests(QueryBudgetMixin, TestCase):
+    # Больше, чем любой бюджет: N+1 на странице сразу будет виден
+    ROWS = 25
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='reader')
+        cls.author = CustomUser.objects.create(username='author')
+
+        for i in range(cls.ROWS):
+            post = Post.objects.create(author=cls.author, content=f'post {i}')
+            PostFile.objects.create(post=post, file=f'post_files/{i}.png', order=0)
+            parent = Comment.objects.create(post=post, author=cls.author, text='parent')
+            reply = Comment.objects.create(post=post, author=cls.user, text='reply', parent_comment=parent)
+            Comment.objects.create(
+                post=None, author=cls.author, text='floating', is_floating=True,
+                expires_at=timezone.now() + timedelta(hours=1),
+            )
+        cls.post = post
+        cls.floating = Comment.objects.filter(is_floating=True).first()
+        # Оценки читателя для my_vote
+        Echo.objects.create(user=cls.user, content_object=post, is_echo=True)
+        Echo.objects.create(user=cls.user, content_object=reply, is_echo=False)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_post_feeds(self):
+        # Посты + prefetch файлов + оценки читателя (my_vote)
+        response = self.assertQueryBudget('/echo_api/feed/posts/', 3)
+        results = response.data['results']
+        self.assertEqual(results[0]['comments_count'], 2)
+        self.assertEqual((results[0]['my_vote'], results[1]['my_vote']), (True, None))
+        self.assertQueryBudget('/echo_api/feed/friends/', 3)
+        self.assertQueryBudget(f'/echo_api/users/{self.author.id}/posts/', 3)
+        response = self.assertQueryBudget(f'/echo_api/posts/{self.post.id}/', 3)
+        self.assertIs(response.data['my_vote'], True)
+
+    def test_my_posts(self):
+        self.client.force_authenticate(self.author)
+        self.assertQueryBudget('/echo_api/my/posts/', 3)
+
+    def test_cached_feeds(self):
+        self.assertQueryBudget('/echo_api/feed/posts/', 3)
+        # Страница из кэша: живые счетчики одним запросом, my_vote - свой у каждого пользователя
+        response = self.assertQueryBudget('/echo_api/feed/posts/', 2)
+        self.assertIs(response.data['results'][0]['my_vote'], True)
+        self.client.force_authenticate(self.author)
+        response = self.assertQueryBudget('/echo_api/feed/posts/', 2)
+        self.assertIsNone(response.data['results'][0]['my_vote'])
+
+        # Голос и комментарий не сбрасывают страницу, но видны сразу
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/echo_api/posts/{self.post.id}/disecho/')
+            Comment.objects.create(post=self.post, author=self.author, text='new')
+        response = self.assertQueryBudget('/echo_api/feed/posts/', 2)
+        first = response.data['results'][0]
+        self.assertEqual((first['disecho_count'], first['comments_count']), (1, 3))
+
+        # Новый пост меняет состав ленты
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(author=self.author, content='new')
+        response = self.assertQueryBudget('/echo_api/feed/posts/', 3)
+        self.assertEqual(response.data['results'][0]['id'], post.id)
+
+        self.assertQueryBudget('/echo_api/feed/floating/', 2)
+        self.assertQueryBudget('/echo_api/feed/floating/', 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.floating.delete()
+        # Удаленный комментарий выпадает из закэшированной страницы
+        response = self.assertQueryBudget('/echo_api/feed/floating/', 2)
+        self.assertNotIn(self.floating.id, [c['id'] for c in response.data['results']])
+
+    @override_settings(ALLOWED_HOSTS=['*'])
+    def test_cached_page_is_not_bound_to_the_first_reader(self):
+        self.client.get('/echo_api/feed/posts/?page_size=1', HTTP_HOST='first.example')
+        request = Request(APIRequestFactory().get('/echo_api/feed/posts/', {'page_size': 1}))
+        stored = cache.get(feed_cache._page_key(feed_cache.POSTS_FEED, request))
+        self.assertNotIn('my_vote', stored['results'][0])
+        self.assertNotIn('first.example', stored['next'])
+
+        response = self.client.get('/echo_api/feed/posts/?page_size=1', HTTP_HOST='second.example')
+        self.assertTrue(response.data['next'].startswith('http://second.example/echo_api/feed/posts/?'))
+        self.assertIs(response.data['results'][0]['my_vote'], True)
+
+    def test_my_echos(self):
+        for comment in Comment.objects.filter(is_floating=True):
+            Echo.objects.create(user=self.user, content_object=comment, is_echo=True)
+        # Оценки + посты + комментарии, сколько бы оценок ни было
+        response = self.assertQueryBudget('/echo_api/my/echos/', 3)
+        results = response.data['results']
+        self.assertEqual(len(results), 20)
+        self.assertEqual(results[0]['content_type_model'], 'comment')
+        self.assertEqual(results[0]['content_object_details']['type'], 'comment')
+
+    def test_comment_feeds(self):
+        self.assertQueryBudget('/echo_api/feed/floating/', 2)
+        response = self.assertQueryBudget(f'/echo_api/posts/{self.post.id}/comments/', 2)
+        self.assertEqual(sorted(c['my_vote'] for c in response.data['results'] if c['my_vote'] is not None), [False])
+        self.assertQueryBudget('/echo_api/my/comments/active/', 2)
+        self.assertQueryBudget(f'/echo_api/users/{self.author.id}/comments/active/', 2)
+
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = CustomUser.objects.create(username='author')
+        now = timezone.now()
+        cls.posts = [Post.objects.create(author=author, content=str(i)) for i in range(7)]
+        # Три поста с одинаковым created_at: порядок внутри - по id
+        for index, post in enumerate(cls.posts):
+            created_at = now if index in (2, 3, 4) else now + timedelta(seconds=index)
+            Post.objects.filter(pk=post.pk).update(created_at=created_at)
+        cls.expected = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def paginate(self, url):
+        paginator = KeysetPagination()
+        request = Request(APIRequestFactory().get(url))
+        page = paginator.paginate_queryset(Post.objects.all(), request)
+        return [post.id for post in page], paginator.get_next_link(), paginator.get_previous_link()
+
+    def test_round_trip(self):
+        seen, url = [], '/feed/?page_size=2'
+        while url:
+            ids, url, _ = self.paginate(url)
+            seen += ids
+        # Ни пропусков, ни повторов, в том числе на одинаковом created_at
+        self.assertEqual(seen, self.expected)
+
+    def test_reverse(self):
+        _, second, _ = self.paginate('/feed/?page_size=3')
+        ids, _, previous = self.paginate(second)
+        self.assertEqual(ids, self.expected[3:6])
+        ids, _, first_previous = self.paginate(previous)
+        self.assertEqual(ids, self.expected[:3])
+        self.assertIsNone(first_previous)
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'eyJ2IjogMX0=', '%%%'):
+            with self.assertRaises(NotFound):
+                self.paginate(f'/feed/?cursor={cursor}')
+
+
+
+class FriendTimelineTests(RedisTestMixin, TestCase):
+    redis_patterns = ('timeline:*',)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = CustomUser.objects.create(username='reader')
+        cls.author = CustomUser.objects.create(username='author')
+        Friend.objects.create(sender=cls.reader, receiver=cls.author, status='accepted')
+        cls.posts = [Post.objects.create(author=cls.author, content=str(i)) for i in range(5)]
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def test_pages_read_a_slice_of_the_timeline(self):
+        friend_ids = get_friend_ids(self.reader.id)
+        post_ids, _, _ = timelines.get_timeline(self.reader.id, friend_ids, None, 3)
+        self.assertEqual(post_ids, [post.id for post in reversed(self.posts)][:3])
+
+        seen, url = [], '/echo_api/feed/friends/?page_size=2'
+        while url:
+            data = self.client.get(url).data
+            seen += [post['id'] for post in data['results']]
+            url = data['next']
+        self.assertEqual(seen, [post.id for post in reversed(self.posts)])
+
+    def read_feed(self, page_size):
+        seen, url = [], f'/echo_api/feed/friends/?page_size={page_size}'
+        while url:
+            data = self.client.get(url).data
+            self.assertTrue(data['results'] or not data['next'])
+            seen += [post['id'] for post in data['results']]
+            url = data['next']
+        return seen
+
+    def test_dead_posts_do_not_end_the_feed(self):
+        timelines.rebuild_timeline(self.reader.id, {self.author.id})
+        newest = self.posts[2:]
+        # Истекшие еще лежат в таймлайне, удаленный выпал бы без сигнала
+        Post.objects.filter(pk__in=[post.pk for post in newest]).update(
+            expires_at=timezone.now() - timedelta(minutes=1),
+        )
+        deleted_id = self.posts[1].pk
+        with self.captureOnCommitCallbacks(execute=True), mock.patch.object(timelines, 'evict_posts'):
+            self.posts[1].delete()
+        self.assertEqual(self.read_feed(1), [self.posts[0].id])
+        # Удаленный id убран из таймлайна при чтении
+        self.assertIsNone(self.redis.zscore(timelines._timeline_key(self.reader.id), deleted_id))
+
+    @override_settings(FRIEND_FEED_TIMELINE_SIZE=2)
+    def test_posts_past_the_timeline_are_read_from_the_database(self):
+        timelines.rebuild_timeline(self.reader.id, {self.author.id})
+        self.assertEqual(self.read_feed(2), [post.id for post in reversed(self.posts)])
+
+    def test_deleted_post_is_evicted(self):
+        timelines.rebuild_timeline(self.reader.id, {self.author.id})
+        key = timelines._timeline_key(self.reader.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(author=self.author, content='x')
+        post_id = post.pk
+        self.assertIsNotNone(self.redis.zscore(key, post_id))
+        with self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+        self.assertIsNone(self.redis.zscore(key, post_id))
+
+    def test_evict_reads_friends_once_per_author(self):
+        timelines.rebuild_timeline(self.reader.id, {self.author.id})
+        with mock.patch.object(timelines, 'get_friend_ids', wraps=get_friend_ids) as friends:
+            timelines.evict_posts([(post.id, self.author.id) for post in self.posts[:3]])
+        self.assertEqual(friends.call_count, 1)
+        post_ids, _, _ = timelines.get_timeline(self.reader.id, {self.author.id}, None, 10)
+        self.assertEqual(post_ids, [self.posts[4].id, self.posts[3].id])
+
+    def test_friend_graph_is_reset_after_commit(self):
+        stranger = CustomUser.objects.create(username='stranger')
+        self.assertEqual(get_friend_ids(stranger.id), set())
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Friend.objects.create(sender=stranger, receiver=self.reader, status='accepted')
+            # До коммита кэш не трогаем: чтение не закэширует незакоммиченный граф
+            self.assertEqual(cache.get(f'friends:ids:{stranger.id}'), set())
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(get_friend_ids(stranger.id), {self.reader.id})
+
+
+def create_expired_posts(author, count):
+    """count истекших постов, у каждого по комментарию."""
+    posts = [Post.objects.create(author=author, content=str(i)) for i in range(count)]
+    for post in posts:
+        Comment.objects.create(post=post, author=author, text='comment')
+    Post.objects.filter(pk__in=[post.pk for post in posts]).update(
+        expires_at=timezone.now() - timedelta(minutes=1),
+    )
+    return posts
+
+
+class ExpirePostsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = CustomUser.objects.create(username='author')
+        cls.alive = Post.objects.create(author=cls.author, content='alive')
+        cls.expired = create_expired_posts(cls.author, 5)
+
+    def test_batches(self):
+        metrics = tasks.check_and_float_expired_posts(batch_size=2)
+        self.assertEqual(
+            (metrics['batches'], metrics['posts'], metrics['comments_floated']), (3, 5, 5),
+        )
+        self.assertEqual(list(Post.objects.values_list('id', flat=True)), [self.alive.id])
+        self.assertEqual(Comment.objects.filter(is_floating=True, post=None).count(), 5)
+
+    def test_batch_cost_does_not_depend_on_size(self):
+        now = timezone.now()
+        # Прогрев: граф друзей автора для очистки таймлайнов уже в кэше
+        tasks.expire_posts_batch(now, 1)
+        with CaptureQueriesContext(connection) as single:
+            rows, _ = tasks.expire_posts_batch(now, 1)
+        with CaptureQueriesContext(connection) as bulk:
+            more, floated = tasks.expire_posts_batch(now, 3)
+        self.assertEqual((len(rows), len(more), floated), (1, 3, 3))
+        self.assertEqual(len(bulk), len(single))
+
+    def test_time_budget(self):
+        expire_batch, done = tasks.expire_posts_batch, []
+
+        def batch(*args, **kwargs):
+            done.append(1)
+            return expire_batch(*args, **kwargs)
+
+        # Часы идут только пачками: после первой пачки бюджет исчерпан
+        with override_settings(POST_EXPIRY_TIME_BUDGET=60), \
+                mock.patch.object(tasks.time, 'monotonic', side_effect=lambda: len(done) * 100), \
+                mock.patch.object(tasks, 'expire_posts_batch', side_effect=batch):
+            metrics = tasks.check_and_float_expired_posts(batch_size=2)
+        self.assertEqual((metrics['batches'], metrics['posts']), (1, 2))
+        self.assertEqual(Post.objects.count(), 4)
+
+
+@skipUnless(connection.features.has_select_for_update_skip_locked, 'Нужен SELECT ... SKIP LOCKED')
+class ExpirePostsSkipLockedTests(TransactionTestCase):
+    def test_locked_posts_are_skipped(self):
+        author = CustomUser.objects.create(username='author')
+        locked, *others = create_expired_posts(author, 3)
+        acquired, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            # Параллельный воркер, который уже разбирает пачку с этим постом
+            try:
+                with transaction.atomic():
+                    list(Post.objects.select_for_update().filter(pk=locked.pk))
+                    acquired.set()
+                    release.wait(10)
+            finally:
+                connections.close_all()
+
+        worker = threading.Thread(target=hold_lock)
+        worker.start()
+        try:
+            self.assertTrue(acquired.wait(10))
+            rows, floated = tasks.expire_posts_batch(timezone.now(), 10)
+        finally:
+            release.set()
+            worker.join()
+
+        self.assertEqual(sorted(post_id for post_id, _ in rows), [post.id for post in others])
+        self.assertEqual(floated, 2)
+        self.assertEqual(list(Post.objects.values_list('id', flat=True)), [locked.id])
+
+
+class ExpiryScheduleTests(RedisTestMixin, TestCase):
+    redis_patterns = (expiry.EXPIRY_KEY, 'echo:*')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = CustomUser.objects.create(username='author')
+        cls.expired = create_expired_posts(cls.author, 2)
+        cls.prolonged = Post.objects.create(author=cls.author, content='prolonged')
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        # Все посты созрели по расписанию, но prolonged в базе уже продлен
+        expiry.schedule_posts(dict.fromkeys(
+            [post.id for post in self.expired] + [self.prolonged.id, 999999], self.now - timedelta(seconds=1),
+        ))
+
+    def schedule(self):
+        return {int(member): score for member, score in self.redis.zrange(expiry.EXPIRY_KEY, 0, -1, withscores=True)}
+
+    def test_pop_due_posts(self):
+        expiry.schedule_post(self.prolonged.id, self.prolonged.expires_at)
+        self.assertEqual(expiry.next_due_at(), (self.now - timedelta(seconds=1)).timestamp())
+        self.assertCountEqual(expiry.pop_due_posts(self.now, 10), [post.id for post in self.expired] + [999999])
+        self.assertEqual(expiry.pop_due_posts(self.now, 10), [])
+        self.assertEqual(list(self.schedule()), [self.prolonged.id])
+
+    def test_float_due_posts(self):
+        self.assertEqual(tasks.float_due_posts(), 2)
+        self.assertEqual(Comment.objects.filter(is_floating=True).count(), 2)
+        # Продленный пост - на новое время, удаленный - выпал из расписания
+        self.assertEqual(self.schedule(), {self.prolonged.id: self.prolonged.expires_at.timestamp()})
+
+    @override_settings(POST_EXPIRY_RETRY_DELAY=30)
+    def test_skipped_posts_are_retried(self):
+        # Посты заняты другим воркером (SKIP LOCKED)
+        with mock.patch.object(tasks, 'expire_posts_batch', return_value=([], 0)):
+            self.assertEqual(tasks.float_due_posts(), 0)
+        schedule = self.schedule()
+        self.assertEqual(set(schedule), {post.id for post in self.expired} | {self.prolonged.id})
+        for post in self.expired:
+            self.assertGreaterEqual(schedule[post.id], (self.now + timedelta(seconds=30)).timestamp())
+
+    def test_failed_batch_is_retried(self):
+        with mock.patch.object(tasks, 'expire_posts_batch', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                tasks.float_due_posts()
+        self.assertEqual(len(self.schedule()), 4)
+        self.assertGreater(min(self.schedule().values()), self.now.timestamp())
+
+    def test_worker_step(self):
+        worker = post_expiry_worker.Command()
+        self.assertEqual(worker.step(), 0)
+        self.assertEqual(Post.objects.count(), 1)
+        # Работы не осталось: пауза до продленного поста, но не дольше опроса
+        with override_settings(POST_EXPIRY_POLL_INTERVAL=0.5):
+            self.assertEqual(worker.step(), 0.5)
+
+
+class ExpiryWorkerTests(TestCase):
+    def test_worker_survives_errors(self):
+        worker = post_expiry_worker.Command(stdout=StringIO(), stderr=StringIO())
+        failures = [DatabaseError('база недоступна'), ValueError('сбой'), SystemExit]
+        with mock.patch.object(worker, 'step', side_effect=failures) as step, \
+                mock.patch.object(post_expiry_worker.time, 'sleep') as sleep, \
+                self.assertLogs('backend.echo_api.management.commands.post_expiry_worker', 'ERROR'):
+            with self.assertRaises(SystemExit):
+                worker.handle(rebuild=False)
+        self.assertEqual(step.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertIn('база недоступна', worker.stderr._out.getvalue())
+
+
+class EchoCounterTests(RedisTestMixin, TestCase):
+    redis_patterns = ('echo:*', expiry.EXPIRY_KEY)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = CustomUser.objects.create(username='author')
+        cls.post = Post.objects.create(author=cls.author, content='post')
+
+    def setUp(self):
+        super().setUp()
+        counters.add_delta(self.post, 2, 1, 3600)
+
+    def read(self):
+        post = Post.objects.get(pk=self.post.pk)
+        stored = (post.echo_count, post.disecho_count)
+        counters.merge_pending([post])
+        return stored, (post.echo_count, post.disecho_count)
+
+    def test_flush(self):
+        self.assertEqual(self.read(), ((0, 0), (2, 1)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(counters.flush(), 1)
+        self.assertEqual(self.read(), ((2, 1), (2, 1)))
+        self.assertEqual(Post.objects.get(pk=self.post.pk).expires_at, self.post.expires_at + timedelta(hours=1))
+        self.assertEqual(list(self.redis.scan_iter('echo:*')), [])
+        self.assertEqual(counters.flush(), 0)
+
+    def test_claim_is_applied_once(self):
+        # Сброс закоммичен, но заявки из Redis не удалены (упал до удаления)
+        with self.captureOnCommitCallbacks(execute=False):
+            counters.flush()
+        counters.add_delta(self.post, 1, 0, 0)
+        self.assertEqual(self.read(), ((2, 1), (3, 1)))
+
+        with override_settings(ECHO_FLUSH_RETRY_AFTER=0), self.captureOnCommitCallbacks(execute=True):
+            counters.flush()
+        self.assertEqual(self.read(), ((3, 1), (3, 1)))
+        self.assertEqual(list(self.redis.scan_iter('echo:*')), [])
+
+    def test_failed_flush_is_retried(self):
+        with mock.patch.object(counters, 'apply_deltas', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                counters.flush()
+        self.assertEqual(self.read(), ((0, 0), (2, 1)))
+
+        # Свежую заявку чужого сброса общий сброс не трогает, сброс объекта - забирает
+        self.assertEqual(counters.flush(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(counters.flush(objects=[('post', self.post.pk)]), 1)
+        self.assertEqual(self.read(), ((2, 1), (2, 1)))
+
+    def test_cleanup(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.flush()
+        CounterClaim.objects.update(applied_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(counters.cleanup(), 1)
+
+    def test_pending_votes_save_an_expiring_post(self):
+        # Срок уже вышел, но голоса в пути продлевают пост на час
+        Post.objects.filter(pk=self.post.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        (doomed,) = create_expired_posts(self.author, 1)
+        # Грязных объектов больше, чем влезает в один общий сброс
+        for post in create_expired_posts(self.author, 3):
+            counters.add_delta(post, 0, 1, 0)
+        with override_settings(ECHO_FLUSH_BATCH_SIZE=1), self.captureOnCommitCallbacks(execute=True):
+            metrics = tasks.check_and_float_expired_posts(batch_size=2)
+        self.assertEqual(metrics['posts'], 4)
+        self.assertFalse(Post.objects.filter(pk=doomed.pk).exists())
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual((post.echo_count, post.disecho_count), (2, 1))
+        self.assertGreater(post.expires_at, timezone.now())
+
+
+class EchoCounterConcurrencyTests(RedisTestMixin, TransactionTestCase):
+    redis_patterns = ('echo:*', expiry.EXPIRY_KEY)
+
+    def test_concurrent_votes_and_flushes_add_up(self):
+        post = Post.objects.create(author=CustomUser.objects.create(username='author'), content='post')
+        votes_per_thread, threads_count = 50, 4
+        stop = threading.Event()
+
+        def vote():
+            for _ in range(votes_per_thread):
+                counters.add_delta(post, 1, 0, 0)
+
+        def flush():
+            # Сбросы идут одновременно с голосами и друг с другом
+            try:
+                while not stop.is_set():
+                    counters.flush()
+                    counters.flush(objects=[('post', post.pk)])
+            finally:
+                connections.close_all()
+
+        voters = [threading.Thread(target=vote) for _ in range(threads_count)]
+        flushers = [threading.Thread(target=flush) for _ in range(2)]
+        for thread in voters + flushers:
+            thread.start()
+        for thread in voters:
+            thread.join()
+        stop.set()
+        for thread in flushers:
+            thread.join()
+
+        with override_settings(ECHO_FLUSH_RETRY_AFTER=0):
+            while counters.flush():
+                pass
+        post.refresh_from_db()
+        self.assertEqual(post.echo_count, votes_per_thread * threads_count)
+        self.assertEqual(list(self.redis.scan_iter('echo:pending:*')), [])
+
+
+class EchoToggleCases(QueryBudgetMixin):
+    VOTE_BUDGET = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='voter')
+        cls.post = Post.objects.create(author=cls.user, content='post')
+
+    def setUp(self):
+        # ContentType уже в кэше процесса: бюджет не зависит от порядка тестов
+        ContentType.objects.clear_cache()
+        ContentType.objects.get_for_models(Post, Comment)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def vote(self, action):
+        return self.assertQueryBudget(f'/echo_api/posts/{self.post.id}/{action}/', self.VOTE_BUDGET, method='post').data
+
+    def test_toggle_cycle(self):
+        expires_at = self.post.expires_at
+
+        data = self.vote('echo')
+        self.assertEqual((data['echo_count'], data['disecho_count'], data['my_vote']), (1, 0, True))
+        self.assertNotIn('content', data)
+
+        data = self.vote('disecho')
+        self.assertEqual((data['echo_count'], data['disecho_count'], data['my_vote']), (0, 1, False))
+        self.assertFalse(Echo.objects.get(user=self.user).is_echo)
+
+        data = self.vote('disecho')
+        self.assertEqual((data['echo_count'], data['disecho_count'], data['my_vote']), (0, 0, None))
+        self.assertFalse(Echo.objects.exists())
+
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.echo_count, self.post.disecho_count), (0, 0))
+        self.assertEqual(self.post.expires_at, expires_at)
+
+    def test_rejected(self):
+        Post.objects.filter(pk=self.post.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        response = self.client.post(f'/echo_api/posts/{self.post.id}/echo/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/echo_api/posts/0/echo/').status_code, 404)
+        self.assertFalse(Echo.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Голос одним запросом - только PostgreSQL')
+@override_settings(ECHO_WRITE_BEHIND=False)
+class EchoToggleTests(EchoToggleCases, TestCase):
+    # Голос - один запрос (echo_api/votes.py)
+    VOTE_BUDGET = 1
+
+
+@override_settings(ECHO_WRITE_BEHIND=False)
+class EchoToggleOrmTests(EchoToggleCases, TestCase):
+    # Объект, блокировка оценки, ее запись, счетчики, перечитывание + SAVEPOINT
+    VOTE_BUDGET = 7
+
+    def setUp(self):
+        super().setUp()
+        # Запасной путь для остальных баз - и на PostgreSQL
+        patcher = mock.patch.object(votes, '_toggle_sql', side_effect=votes._toggle_orm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@override_settings(ECHO_WRITE_BEHIND=False)
+class EchoBatchTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='voter')
+        cls.posts = [Post.objects.create(author=cls.user, content=f'post {i}') for i in range(10)]
+        cls.comments = [Comment.objects.create(post=post, author=cls.user, text='comment') for post in cls.posts]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_batch(self):
+        first, second = self.posts[0], self.posts[1]
+        Echo.objects.create(user=self.user, content_object=second, is_echo=False)
+        Post.objects.filter(pk=second.pk).update(disecho_count=1)
+
+        operations = [{'content_type': 'post', 'id': post.id, 'is_echo': True} for post in self.posts]
+        operations += [{'content_type': 'comment', 'id': comment.id, 'is_echo': False} for comment in self.comments]
+        operations += [
+            # Второе нажатие внутри пачки отменяет первое
+            {'content_type': 'post', 'id': first.id, 'is_echo': True},
+            {'content_type': 'post', 'id': 10 ** 6, 'is_echo': True},
+        ]
+        # Число запросов не зависит от размера пачки
+        response = self.assertQueryBudget(
+            '/echo_api/echos/batch/', 14, method='post', data={'operations': operations}, format='json'
+        )
+        results = response.data['results']
+        self.assertEqual(len(results), len(operations))
+        self.assertEqual(results[0]['my_vote'], True)
+        self.assertEqual((results[1]['echo_count'], results[1]['disecho_count']), (1, 0))
+        self.assertEqual((results[-2]['my_vote'], results[-2]['echo_count']), (None, 0))
+        self.assertEqual(results[-1]['status'], 'not_found')
+
+        self.assertEqual(Echo.objects.filter(user=self.user, is_echo=True).count(), 9)
+        self.assertEqual(Echo.objects.filter(user=self.user, is_echo=False).count(), 10)
+        second.refresh_from_db()
+        self.assertEqual((second.echo_count, second.disecho_count), (1, 0))
+        self.assertEqual(Comment.objects.filter(disecho_count=1).count(), 10)
+
+    @skipUnless(connection.features.supports_covering_indexes, 'Уникальность Echo с INCLUDE - только PostgreSQL')
+    def test_concurrent_insert(self):
+        post = self.posts[0]
+        replay, calls = votes._replay, []
+
+        def racing_replay(*args):
+            # Параллельный запрос успел поставить тот же Echo между чтением и вставкой
+            if not calls:
+                Echo.objects.create(user=self.user, content_object=post, is_echo=True)
+                Post.objects.filter(pk=post.pk).update(echo_count=1)
+            calls.append(args)
+            return replay(*args)
+
+        with mock.patch.object(votes, '_replay', side_effect=racing_replay):
+            results = votes.toggle_many(self.user, [{'content_type': 'post', 'id': post.id, 'is_echo': True}])
+        self.assertEqual(len(calls), 2)
+        # Нажатие применено к настоящему прежнему состоянию: оценка снята, голос не удвоен
+        self.assertEqual(results[0]['my_vote'], None)
+        self.assertEqual((results[0]['object'].echo_count, Echo.objects.count()), (0, 0))
+
+
+class CommentTreeTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='reader')
+        cls.post = Post.objects.create(author=cls.user, content='post')
+
+        def reply(parent=None):
+            return Comment.objects.create(post=cls.post, author=cls.user, text='comment', parent_comment=parent)
+
+        # a -> (b -> d -> e, c); f без ответов
+        cls.a = reply()
+        cls.b = reply(cls.a)
+        cls.c = reply(cls.a)
+        cls.d = reply(cls.b)
+        cls.e = reply(cls.d)
+        cls.f = reply()
+        # ContentType кэшируется в процессе: бюджет не должен зависеть от порядка тестов
+        ContentType.objects.get_for_model(Comment)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_tree(self, query):
+        # Корни + все потомки + my_vote
+        url = f'/echo_api/posts/{self.post.id}/comments/?mode=tree&{query}'
+        return self.assertQueryBudget(url, 3).data['results']
+
+    def test_path(self):
+        self.e.refresh_from_db()
+        self.assertEqual(self.e.depth, 3)
+        self.assertTrue(self.e.path.startswith(self.a.path + self.b.path[-Comment.PATH_SEGMENT_LENGTH:]))
+
+    def test_depth(self):
+        f, a = self.get_tree('depth=2')
+        self.assertEqual((f['id'], f['replies'], f['replies_count']), (self.f.id, [], 0))
+        self.assertEqual([node['id'] for node in a['replies']], [self.b.id, self.c.id])
+        d = a['replies'][0]['replies'][0]
+        self.assertEqual((d['id'], d['replies'], d['replies_count']), (self.d.id, [], 1))
+
+    def test_breadth(self):
+        _, a = self.get_tree('breadth=1&depth=10')
+        self.assertEqual(a['replies_count'], 2)
+        self.assertEqual([node['id'] for node in a['replies']], [self.b.id])
+        self.assertEqual(a['replies'][0]['replies'][0]['replies'][0]['id'], self.e.id)
+
+    def test_paginated_roots(self):
+        (f,) = self.get_tree('page_size=1')
+        self.assertEqual(f['id'], self.f.id)
+
+    @override_settings(COMMENT_TREE_MAX_NODES=4)
+    def test_each_root_has_its_own_budget(self):
+        # Ветка a уже длиннее двух узлов: ответ g корню f все равно виден
+        g = Comment.objects.create(post=self.post, author=self.user, text='comment', parent_comment=self.f)
+        f, a = self.get_tree('depth=10')
+        self.assertEqual([node['id'] for node in f['replies']], [g.id])
+        # Сначала ближние уровни: b и c целиком, d - за бюджетом
+        self.assertEqual([node['id'] for node in a['replies']], [self.b.id, self.c.id])
+        b = a['replies'][0]
+        self.assertEqual((b['replies'], b['replies_count']), ([], 1))
+
+    def test_max_depth(self):
+        url = f'/echo_api/posts/{self.post.id}/comments/'
+        with mock.patch.object(Comment, 'MAX_DEPTH', 3):
+            response = self.client.post(url, {'content': 'reply', 'parent_comment_id': self.d.id})
+            self.assertEqual(response.status_code, 201, response.content)
+            response = self.client.post(url, {'content': 'too deep', 'parent_comment_id': self.e.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Comment.objects.filter(text='too deep').exists())
+
+
+class UploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='uploader')
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.root, UPLOAD_CHUNK_ROOT=f'{self.root}/chunks', UPLOAD_CHUNK_SIZE=4,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def put_chunk(self, upload_id, index, body, **headers):
+        return self.client.put(
+            f'/echo_api/uploads/{upload_id}/chunks/{index}/', body,
+            content_type='application/octet-stream', headers=headers,
+        )
+
+    def test_resumable_upload(self):
+        content = b'0123456789'
+        upload = self.client.post('/echo_api/uploads/', {'filename': 'a.txt', 'size': len(content)}, format='json').data
+        self.assertEqual((upload['chunk_size'], upload['chunks_total'], upload['received']), (4, 3, []))
+
+        # Куски в любом порядке, повтор ничего не ломает
+        self.assertEqual(self.put_chunk(upload['id'], 2, content[8:]).status_code, 200)
+        self.assertEqual(self.put_chunk(upload['id'], 0, content[:4]).status_code, 200)
+        self.assertEqual(self.put_chunk(upload['id'], 0, content[:4]).status_code, 200)
+        self.assertEqual(self.put_chunk(upload['id'], 1, b'45').status_code, 400)
+        self.assertEqual(
+            self.put_chunk(upload['id'], 1, content[4:8], X_CHUNK_SHA256='0' * 64).status_code, 400
+        )
+        self.assertEqual(self.client.post(f'/echo_api/uploads/{upload["id"]}/complete/').status_code, 400)
+        self.assertEqual(self.client.get(f'/echo_api/uploads/{upload["id"]}/').data['received'], [0, 2])
+
+        digest = hashlib.sha256(content[4:8]).hexdigest()
+        self.assertEqual(self.put_chunk(upload['id'], 1, content[4:8], X_CHUNK_SHA256=digest).status_code, 200)
+        response = self.client.post(f'/echo_api/uploads/{upload["id"]}/complete/')
+        self.assertEqual(response.data['status'], Upload.COMPLETE)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/echo_api/posts/', {'content': 'post', 'upload_ids': [upload['id']]}, format='json'
+            )
+        self.assertEqual(response.status_code, 201, response.content)
+        post_file = PostFile.objects.get(post_id=response.data['id'])
+        # Ссылка перешла к PostFile, удаление сессии ее не сняло
+        self.assertEqual(MediaBlob.objects.get(pk=post_file.file.name).refcount, 1)
+        with post_file.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(Upload.objects.exists())
+        # Куски собранного файла удалены
+        self.assertEqual(uploads.cleanup(ttl=1), (0, 0))
+
+    def test_deleted_upload_releases_file(self):
+        upload = Upload.objects.create(user=self.user, filename='a.txt', size=4, chunk_size=4, status=Upload.COMPLETE)
+        upload.file.save('a.txt', ContentFile(b'0123'), save=True)
+        name = upload.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.uploads.all().delete()
+        self.assertFalse(MediaBlob.objects.filter(pk=name).exists())
+        self.assertFalse(upload.file.storage.exists(name))
+
+    def test_foreign_upload(self):
+        other = CustomUser.objects.create(username='other')
+        upload = Upload.objects.create(user=other, filename='a.txt', size=4, chunk_size=4, status=Upload.COMPLETE)
+        self.assertEqual(self.put_chunk(upload.id, 0, b'0123').status_code, 404)
+        response = self.client.post(
+            '/echo_api/posts/', {'content': 'post', 'upload_ids': [str(upload.id)]}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class MediaVariantTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def photo(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Ориентация: повернуть на 90°
+        exif[0x010F] = 'Camera'
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buffer, 'JPEG', exif=exif)
+        return ContentFile(buffer.getvalue(), name='photo.jpg')
+
+    def test_post_file_variants(self):
+        user = CustomUser.objects.create(username='photographer')
+        post = Post.objects.create(author=user, content='post')
+        post_file = PostFile.objects.create(post=post, file=self.photo())
+        original_url = post_file.file.url
+        self.assertEqual(media.variant_url(post_file.file, post_file.variants, 'feed'), original_url)
+
+        media.process('echo_api.postfile', post_file.pk)
+        post_file.refresh_from_db()
+        self.assertEqual(post_file.variants['source'], post_file.file.name)
+        with post_file.file.storage.open(post_file.variants['feed']) as f, Image.open(f) as image:
+            # Повернута по EXIF, ужата до ширины ленты, метаданных нет
+            self.assertEqual(image.size, (1000, 2000))
+            self.assertFalse(image.getexif())
+        url = media.variant_url(post_file.file, post_file.variants, 'feed')
+        self.assertNotEqual(url, original_url)
+
+        # Не картинка: остается оригинал
+        text_file = PostFile.objects.create(post=post, file=ContentFile(b'not an image', name='a.mp4'), order=1)
+        media.process('echo_api.postfile', text_file.pk)
+        text_file.refresh_from_db()
+        self.assertEqual(media.variant_url(text_file.file, text_file.variants, 'feed'), text_file.file.url)
+
+        # Анимация: вариант был бы первым кадром, остается оригинал
+        buffer = BytesIO()
+        frames = [Image.new('RGB', (1500, 100), color) for color in ('red', 'blue')]
+        frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:])
+        animation = PostFile.objects.create(post=post, file=ContentFile(buffer.getvalue(), name='a.gif'), order=2)
+        media.process('echo_api.postfile', animation.pk)
+        animation.refresh_from_db()
+        self.assertEqual(animation.variants, {'source': animation.file.name})
+        self.assertEqual(media.variant_url(animation.file, animation.variants, 'feed'), animation.file.url)
+
+        user.avatar = self.photo()
+        user.save()
+        media.process('users_api.customuser', user.pk)
+        user.refresh_from_db()
+        self.assertEqual(set(user.avatar_variants), {'source', 'small', 'large'})
+
+        # Размер копии задает класс сериализатора или context, а не вложенность
+        small, large = (media.variant_url(user.avatar, user.avatar_variants, name) for name in ('small', 'large'))
+        self.assertEqual(UserSerializer(user).data['avatar'], large)
+        self.assertEqual(UserSerializer([user], many=True).data[0]['avatar'], large)
+        self.assertEqual(NestedUserSerializer(user).data['avatar'], small)
+        self.assertEqual(UserSerializer(user, context={'avatar_variant': 'small'}).data['avatar'], small)
+
+
+class DedupStorageTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_shared_blob(self):
+        user = CustomUser.objects.create(username='reposter')
+        first, second = (Post.objects.create(author=user, content=f'meme {i}') for i in range(2))
+        files = [
+            PostFile.objects.create(post=post, file=ContentFile(b'meme', name=f'meme{post.pk}.PNG'))
+            for post in (first, second)
+        ]
+        name = files[0].file.name
+        digest = hashlib.sha256(b'meme').hexdigest()
+        self.assertEqual(name, f'post_files/{digest[:2]}/{digest}.png')
+        self.assertEqual(files[1].file.name, name)
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 2)
+
+        storage = files[0].file.storage
+        with self.captureOnCommitCallbacks(execute=True):
+            # Каскад, как при удалении истекших постов
+            Post.objects.filter(pk=first.pk).delete()
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+        self.assertTrue(storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+        self.assertFalse(storage.exists(name))
+
+    def test_avatar_change(self):
+        user = CustomUser.objects.create(username='selfie')
+        user.avatar = ContentFile(b'old', name='a.jpg')
+        user.save()
+        old = user.avatar.name
+        with self.captureOnCommitCallbacks(execute=True):
+            user.avatar = ContentFile(b'new', name='b.jpg')
+            user.save()
+        self.assertFalse(user.avatar.storage.exists(old))
+        self.assertTrue(user.avatar.storage.exists(user.avatar.name))
+
+    def test_same_avatar_reupload(self):
+        user = CustomUser.objects.create(username='selfie')
+        user.avatar = ContentFile(b'same', name='a.jpg')
+        user.save()
+        name = user.avatar.name
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                user.avatar = ContentFile(b'same', name='b.jpg')
+                user.save()
+        # Имя то же, ссылка по-прежнему одна
+        self.assertEqual(user.avatar.name, name)
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+        self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+
+
+class MediaServerTests(TransactionTestCase):
+    # database_sync_to_async закрывает соединение, TestCase этого не переживает
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.server = MediaServer(inner=None)
+
+    def get(self, name, query=b'', **headers):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': f'/media/{name}', 'query_string': query,
+            'headers': [(key.replace('_', '-').lower().encode(), value.encode()) for key, value in headers.items()],
+        }
+        async_to_sync(self.server)(scope, None, send)
+        start, *body = messages
+        return start['status'], dict((k.decode(), v.decode()) for k, v in start['headers']), b''.join(
+            message.get('body', b'') for message in body
+        )
+
+    def test_post_file(self):
+        user = CustomUser.objects.create(username='author')
+        post = Post.objects.create(author=user, content='post')
+        name = PostFile.objects.create(post=post, file=ContentFile(b'0123456789', name='a.txt')).file.name
+
+        status, headers, body = self.get(name)
+        self.assertEqual((status, body), (200, b'0123456789'))
+        self.assertIn('immutable', headers['Cache-Control'])
+        self.assertEqual(headers['ETag'], f'"{hashlib.sha256(b"0123456789").hexdigest()}"')
+
+        self.assertEqual(self.get(name, If_None_Match=headers['ETag'])[0], 304)
+        status, headers, body = self.get(name, Range='bytes=2-4')
+        self.assertEqual((status, body, headers['Content-Range']), (206, b'234', 'bytes 2-4/10'))
+        self.assertEqual(self.get(name, Range='bytes=-3')[2], b'789')
+        self.assertEqual(self.get(name, Range='bytes=20-')[0], 416)
+        self.assertEqual(self.get('../settings.py')[0], 404)
+        self.assertEqual(self.get('%00')[0], 404)
+
+    def test_chat_avatar(self):
+        member, stranger = (CustomUser.objects.create(username=name) for name in ('member', 'stranger'))
+        chat = Chat.objects.create(is_group=True, name='chat', avatar=ContentFile(b'avatar', name='c.png'))
+        chat.participants.add(member)
+        name = chat.avatar.name
+
+        self.assertEqual(self.get(name)[0], 404)
+        self.assertEqual(self.get(name, Authorization=f'Bearer {AccessToken.for_user(stranger)}')[0], 404)
+        self.assertEqual(self.get(name, query=f'token={AccessToken.for_user(member)}'.encode())[:3:2], (200, b'avatar'))
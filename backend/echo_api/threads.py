@@ -0,0 +1,88 @@
+"""
+Дерево комментариев поста (posts/<post_id>/comments/?mode=tree).
+
+Корни (комментарии к самому посту) идут курсорными страницами, а потомки всех
+корней страницы загружаются одним запросом: поддерево каждого корня - это
+диапазон по материализованному пути Comment.path (индекс idx_comment_post_path).
+"""
+from django.conf import settings
+from django.db.models import F, Q, Window
+from django.db.models.functions import Length, RowNumber, Substr
+
+from .models import Comment
+
+
+def _bounded(query_params, name, default, maximum):
+    try:
+        value = int(query_params[name])
+    except (KeyError, ValueError):
+        return default
+    return min(max(value, 0), maximum)
+
+
+def tree_limits(query_params):
+    """
+    (depth, breadth) из ?depth= и ?breadth=: сколько уровней ответов
+    загружать под корнем и сколько ответов показывать у каждого узла.
+    """
+    depth = _bounded(query_params, 'depth', settings.COMMENT_TREE_DEPTH, settings.COMMENT_TREE_MAX_DEPTH)
+    breadth = _bounded(query_params, 'breadth', settings.COMMENT_TREE_BREADTH, settings.COMMENT_TREE_MAX_BREADTH)
+    return depth, breadth
+
+
+def load_descendants(queryset, roots, depth):
+    """
+    Потомки roots не глубже depth уровней одним запросом, в порядке обхода в глубину.
+
+    COMMENT_TREE_MAX_NODES делится поровну между корнями: у каждого корня свое
+    окно по префиксу пути, и одна ветка-гигант не оставит остальных без
+    ответов. Внутри окна берутся сначала ближние уровни (прямые ответы корню,
+    потом их ответы), поэтому обрезается только глубина, а replies_count
+    узла по-прежнему говорит, сколько ответов можно догрузить.
+    """
+    if not roots or depth <= 0:
+        return []
+
+    ranges = Q()
+    for root in roots:
+        low, high = root.subtree_path_range()
+        ranges |= Q(path__gt=low, path__lt=high)
+
+    # У корня глубина 0, то есть путь из одного сегмента
+    max_path_length = (depth + 1) * Comment.PATH_SEGMENT_LENGTH
+    per_root = max(settings.COMMENT_TREE_MAX_NODES // len(roots), 1)
+    return list(
+        queryset.filter(ranges)
+        .alias(path_length=Length('path')).filter(path_length__lte=max_path_length)
+        .alias(rank=Window(
+            RowNumber(),
+            partition_by=Substr('path', 1, Comment.PATH_SEGMENT_LENGTH),
+            order_by=[F('path_length').asc(), F('path').asc()],
+        ))
+        .filter(rank__lte=per_root)
+        .order_by('path')
+    )
+
+
+def build_tree(comments, data, breadth):
+    """
+    Собирает вложенные replies из сериализованных комментариев.
+
+    comments и data идут параллельно: сначала корни, потом их потомки в порядке
+    path. У каждого узла replies_count - сколько всего прямых ответов в базе
+    (аннотация with_replies_count), в replies - не больше breadth первых из них.
+    """
+    nodes = {}
+    roots = []
+    for comment, item in zip(comments, data):
+        node = dict(item, replies=[], replies_count=comment.replies_count)
+        nodes[comment.pk] = node
+
+        if comment.parent_comment_id is None:
+            roots.append(node)
+            continue
+        # Родитель мог не попасть в выборку из-за breadth
+        parent = nodes.get(comment.parent_comment_id)
+        if parent is not None and len(parent['replies']) < breadth:
+            parent['replies'].append(node)
+    return roots
@@ -0,0 +1,191 @@
+"""
+Таймлайны ленты друзей в Redis.
+
+У каждого пользователя есть sorted set `timeline:<user_id>`: id постов друзей
+со score = created_at. Новый пост раскладывается по таймлайнам друзей автора
+при создании (fan-out on write). Авторы, у которых друзей больше
+FRIEND_FEED_FANOUT_LIMIT, не раскладываются - их посты читатель подтягивает
+из базы сам (pull) и сливает с таймлайном.
+
+Таймлайн строится лениво при первом чтении. Служебный элемент TIMELINE_SENTINEL
+отличает построенный пустой таймлайн от несуществующего. Страница читается
+из таймлайна по score от курсора ленты (ZREVRANGEBYSCORE ... LIMIT), а не
+целиком.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from backend.friends_api.services import get_friend_ids
+
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_KEY = 'timeline:{user_id}'
+PULL_AUTHORS_KEY = 'timeline:pull_authors'
+TIMELINE_SENTINEL = '0'
+
+# Ошибки, при которых лента собирается напрямую из базы
+TIMELINE_ERRORS = (RedisError, NotImplementedError)
+
+# ZADD только в уже построенные таймлайны: недостроенный таймлайн из одного
+# поста выглядел бы для читателя как полный.
+_PUSH_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', key, ARGV[1], ARGV[2])
+        redis.call('ZREMRANGEBYRANK', key, 1, -(tonumber(ARGV[3]) + 1))
+    end
+end
+return 1
+"""
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def _timeline_key(user_id):
+    return TIMELINE_KEY.format(user_id=user_id)
+
+
+def push_post(post):
+    """Fan-out on write: добавляет пост в таймлайны друзей автора."""
+    friend_ids = get_friend_ids(post.author_id)
+    if not friend_ids:
+        return
+    r = _redis()
+    if len(friend_ids) > settings.FRIEND_FEED_FANOUT_LIMIT:
+        # Слишком дорого раскладывать: читатели подтянут посты автора сами
+        r.sadd(PULL_AUTHORS_KEY, post.author_id)
+        return
+    r.eval(
+        _PUSH_SCRIPT, len(friend_ids), *[_timeline_key(fid) for fid in friend_ids],
+        post.created_at.timestamp(), post.pk, settings.FRIEND_FEED_TIMELINE_SIZE,
+    )
+
+
+def rebuild_timeline(user_id, friend_ids):
+    """Собирает таймлайн пользователя из базы (холодный старт или сброс)."""
+    rows = (
+        Post.objects.alive()
+        .filter(author_id__in=friend_ids)
+        .order_by('-created_at', '-id')
+        .values_list('id', 'created_at')[:settings.FRIEND_FEED_TIMELINE_SIZE]
+    )
+    key = _timeline_key(user_id)
+    # Служебный элемент всегда имеет наименьший score и ранг 0
+    mapping = {TIMELINE_SENTINEL: 0}
+    mapping.update({str(pk): created_at.timestamp() for pk, created_at in rows})
+
+    pipe = _redis().pipeline()
+    pipe.delete(key)
+    pipe.zadd(key, mapping)
+    pipe.expire(key, settings.FRIEND_FEED_TIMELINE_TTL)
+    pipe.execute()
+
+
+def _window(r, key, cursor, offset, limit):
+    """Отрезок таймлайна за курсором: [(member, score)], начиная с offset."""
+    if cursor is None:
+        return r.zrevrangebyscore(key, '+inf', '-inf', start=offset, num=limit, withscores=True)
+    created_at, _, reverse = cursor
+    score = created_at.timestamp()
+    if reverse:
+        return r.zrangebyscore(key, f'({score}', '+inf', start=offset, num=limit, withscores=True)
+    return r.zrevrangebyscore(key, f'({score}', '-inf', start=offset, num=limit, withscores=True)
+
+
+def get_timeline(user_id, friend_ids, cursor, limit):
+    """
+    Возвращает (id постов из таймлайна, id друзей, чьи посты нужно дочитать из
+    базы, время, старше которого посты читаются из базы напрямую, или None).
+
+    cursor - (created_at, id, reverse) из KeysetPagination.decode_cursor или
+    None. Из таймлайна берутся limit живых постов за курсором плюс посты с тем
+    же created_at: точное условие (created_at, id) проверит запрос к базе.
+    Истекшие и удаленные посты, которые еще лежат в таймлайне, места на
+    странице не занимают: таймлайн читается отрезками по limit, пока живых не
+    наберется limit или он не кончится; удаленные id из него убираются.
+    Таймлайн хранит не больше FRIEND_FEED_TIMELINE_SIZE постов: если при
+    листании к старым он кончился, посты старше его последнего читаются из
+    базы напрямую.
+    """
+    r = _redis()
+    key = _timeline_key(user_id)
+    if not r.exists(key):
+        rebuild_timeline(user_id, friend_ids)
+
+    pipe = r.pipeline()
+    pipe.smembers(PULL_AUTHORS_KEY)
+    pipe.expire(key, settings.FRIEND_FEED_TIMELINE_TTL)
+    if cursor is not None:
+        score = cursor[0].timestamp()
+        pipe.zrangebyscore(key, score, score, withscores=True)
+    pull_authors, _, *same_score = pipe.execute()
+
+    def member_ids(entries):
+        return [int(member) for member, _ in entries if member.decode() != TIMELINE_SENTINEL]
+
+    post_ids, found, offset = [], 0, 0
+    ids = member_ids(entry for page in same_score for entry in page)
+    while True:
+        window = _window(r, key, cursor, offset, limit)
+        window_ids = member_ids(window)
+        ids += window_ids
+        expires = dict(Post.objects.filter(pk__in=ids).values_list('pk', 'expires_at'))
+        now = timezone.now()
+        post_ids += [pk for pk in ids if pk in expires and expires[pk] > now]
+        # Посты с created_at курсора могут оказаться до него - в счет идет только отрезок
+        found += sum(1 for pk in window_ids if pk in expires and expires[pk] > now)
+        # Удаленные посты убираем из таймлайна сразу; истекшие уберет воркер
+        # истечения (голос Эхо в пути еще может продлить пост)
+        deleted = [pk for pk in ids if pk not in expires]
+        if deleted:
+            r.zrem(key, *deleted)
+        exhausted = len(window) < limit
+        if exhausted or found >= limit:
+            break
+        # Удаленные сдвинули ранги: следующий отрезок начинается раньше
+        offset += len(window) - len(set(deleted) & set(window_ids))
+        ids = []
+
+    # Таймлайн обрезан до FRIEND_FEED_TIMELINE_SIZE: за его концом посты
+    # дочитываются из базы (при листании к новым конец таймлайна - конец ленты)
+    older_than = None
+    if exhausted and not (cursor is not None and cursor[2]):
+        oldest = r.zrange(key, 1, 1, withscores=True)
+        if oldest:
+            older_than = datetime.fromtimestamp(oldest[0][1], tz=dt_timezone.utc)
+
+    pull_author_ids = {int(author_id) for author_id in pull_authors} & friend_ids
+    return post_ids, pull_author_ids, older_than
+
+
+def reset_timelines(user_ids):
+    """Удаляет таймлайны: они пересоберутся при следующем чтении."""
+    if user_ids:
+        _redis().delete(*[_timeline_key(user_id) for user_id in user_ids])
+
+
+def evict_posts(posts):
+    """
+    Убирает истекшие и удаленные посты из таймлайнов друзей их авторов.
+
+    posts - пары (post_id, author_id).
+    """
+    by_author = defaultdict(list)
+    for post_id, author_id in posts:
+        by_author[author_id].append(post_id)
+
+    pipe = _redis().pipeline(transaction=False)
+    for author_id, post_ids in by_author.items():
+        for friend_id in get_friend_ids(author_id):
+            pipe.zrem(_timeline_key(friend_id), *post_ids)
+    pipe.execute()
@@ -0,0 +1,164 @@
+"""
+Докачиваемая загрузка файлов для постов.
+
+1. POST uploads/ {filename, size} - сессия Upload; в ответе chunk_size и chunks_total.
+2. PUT uploads/<id>/chunks/<index>/ - тело запроса = кусок index. Кусок читается
+   из потока блоками, на лету хэшируется и кладется в UPLOAD_CHUNK_ROOT под
+   именем своего sha256, поэтому повторная отправка того же куска ничего не меняет.
+3. GET uploads/<id>/ - какие куски уже приняты (докачка после обрыва связи).
+4. POST uploads/<id>/complete/ - куски потоком склеиваются в файл post_files/.
+5. POST posts/ с upload_ids - пост ссылается на собранные файлы.
+
+Ни кусок, ни файл целиком в памяти воркера не держатся.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Upload
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """Кусок или сессия загрузки не прошли проверку."""
+
+
+def _chunk_root():
+    return Path(settings.UPLOAD_CHUNK_ROOT)
+
+
+def _chunk_path(digest):
+    return _chunk_root() / digest[:2] / digest
+
+
+def store_chunk(upload, index, stream, length, expected_digest=None):
+    """
+    Принимает кусок index длиной length байт из stream и отмечает его в сессии.
+    Возвращает sha256 куска.
+    """
+    if not 0 <= index < upload.chunks_total:
+        raise UploadError(f"Нет куска с номером {index}.")
+    expected_length = min(upload.chunk_size, upload.size - index * upload.chunk_size)
+    if length != expected_length:
+        raise UploadError(f"Кусок {index} должен быть {expected_length} байт.")
+
+    root = _chunk_root()
+    root.mkdir(parents=True, exist_ok=True)
+    sha = hashlib.sha256()
+    received = 0
+    with tempfile.NamedTemporaryFile(dir=root, prefix='.part-', delete=False) as tmp:
+        try:
+            while received < length:
+                block = stream.read(min(BLOCK_SIZE, length - received))
+                if not block:
+                    break
+                sha.update(block)
+                tmp.write(block)
+                received += len(block)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+    digest = sha.hexdigest()
+    if received != length:
+        os.unlink(tmp.name)
+        raise UploadError(f"Кусок {index} пришел не полностью: {received} из {length} байт.")
+    if expected_digest and expected_digest.lower() != digest:
+        os.unlink(tmp.name)
+        raise UploadError(f"Контрольная сумма куска {index} не совпала.")
+
+    path = _chunk_path(digest)
+    path.parent.mkdir(exist_ok=True)
+    # Атомарная замена: одинаковые куски - один файл
+    os.replace(tmp.name, path)
+
+    with transaction.atomic():
+        # Куски одной сессии могут приходить параллельно
+        upload = Upload.objects.select_for_update().get(pk=upload.pk)
+        chunks = list(upload.chunks) + [None] * (upload.chunks_total - len(upload.chunks))
+        chunks[index] = digest
+        upload.chunks = chunks
+        upload.save(update_fields=['chunks'])
+    return digest
+
+
+def assemble(upload):
+    """Склеивает куски в файл upload.file и закрывает сессию."""
+    chunks = list(upload.chunks) + [None] * (upload.chunks_total - len(upload.chunks))
+    missing = [index for index, digest in enumerate(chunks) if not digest]
+    if missing:
+        raise UploadError(f"Не хватает кусков: {missing[:50]}")
+
+    with tempfile.TemporaryFile() as assembled:
+        for index, digest in enumerate(chunks):
+            try:
+                with open(_chunk_path(digest), 'rb') as chunk:
+                    shutil.copyfileobj(chunk, assembled, BLOCK_SIZE)
+            except FileNotFoundError:
+                # Кусок убрала уборка - клиент пришлет его заново
+                chunks[index] = None
+                Upload.objects.filter(pk=upload.pk).update(chunks=chunks)
+                raise UploadError(f"Кусок {index} потерян, отправьте его еще раз.")
+        assembled.seek(0)
+        upload.file.save(os.path.basename(upload.filename), File(assembled), save=False)
+
+    upload.status = Upload.COMPLETE
+    upload.save(update_fields=['file', 'status'])
+    release_chunks(chunks)
+
+
+def release_chunks(digests):
+    """Удаляет куски, на которые не ссылается ни одна незавершенная сессия."""
+    in_use = set()
+    for chunks in Upload.objects.filter(status=Upload.PENDING).values_list('chunks', flat=True):
+        in_use.update(chunks)
+    for digest in set(digests) - in_use:
+        if digest:
+            _chunk_path(digest).unlink(missing_ok=True)
+
+
+def cleanup(ttl=None):
+    """
+    Уборка: удаляет брошенные сессии старше ttl секунд (собранные, но так и не
+    прикрепленные к посту - вместе с файлом) и куски, на которые никто не ссылается.
+    Возвращает (удалено сессий, удалено кусков).
+    """
+    ttl = ttl or settings.UPLOAD_SESSION_TTL
+    deadline = time.time() - ttl
+
+    stale = Upload.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=ttl))
+    sessions = 0
+    for upload in stale.iterator():
+        # Собранный файл освободит сигнал post_delete
+        upload.delete()
+        sessions += 1
+
+    in_use = set()
+    for chunks in Upload.objects.filter(status=Upload.PENDING).values_list('chunks', flat=True):
+        in_use.update(chunks)
+
+    removed = 0
+    root = _chunk_root()
+    if root.exists():
+        for path in root.rglob('*'):
+            # Свежие файлы не трогаем: кусок мог быть записан, но еще не отмечен в сессии
+            if path.is_file() and path.name not in in_use and path.stat().st_mtime < deadline:
+                path.unlink(missing_ok=True)
+                removed += 1
+
+    if sessions or removed:
+        logger.info("Уборка загрузок: sessions=%s chunks=%s", sessions, removed)
+    return sessions, removed
@@ -69,4 +69,21 @@ urlpatterns = [
     path('comments/<int:pk>/disecho/', 
          views.EchoToggleView.as_view(), 
          {'content_type_model': 'comment', 'is_echo_url_param': False}, name='comment_disecho_toggle'),
+
+    # POST: Пачка оценок постов и комментариев одной транзакцией
+    path('echos/batch/', views.EchoBatchView.as_view(), name='echo_batch'),
+
+    # -------------------- ЗАГРУЗКА ФАЙЛОВ КУСКАМИ --------------------
+
+    # POST: Новая сессия загрузки
+    path('uploads/', views.UploadCreateView.as_view(), name='upload_create'),
+
+    # GET: Какие куски уже приняты
+    path('uploads/<uuid:pk>/', views.UploadDetailView.as_view(), name='upload_detail'),
+
+    # PUT: Один кусок файла
+    path('uploads/<uuid:pk>/chunks/<int:index>/', views.UploadChunkView.as_view(), name='upload_chunk'),
+
+    # POST: Склеить куски в файл
+    path('uploads/<uuid:pk>/complete/', views.UploadCompleteView.as_view(), name='upload_complete'),
 ]
\ No newline at end of file
@@ -1,18 +1,23 @@
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.exceptions import APIException 
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.views import APIView 
 from django.utils import timezone
 from django.db.models import Q
-from django.db import transaction 
-from django.shortcuts import get_object_or_404
-from django.contrib.contenttypes.models import ContentType 
-from datetime import timedelta
+from django.contrib.contenttypes.prefetch import GenericPrefetch
 from django.conf import settings 
-
-from .models import Post, Comment, Echo 
-from .serializers import PostSerializer, CommentSerializer, EchoSerializer
+from urllib.parse import urlsplit
+
+from .models import Post, Comment, Echo, Upload
+from .serializers import (
+    PostSerializer, CommentSerializer, EchoSerializer, VoteResultSerializer, EchoBatchSerializer,
+    UploadSerializer,
+)
+from .pagination import KeysetPagination
+from . import counters, feed_cache, threads, timelines, uploads, votes
+from .votes import VOTE_FIELDS
+from backend.friends_api.services import get_friend_ids
 
 class IsAuthorOrReadOnly(permissions.BasePermission):
     """Разрешение: разрешает полный доступ автору, остальным - только чтение."""
@@ -22,16 +27,89 @@ class IsAuthorOrReadOnly(permissions.BasePermission):
         
         return obj.author == request.user
 
+class CachedFeedMixin:
+    """
+    GET отдает страницу общей ленты из кэша (echo_api/feed_cache.py).
+
+    Кэш хранит состав и порядок страницы. Поля live_fields меняются без
+    сброса кэша (голоса, комментарии, продление жизни), поэтому при чтении из
+    кэша они подставляются живыми: один запрос к базе, несброшенные счетчики
+    из Redis и my_vote текущего пользователя одним запросом к Echo.
+
+    В кэш страница кладется без my_vote, а ссылки next/previous - только
+    строкой запроса: полный URL собирается для каждого запроса заново.
+    """
+    feed_name = None
+    live_fields = ('echo_count', 'disecho_count', 'expires_at', 'is_expired', 'my_vote')
+    link_fields = ('next', 'previous')
+
+    def get_live_queryset(self):
+        """Живые объекты ленты с полями, из которых считаются live_fields."""
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        built = []
+
+        def build():
+            data = super(CachedFeedMixin, self).list(request, *args, **kwargs).data
+            built.append(data)
+            return self.to_cache(data)
+
+        data = feed_cache.get_or_build(self.feed_name, request, build)
+        if built:
+            # Собрали сами: все поля уже свежие и my_vote - для этого пользователя
+            return Response(built[0])
+        return Response(self.from_cache(self.refresh(data)))
+
+    def to_cache(self, data):
+        cached = {name: urlsplit(data[name]).query if data.get(name) else None for name in self.link_fields}
+        cached['results'] = [
+            {name: value for name, value in item.items() if name != 'my_vote'} for item in data.get('results', [])
+        ]
+        return cached
+
+    def from_cache(self, data):
+        for name in self.link_fields:
+            if data.get(name):
+                data[name] = self.request.build_absolute_uri(f'{self.request.path}?{data[name]}')
+        return data
+
+    def refresh(self, data):
+        results = data.get('results', [])
+        live = self.get_live_queryset().in_bulk([item['id'] for item in results])
+        counters.merge_pending(list(live.values()))
+        votes.load_my_votes(self.request.user, list(live.values()))
+
+        fields = self.get_serializer().fields
+        refreshed = []
+        for item in results:
+            obj = live.get(item['id'])
+            if obj is None:
+                # Истек или удален после сборки страницы
+                continue
+            for name in self.live_fields:
+                item[name] = fields[name].to_representation(fields[name].get_attribute(obj))
+            refreshed.append(item)
+        data['results'] = refreshed
+        return data
+
 # -------------------- Post Views --------------------
 
-class PostListView(generics.ListCreateAPIView):
+class PostListView(CachedFeedMixin, generics.ListCreateAPIView):
     """GET: Список всех живых постов. POST: Создание нового поста."""
+    feed_name = feed_cache.POSTS_FEED
     serializer_class = PostSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
+
+    live_fields = CachedFeedMixin.live_fields + ('comments_count',)
 
     def get_queryset(self):
         # Только живые посты
-        return Post.objects.filter(expires_at__gt=timezone.now()).order_by('-created_at')
+        return Post.objects.alive().for_feed().order_by('-created_at')
+
+    def get_live_queryset(self):
+        return Post.objects.alive().with_comments_count().only(*VOTE_FIELDS)
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -45,53 +123,83 @@ class PostDetailView(generics.RetrieveAPIView):
     def get_queryset(self):
         # Показываем только живые посты
         if self.request.user.is_staff:
-            return Post.objects.all()
-        return Post.objects.filter(expires_at__gt=timezone.now())
+            return Post.objects.for_feed()
+        return Post.objects.alive().for_feed()
 
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def friend_feed(request):
-    """Лента друзей (заглушка)"""
-    posts = Post.objects.filter(expires_at__gt=timezone.now()).order_by('-created_at')
-    serializer = PostSerializer(posts, many=True)
-    return Response(serializer.data)
+    """
+    Лента друзей: живые посты подтвержденных друзей.
+
+    Набор постов берется из таймлайна в Redis (плюс посты "тяжелых" авторов,
+    которые не раскладываются, и посты старше конца таймлайна), а сами
+    посты - из базы по первичному ключу.
+    Если Redis недоступен, лента собирается прямым запросом по друзьям.
+    """
+    friend_ids = get_friend_ids(request.user.id)
+    paginator = KeysetPagination()
+    try:
+        # Из таймлайна - только отрезок для этой страницы (+1, чтобы узнать про продолжение)
+        post_ids, pull_author_ids, older_than = timelines.get_timeline(
+            request.user.id, friend_ids, paginator.decode_cursor(request), paginator.get_page_size(request) + 1,
+        )
+        query = Q(id__in=post_ids) | Q(author_id__in=pull_author_ids)
+        if older_than is not None:
+            # Дальше конца таймлайна - прямой запрос по друзьям
+            query |= Q(author_id__in=friend_ids, created_at__lte=older_than)
+        posts = Post.objects.filter(query)
+    except timelines.TIMELINE_ERRORS:
+        posts = Post.objects.filter(author_id__in=friend_ids)
+
+    posts = posts.alive().for_feed().order_by('-created_at')
+    page = paginator.paginate_queryset(posts, request)
+    serializer = PostSerializer(page, many=True, context={'request': request})
+    return paginator.get_paginated_response(serializer.data)
     
 # -------------------- Floating Comment View --------------------
-class FloatingCommentListView(generics.ListAPIView):
+class FloatingCommentListView(CachedFeedMixin, generics.ListAPIView):
     """
     Показывает все комментарии, которые были оторваны от своих постов (is_floating=True)
     и которые еще не истекли.
     """
+    feed_name = feed_cache.FLOATING_FEED
     serializer_class = CommentSerializer 
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
-        return Comment.objects.filter(
+        return Comment.objects.for_feed().filter(
             is_floating=True,
             # Плавающий комментарий исчезает, когда истекает его время жизни
             expires_at__gt=timezone.now() 
         ).order_by('-created_at')
 
+    def get_live_queryset(self):
+        return Comment.objects.alive().filter(is_floating=True).only(*VOTE_FIELDS)
+
 # -------------------- My Views (для профиля) --------------------
 class MyPostListView(generics.ListAPIView):
     """Список всех постов, созданных текущим пользователем (даже если они истекли)."""
     serializer_class = PostSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         # Показываем все посты пользователя, независимо от expires_at
-        return Post.objects.filter(author=self.request.user).order_by('-created_at')
+        return Post.objects.for_feed().filter(author=self.request.user).order_by('-created_at')
 
 class MyCommentListActiveView(generics.ListAPIView): # ✅ НОВЫЙ КЛАСС
     """Список всех комментариев, созданных текущим пользователем (только 'живые' и 'плавающие')."""
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         # Показываем все комментарии пользователя, которые еще не истекли
         # (они могут быть прикреплены к посту или быть плавающими)
-        return Comment.objects.filter(
+        return Comment.objects.for_feed().filter(
             author=self.request.user, 
             expires_at__gt=timezone.now()
         ).order_by('-created_at')
@@ -100,21 +208,23 @@ class UserPostListView(generics.ListAPIView):
     """Список всех постов, созданных указанным пользователем (даже если они истекли)."""
     serializer_class = PostSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         user_id = self.kwargs['user_id']
         # Показываем все посты пользователя, независимо от expires_at
-        return Post.objects.filter(author_id=user_id).order_by('-created_at')
+        return Post.objects.for_feed().filter(author_id=user_id).order_by('-created_at')
 
 class UserCommentListActiveView(generics.ListAPIView):
     """Список всех активных комментариев, созданных указанным пользователем."""
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         user_id = self.kwargs['user_id']
         # Показываем все комментарии пользователя, которые еще не истекли
-        return Comment.objects.filter(
+        return Comment.objects.for_feed().filter(
             author_id=user_id,
             expires_at__gt=timezone.now()
         ).order_by('-created_at')
@@ -125,7 +235,7 @@ class MyPostDetailView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Post.objects.filter(author=self.request.user)
+        return Post.objects.for_feed().filter(author=self.request.user)
 
 
 class MyCommentDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -136,31 +246,59 @@ class MyCommentDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticated, IsAuthorOrReadOnly]
 
     def get_queryset(self):
-        return Comment.objects.filter(author=self.request.user)
+        return Comment.objects.for_feed().filter(author=self.request.user)
         
         
 class MyEchoListView(generics.ListAPIView):
     """Список всех Echo/DisEcho, которые поставил текущий пользователь."""
     serializer_class = EchoSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        return Echo.objects.filter(user=self.request.user).order_by('-created_at')
+        # Оцененные объекты подгружаются пачкой на модель, а не по запросу на строку
+        return Echo.objects.filter(user=self.request.user).select_related('user').prefetch_related(
+            GenericPrefetch('content_object', [
+                Post.objects.only('id', 'content'),
+                Comment.objects.only('id', 'text'),
+            ])
+        ).order_by('-created_at')
 
 # -------------------- Comment Views --------------------
 
 class CommentListView(generics.ListCreateAPIView):
-    """GET: Список комментариев. POST: Создание комментария."""
+    """
+    GET: Список комментариев. POST: Создание комментария.
+
+    GET ?mode=tree: страница комментариев к посту, у каждого вложенные replies
+    (?depth= уровней, не больше ?breadth= ответов на узел) и replies_count.
+    """
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         post_id = self.kwargs['post_id']
         # Показываем только комментарии, привязанные к посту и не плавающие
-        return Comment.objects.filter(
+        return Comment.objects.for_feed().filter(
             post_id=post_id,
             is_floating=False 
         ).order_by('-created_at')
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('mode') == 'tree':
+            return self.list_tree(request)
+        return super().list(request, *args, **kwargs)
+
+    def list_tree(self, request):
+        depth, breadth = threads.tree_limits(request.query_params)
+        queryset = self.get_queryset().with_replies_count()
+
+        roots = self.paginate_queryset(queryset.filter(parent_comment__isnull=True))
+        comments = roots + threads.load_descendants(queryset, roots, depth)
+        # Одна сериализация на всю страницу: счетчики и my_vote пачкой
+        data = self.get_serializer(comments, many=True).data
+        return self.get_paginated_response(threads.build_tree(comments, data, breadth))
         
     def perform_create(self, serializer):
         post_id = self.kwargs['post_id']
@@ -189,6 +327,9 @@ class CommentListView(generics.ListCreateAPIView):
             if parent_comment.is_floating:
                 raise APIException({"error": "Нельзя ответить на плавающий комментарий."}, code=status.HTTP_400_BAD_REQUEST)
 
+            if parent_comment.depth >= Comment.MAX_DEPTH:
+                raise ValidationError({"error": f"Ветка обсуждения не может быть глубже {Comment.MAX_DEPTH} ответов."})
+
 
         serializer.save(
             author=self.request.user, 
@@ -200,109 +341,117 @@ class CommentListView(generics.ListCreateAPIView):
 # -------------------- Echo/DisEcho Toggle View --------------------
 
 class EchoToggleView(APIView):
+    """
+    POST: Echo/DisEcho поста или комментария (повторное нажатие отменяет оценку).
+
+    Голос - один запрос к базе (echo_api/votes.py); в ответе только
+    изменившиеся поля: id, echo_count, disecho_count, expires_at, is_expired, my_vote.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
-    def get_time_deltas(self, content_type_model):
-        if content_type_model == 'post':
-            extend_hours = settings.ECHO_EXTEND_HOURS
-            reduce_hours = settings.DISECHO_REDUCE_HOURS
-        else:
-            extend_hours = settings.COMMENT_ECHO_EXTEND_HOURS
-            reduce_hours = settings.COMMENT_DISECHO_REDUCE_HOURS
-        
-        return timedelta(hours=extend_hours), timedelta(hours=reduce_hours)
-        
-    def post(self, request, pk, content_type_model, is_echo_url_param): 
-        
-        user = request.user
-        is_echo = is_echo_url_param 
-        
-        if content_type_model == 'post':
-            Model = Post
-            Serializer = PostSerializer
-        elif content_type_model == 'comment':
-            Model = Comment
-            Serializer = CommentSerializer
-        else:
+    def post(self, request, pk, content_type_model, is_echo_url_param):
+        if content_type_model not in votes.VOTE_MODELS:
             return Response(
                 {"error": "Недопустимый тип контента. Должен быть 'post' или 'comment'."}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-            
-        content_object = get_object_or_404(Model, pk=pk)
-        
-        if content_object.is_expired() and not user.is_staff:
-            return Response(
-                {"error": f"{content_type_model.capitalize()} истек и не может быть оценен."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
 
-        if content_type_model == 'comment' and content_object.is_floating:
-              return Response(
-                {"error": "Нельзя оценивать плавающий комментарий, так как он оторван от поста."},
-                status=status.HTTP_400_BAD_REQUEST
+        try:
+            content_object = votes.toggle(request.user, content_type_model, pk, is_echo_url_param)
+        except votes.VoteRejected as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(VoteResultSerializer(content_object).data, status=status.HTTP_200_OK)
+
+
+class EchoBatchView(APIView):
+    """
+    POST: Пачка Echo/DisEcho одной транзакцией.
+
+    Тело: {"operations": [{"content_type": "post" | "comment", "id": 1, "is_echo": true}, ...]}.
+    Ответ: {"results": [...]} в том же порядке; у каждого элемента status
+    'ok' (с полями как у EchoToggleView), 'not_found' или 'rejected' (с error).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = EchoBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = []
+        for result in votes.toggle_many(request.user, serializer.validated_data['operations']):
+            content_object = result.pop('object', None)
+            if content_object is not None:
+                result = {**VoteResultSerializer(content_object).data, **result}
+            results.append(result)
+
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
+# -------------------- Докачиваемая загрузка файлов --------------------
+
+class UploadCreateView(generics.CreateAPIView):
+    """POST: Новая сессия загрузки {filename, size}; в ответе chunk_size и chunks_total."""
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user, chunk_size=settings.UPLOAD_CHUNK_SIZE)
+
+
+class UploadDetailView(generics.RetrieveAPIView):
+    """GET: Состояние своей загрузки - какие куски уже приняты."""
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Upload.objects.filter(user=self.request.user)
+
+
+class UploadChunkView(generics.GenericAPIView):
+    """
+    PUT: Кусок index загрузки, тело запроса - сырые байты куска.
+
+    Необязательный заголовок X-Chunk-SHA256 проверяется. Кусок можно
+    отправлять повторно и в любом порядке.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Upload.objects.filter(user=self.request.user, status=Upload.PENDING)
+
+    def put(self, request, pk, index):
+        upload = self.get_object()
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+
+        try:
+            digest = uploads.store_chunk(
+                upload, index, request.stream, length,
+                expected_digest=request.headers.get('X-Chunk-SHA256'),
             )
-            
-        content_type = ContentType.objects.get_for_model(Model)
-        
-        echo_delta, disecho_delta = self.get_time_deltas(content_type_model)
-
-        with transaction.atomic():
-            existing_echo = Echo.objects.select_for_update().filter(
-                user=user, 
-                content_type=content_type, 
-                object_id=content_object.pk
-            ).first()
-
-            # Сценарий 1: Отмена (удаление) оценки
-            if existing_echo and existing_echo.is_echo == is_echo:
-                if is_echo:
-                    content_object.echo_count -= 1
-                    content_object.expires_at -= echo_delta
-                else:
-                    content_object.disecho_count -= 1
-                    content_object.expires_at += disecho_delta 
-                
-                existing_echo.delete()
-                
-            # Сценарий 2: Смена оценки (Echo -> DisEcho или наоборот)
-            elif existing_echo and existing_echo.is_echo != is_echo:
-                
-                # 1. Откатываем старую оценку
-                if existing_echo.is_echo:
-                    content_object.echo_count -= 1
-                    content_object.expires_at -= echo_delta
-                else:
-                    content_object.disecho_count -= 1
-                    content_object.expires_at += disecho_delta
-
-                # 2. Применяем новую оценку
-                existing_echo.is_echo = is_echo
-                if is_echo:
-                    content_object.echo_count += 1
-                    content_object.expires_at += echo_delta
-                else:
-                    content_object.disecho_count += 1
-                    content_object.expires_at -= disecho_delta
-                
-                existing_echo.save()
-                
-            # Сценарий 3: Создание новой оценки
-            else:
-                Echo.objects.create(
-                    user=user,
-                    content_type=content_type,
-                    object_id=content_object.pk,
-                    is_echo=is_echo
-                )
-                
-                if is_echo:
-                    content_object.echo_count += 1
-                    content_object.expires_at += echo_delta 
-                else:
-                    content_object.disecho_count += 1
-                    content_object.expires_at -= disecho_delta
-                        
-            content_object.save(update_fields=['echo_count', 'disecho_count', 'expires_at', 'updated_at'])
-
-            return Response(Serializer(content_object).data, status=status.HTTP_200_OK)
\ No newline at end of file
+        except uploads.UploadError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'index': index, 'sha256': digest}, status=status.HTTP_200_OK)
+
+
+class UploadCompleteView(generics.GenericAPIView):
+    """POST: Склеивает принятые куски; после этого id загрузки можно передать в upload_ids поста."""
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Upload.objects.filter(user=self.request.user)
+
+    def post(self, request, pk):
+        upload = self.get_object()
+        if upload.status == Upload.PENDING:
+            try:
+                uploads.assemble(upload)
+            except uploads.UploadError as exc:
+                return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(self.get_serializer(upload).data, status=status.HTTP_200_OK)
@@ -0,0 +1,421 @@
+"""
+Голосование Echo/DisEcho.
+
+На PostgreSQL голос стоит один запрос: CTE блокирует прежнюю оценку
+пользователя, удаляет, меняет или вставляет строку Echo и (без write-behind)
+сдвигает счетчики и expires_at поста или комментария, возвращая новые
+значения через RETURNING. На остальных базах тот же алгоритм работает через ORM.
+
+Пачка голосов (toggle_many) - одна транзакция с массовыми вставками и
+удалениями Echo и одним обновлением счетчиков на модель. Если параллельный
+запрос вставил оценку того же объекта, пачка перечитывает оценки и
+пересчитывается, а не удваивает голос.
+
+load_my_votes заполняет оценку текущего пользователя (my_vote) для целой
+страницы ленты одним запросом к Echo.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.http import Http404
+
+from . import counters
+from .models import Comment, Echo, Post
+
+VOTE_MODELS = {'post': Post, 'comment': Comment}
+
+# Поля, которые нужны для проверки и ответа на голос
+VOTE_FIELDS = ('id', 'echo_count', 'disecho_count', 'expires_at', 'is_floating')
+
+# Сколько раз пересчитать пачку, если параллельный запрос вставил ту же оценку
+BATCH_CONFLICT_RETRIES = 3
+
+
+class VoteRejected(Exception):
+    """Объект нельзя оценить: он истек или оторван от поста."""
+
+
+def get_time_deltas(model_name):
+    """(на сколько Echo продлевает жизнь, на сколько DisEcho ее сокращает)."""
+    if model_name == 'post':
+        extend_hours = settings.ECHO_EXTEND_HOURS
+        reduce_hours = settings.DISECHO_REDUCE_HOURS
+    else:
+        extend_hours = settings.COMMENT_ECHO_EXTEND_HOURS
+        reduce_hours = settings.COMMENT_DISECHO_REDUCE_HOURS
+    return timedelta(hours=extend_hours), timedelta(hours=reduce_hours)
+
+
+def check_votable(model_name, is_expired, is_floating, is_staff):
+    if is_expired and not is_staff:
+        raise VoteRejected(f"{model_name.capitalize()} истек и не может быть оценен.")
+    if model_name == 'comment' and is_floating:
+        raise VoteRejected("Нельзя оценивать плавающий комментарий, так как он оторван от поста.")
+
+
+def _content_type_ids(model_names):
+    # get_for_model кэширует ContentType в процессе: запроса нет
+    return {model_name: ContentType.objects.get_for_model(VOTE_MODELS[model_name]).pk for model_name in model_names}
+
+
+def _echo_lookup(content_type_ids, ids_by_model):
+    """Условие на Echo для набора объектов: {model_name: ids}."""
+    lookup = Q()
+    for model_name, ids in ids_by_model.items():
+        lookup |= Q(content_type_id=content_type_ids[model_name], object_id__in=ids)
+    return lookup
+
+
+def vote_changes(old_is_echo, is_echo):
+    """
+    Переход оценки пользователя old_is_echo (None - оценки нет) по нажатию is_echo.
+
+    Возвращает (приращение echo_count, приращение disecho_count, новая оценка или None).
+    """
+    if old_is_echo is None:
+        # Новая оценка
+        return (1, 0, is_echo) if is_echo else (0, 1, is_echo)
+    if old_is_echo == is_echo:
+        # Повторное нажатие отменяет оценку
+        return (-1, 0, None) if is_echo else (0, -1, None)
+    # Смена Echo <-> DisEcho
+    return (1, -1, is_echo) if is_echo else (-1, 1, is_echo)
+
+
+def toggle(user, model_name, pk, is_echo):
+    """
+    Переключает оценку user на объекте model_name/pk.
+
+    Возвращает объект модели, в котором заполнены только id, echo_count,
+    disecho_count, expires_at и my_vote (True, False или None).
+    Бросает Http404, если объекта нет, и VoteRejected, если его нельзя оценить.
+    """
+    if connection.vendor == 'postgresql':
+        return _toggle_sql(user, model_name, pk, is_echo)
+    return _toggle_orm(user, model_name, pk, is_echo)
+
+
+# -------------------- PostgreSQL: один запрос --------------------
+
+_TOGGLE_SQL = """
+WITH target AS (
+    SELECT id, echo_count, disecho_count, expires_at,
+           {is_floating} AS is_floating,
+           COALESCE(expires_at < now(), false) AS is_expired
+    FROM {table}
+    WHERE id = %(object_id)s
+),
+votable AS (
+    SELECT id FROM target
+    WHERE NOT is_floating AND (%(is_staff)s OR NOT is_expired)
+),
+old AS (
+    SELECT e.id, e.is_echo
+    FROM {echo} e JOIN votable v ON e.object_id = v.id
+    WHERE e.user_id = %(user_id)s AND e.content_type_id = %(content_type_id)s
+    FOR UPDATE OF e
+),
+removed AS (
+    DELETE FROM {echo} e USING old
+    WHERE e.id = old.id AND old.is_echo = %(is_echo)s
+    RETURNING e.id
+),
+switched AS (
+    UPDATE {echo} e SET is_echo = %(is_echo)s FROM old
+    WHERE e.id = old.id AND old.is_echo <> %(is_echo)s
+    RETURNING e.id
+),
+added AS (
+    INSERT INTO {echo} (user_id, content_type_id, object_id, is_echo, created_at)
+    SELECT %(user_id)s, %(content_type_id)s, v.id, %(is_echo)s, now()
+    FROM votable v
+    WHERE NOT EXISTS (SELECT 1 FROM old)
+    ON CONFLICT (user_id, content_type_id, object_id) DO NOTHING
+    RETURNING id
+),
+changes AS (
+    SELECT CASE WHEN %(is_echo)s THEN d.own + d.switched ELSE -d.switched END AS echo_change,
+           CASE WHEN %(is_echo)s THEN -d.switched ELSE d.own + d.switched END AS disecho_change,
+           d.own, d.switched
+    FROM (
+        SELECT (SELECT count(*) FROM added) - (SELECT count(*) FROM removed) AS own,
+               (SELECT count(*) FROM switched) AS switched
+    ) d
+){bump}
+SELECT t.id, t.is_floating, t.is_expired, EXISTS (SELECT 1 FROM votable),
+       c.echo_change, c.disecho_change, c.own, c.switched,
+       {counts}
+FROM target t CROSS JOIN changes c{bump_join}
+"""
+
+# Сдвиг счетчиков в том же запросе (ECHO_WRITE_BEHIND выключен)
+_BUMP_SQL = """,
+bumped AS (
+    UPDATE {table} o SET
+        echo_count = o.echo_count + c.echo_change,
+        disecho_count = o.disecho_count + c.disecho_change,
+        expires_at = o.expires_at + make_interval(
+            secs => c.echo_change * %(echo_seconds)s - c.disecho_change * %(disecho_seconds)s
+        ){updated_at}
+    FROM changes c
+    WHERE o.id = %(object_id)s AND (c.echo_change <> 0 OR c.disecho_change <> 0)
+    RETURNING o.echo_count, o.disecho_count, o.expires_at
+)
+"""
+
+
+def _toggle_sql(user, model_name, pk, is_echo):
+    Model = VOTE_MODELS[model_name]
+    qn = connection.ops.quote_name
+    table = qn(Model._meta.db_table)
+    write_behind = settings.ECHO_WRITE_BEHIND
+
+    if write_behind:
+        bump, bump_join = '\n', ''
+        counts = 't.echo_count, t.disecho_count, t.expires_at'
+    else:
+        has_updated_at = any(field.name == 'updated_at' for field in Model._meta.fields)
+        bump = _BUMP_SQL.format(table=table, updated_at=',\n        updated_at = now()' if has_updated_at else '')
+        bump_join = ' LEFT JOIN bumped b ON true'
+        counts = (
+            'COALESCE(b.echo_count, t.echo_count), COALESCE(b.disecho_count, t.disecho_count), '
+            'COALESCE(b.expires_at, t.expires_at)'
+        )
+
+    sql = _TOGGLE_SQL.format(
+        table=table, echo=qn(Echo._meta.db_table),
+        is_floating='is_floating' if model_name == 'comment' else 'false',
+        bump=bump, bump_join=bump_join, counts=counts,
+    )
+    echo_delta, disecho_delta = get_time_deltas(model_name)
+    params = {
+        'object_id': pk,
+        'user_id': user.pk,
+        'content_type_id': _content_type_ids([model_name])[model_name],
+        'is_echo': is_echo,
+        'is_staff': user.is_staff,
+        'echo_seconds': int(echo_delta.total_seconds()),
+        'disecho_seconds': int(disecho_delta.total_seconds()),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+
+    if row is None:
+        raise Http404(f"{model_name.capitalize()} не найден.")
+    (object_id, is_floating, is_expired, votable, echo_change, disecho_change,
+     own, switched, echo_count, disecho_count, expires_at) = row
+    if not votable:
+        check_votable(model_name, is_expired, is_floating, user.is_staff)
+
+    content_object = Model(id=object_id, echo_count=echo_count, disecho_count=disecho_count, expires_at=expires_at)
+    # own == -1: оценка снята; own == 0 без смены - параллельный запрос уже поставил ту же оценку
+    content_object.my_vote = None if own < 0 else is_echo
+
+    if write_behind:
+        shift = echo_change * echo_delta - disecho_change * disecho_delta
+        counters.record(content_object, echo_change, disecho_change, shift)
+        counters.merge_pending([content_object])
+    elif model_name == 'post' and (echo_change or disecho_change):
+        content_object.schedule_expiry()
+    return content_object
+
+
+# -------------------- Остальные базы: ORM --------------------
+
+def _toggle_orm(user, model_name, pk, is_echo):
+    Model = VOTE_MODELS[model_name]
+    content_object = Model.objects.filter(pk=pk).only(*VOTE_FIELDS).first()
+    if content_object is None:
+        raise Http404(f"{model_name.capitalize()} не найден.")
+    check_votable(model_name, content_object.is_expired(), content_object.is_floating, user.is_staff)
+
+    content_type = ContentType.objects.get_for_model(Model)
+    echo_delta, disecho_delta = get_time_deltas(model_name)
+
+    with transaction.atomic():
+        existing_echo = Echo.objects.select_for_update().filter(
+            user=user, content_type=content_type, object_id=content_object.pk
+        ).first()
+
+        old_is_echo = existing_echo.is_echo if existing_echo else None
+        echo_change, disecho_change, my_vote = vote_changes(old_is_echo, is_echo)
+
+        if my_vote is None:
+            existing_echo.delete()
+        elif existing_echo:
+            existing_echo.is_echo = is_echo
+            existing_echo.save(update_fields=['is_echo'])
+        else:
+            Echo.objects.create(user=user, content_type=content_type, object_id=content_object.pk, is_echo=is_echo)
+
+        # Echo продлевает жизнь, DisEcho сокращает
+        shift = echo_change * echo_delta - disecho_change * disecho_delta
+        counters.record(content_object, echo_change, disecho_change, shift)
+
+    counters.merge_pending([content_object])
+    content_object.my_vote = my_vote
+    return content_object
+
+
+# -------------------- Пачка голосов --------------------
+
+def _replay(user, operations, objects, existing):
+    """
+    Прогоняет нажатия пачки по порядку в памяти, начиная с оценок existing.
+
+    Возвращает (state, deltas, results): итоговую оценку по (model_name, id),
+    приращения счетчиков {model_name: {id: [echo, disecho, seconds]}} и
+    результаты нажатий (без object).
+    """
+    state = {key: echo.is_echo for key, echo in existing.items()}
+    deltas = defaultdict(lambda: defaultdict(lambda: [0, 0, 0]))
+    results = []
+    for op in operations:
+        model_name, key = op['content_type'], (op['content_type'], op['id'])
+        result = {'content_type': model_name, 'id': op['id']}
+        results.append(result)
+
+        obj = objects.get(key)
+        if obj is None:
+            result['status'] = 'not_found'
+            continue
+        try:
+            check_votable(model_name, obj.is_expired(), obj.is_floating, user.is_staff)
+        except VoteRejected as exc:
+            result.update(status='rejected', error=str(exc))
+            continue
+
+        echo_change, disecho_change, state[key] = vote_changes(state.get(key), op['is_echo'])
+        echo_delta, disecho_delta = get_time_deltas(model_name)
+        delta = deltas[model_name][op['id']]
+        delta[0] += echo_change
+        delta[1] += disecho_change
+        delta[2] += int((echo_change * echo_delta - disecho_change * disecho_delta).total_seconds())
+        result.update(status='ok', my_vote=state[key])
+    return state, deltas, results
+
+
+def _write_votes(user, content_type_ids, existing, state):
+    """Пишет в Echo только итог пачки: массовые удаление, переключение и вставка."""
+    to_delete, to_create, to_switch = [], [], {True: [], False: []}
+    for key, vote in state.items():
+        old_echo = existing.get(key)
+        old_vote = old_echo.is_echo if old_echo else None
+        if vote == old_vote:
+            continue
+        if vote is None:
+            to_delete.append(old_echo.pk)
+        elif old_echo is None:
+            to_create.append(Echo(
+                user=user, content_type_id=content_type_ids[key[0]], object_id=key[1], is_echo=vote
+            ))
+        else:
+            to_switch[vote].append(old_echo.pk)
+
+    if to_delete:
+        Echo.objects.filter(pk__in=to_delete).delete()
+    for vote, pks in to_switch.items():
+        if pks:
+            Echo.objects.filter(pk__in=pks).update(is_echo=vote)
+    if to_create:
+        # Без ignore_conflicts: чужая вставка должна откатить пачку на перечитывание
+        Echo.objects.bulk_create(to_create)
+
+
+def toggle_many(user, operations):
+    """
+    Применяет пачку нажатий одной транзакцией (клиент досылает голоса после офлайна).
+
+    operations - список dict(content_type, id, is_echo) в порядке нажатий;
+    повторное нажатие на тот же объект внутри пачки отменяет оценку, как и по одному.
+
+    Возвращает результаты в том же порядке: dict(content_type, id, status) со
+    status 'ok', 'not_found' или 'rejected'. У 'ok' есть my_vote и object -
+    объект с актуальными счетчиками, у 'rejected' - error.
+    """
+    ids_by_model = defaultdict(set)
+    for op in operations:
+        ids_by_model[op['content_type']].add(op['id'])
+
+    objects = {}
+    for model_name, ids in ids_by_model.items():
+        for obj in VOTE_MODELS[model_name].objects.filter(pk__in=ids).only(*VOTE_FIELDS):
+            objects[(model_name, obj.pk)] = obj
+
+    content_type_ids = _content_type_ids(ids_by_model)
+    model_by_content_type = {ct_id: model_name for model_name, ct_id in content_type_ids.items()}
+
+    with transaction.atomic():
+        for attempt in range(BATCH_CONFLICT_RETRIES):
+            existing = {
+                (model_by_content_type[echo.content_type_id], echo.object_id): echo
+                for echo in Echo.objects.select_for_update()
+                .filter(_echo_lookup(content_type_ids, ids_by_model), user=user)
+                .only('id', 'content_type_id', 'object_id', 'is_echo')
+            }
+            state, deltas, results = _replay(user, operations, objects, existing)
+            try:
+                with transaction.atomic():
+                    _write_votes(user, content_type_ids, existing, state)
+                break
+            except IntegrityError:
+                # Параллельный запрос успел вставить оценку одного из объектов:
+                # перечитываем оценки (теперь их есть что блокировать) и
+                # пересчитываем приращения от настоящего прежнего состояния
+                if attempt == BATCH_CONFLICT_RETRIES - 1:
+                    raise
+
+        for model_name, model_deltas in deltas.items():
+            counters.record_many(
+                VOTE_MODELS[model_name], {pk: tuple(delta) for pk, delta in model_deltas.items()}
+            )
+
+    # Перечитываем объекты с новыми счетчиками (по запросу на модель)
+    for model_name, model_deltas in deltas.items():
+        for obj in VOTE_MODELS[model_name].objects.filter(pk__in=model_deltas).only(*VOTE_FIELDS):
+            objects[(model_name, obj.pk)] = obj
+    counters.merge_pending([objects[model_name, pk] for model_name, model_deltas in deltas.items() for pk in model_deltas])
+
+    for result in results:
+        if result['status'] == 'ok':
+            key = (result['content_type'], result['id'])
+            result['object'] = objects[key]
+            objects[key].my_vote = state[key]
+    return results
+
+
+# -------------------- Оценки пользователя в лентах --------------------
+
+def load_my_votes(user, instances):
+    """
+    Заполняет my_vote (True, False или None) у постов и комментариев одним
+    запросом к Echo на всю страницу. Объекты, у которых my_vote уже есть, пропускаются.
+    """
+    pending = [obj for obj in instances if not hasattr(obj, 'my_vote')]
+    if not pending:
+        return
+    if user is None or not user.is_authenticated:
+        for obj in pending:
+            obj.my_vote = None
+        return
+
+    ids_by_model = defaultdict(set)
+    for obj in pending:
+        ids_by_model[obj._meta.model_name].add(obj.pk)
+    content_type_ids = _content_type_ids(ids_by_model)
+    model_by_content_type = {ct_id: model_name for model_name, ct_id in content_type_ids.items()}
+
+    # Покрывающий индекс uniq_echo_user_object: запрос не читает таблицу
+    found = {
+        (model_by_content_type[content_type_id], object_id): is_echo
+        for content_type_id, object_id, is_echo in Echo.objects
+        .filter(_echo_lookup(content_type_ids, ids_by_model), user=user)
+        .values_list('content_type_id', 'object_id', 'is_echo')
+    }
+    for obj in pending:
+        obj.my_vote = found.get((obj._meta.model_name, obj.pk))
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import Friend
+from .services import invalidate_friend_ids
 
 @admin.register(Friend)
 class FriendAdmin(admin.ModelAdmin):
@@ -27,17 +28,23 @@ class FriendAdmin(admin.ModelAdmin):
     actions = ['make_accepted', 'make_rejected', 'make_pending']
     
     def make_accepted(self, request, queryset):
-        queryset.update(status='accepted')
+        self._update_status(queryset, 'accepted')
     make_accepted.short_description = "Изменить статус на 'Подтверждено'"
     
     def make_rejected(self, request, queryset):
-        queryset.update(status='rejected')
+        self._update_status(queryset, 'rejected')
     make_rejected.short_description = "Изменить статус на 'Отклонено'"
     
     def make_pending(self, request, queryset):
-        queryset.update(status='pending')
+        self._update_status(queryset, 'pending')
     make_pending.short_description = "Изменить статус на 'Ожидает подтверждения'"
     
+    def _update_status(self, queryset, status):
+        # update() не шлет сигналы, поэтому граф друзей сбрасываем вручную
+        pairs = list(queryset.values_list('sender_id', 'receiver_id'))
+        queryset.update(status=status)
+        invalidate_friend_ids(*{user_id for pair in pairs for user_id in pair})
+    
     # Оптимизация запросов для отображения в списке
     def get_queryset(self, request):
         qs = super().get_queryset(request)
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.dispatch import Signal
+
+from .models import Friend
+
+FRIEND_IDS_KEY = 'friends:ids:{user_id}'
+
+# Отправляется после сброса графа; аргумент user_ids - затронутые пользователи
+friend_graph_changed = Signal()
+
+
+def get_friend_ids(user_id):
+    """
+    Возвращает множество id подтвержденных друзей пользователя.
+
+    Граф дружбы материализован в кэше: один запрос к Friend на пользователя,
+    пока запись не будет сброшена сигналом (см. friends_api/signals.py).
+    """
+    key = FRIEND_IDS_KEY.format(user_id=user_id)
+    friend_ids = cache.get(key)
+    if friend_ids is None:
+        rows = Friend.objects.filter(
+            Q(sender_id=user_id) | Q(receiver_id=user_id),
+            status='accepted',
+        ).values_list('sender_id', 'receiver_id')
+        friend_ids = {receiver if sender == user_id else sender for sender, receiver in rows}
+        cache.set(key, friend_ids, settings.FRIEND_GRAPH_CACHE_TIMEOUT)
+    return friend_ids
+
+
+def invalidate_friend_ids(*user_ids):
+    """Сбрасывает закэшированный список друзей у указанных пользователей."""
+    cache.delete_many([FRIEND_IDS_KEY.format(user_id=user_id) for user_id in user_ids])
+    friend_graph_changed.send(sender=Friend, user_ids=user_ids)
@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Friend
+from .services import invalidate_friend_ids
+
+
+@receiver(post_save, sender=Friend)
+@receiver(post_delete, sender=Friend)
+def reset_friend_graph(sender, instance, **kwargs):
+    """Любое изменение запроса дружбы меняет граф у обеих сторон."""
+    # После коммита: иначе параллельное чтение успеет закэшировать старый граф
+    user_ids = (instance.sender_id, instance.receiver_id)
+    transaction.on_commit(lambda: invalidate_friend_ids(*user_ids))
@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class MessengerApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'backend.messenger_api'
\ No newline at end of file
+    name = 'backend.messenger_api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
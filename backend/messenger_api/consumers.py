@@ -1,186 +1,315 @@
+import asyncio
 import json
+import logging
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.utils import timezone
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from rest_framework import serializers
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
-from django.db.models import Q # Для более чистой проверки доступа
+from bson.errors import InvalidId
 
-# Импорты для сохранения
-from .serializers import MessageSerializer 
-from .models import Chat 
+from . import ingest, membership, receipts, senders
+from .mongo_models import MongoMessage
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
+# Тот же формат времени, что у MessageSerializer.timestamp
+_timestamp_field = serializers.DateTimeField()
+
+
+def message_data(message, sender):
+    return {
+        'id': str(message.id),
+        'chat_id': int(message.chat_id),
+        'sender_id': message.sender_id,
+        'timestamp': _timestamp_field.to_representation(message.timestamp),
+        'text': message.text,
+        'sender': sender,
+    }
+
 
-# 1. Синхронная функция для сохранения сообщения
-@database_sync_to_async
-def save_message_and_get_data(chat_id, text, user):
+class ChatMessagingMixin:
     """
-    Выполняет синхронное сохранение сообщения в MongoDB 
-    через MessageSerializer и возвращает сериализованные данные.
+    Общее для ChatConsumer и MessengerConsumer: отправка сообщения в чат и
+    отметка о прочтении. Нужны self.user, self.sender и self.pending.
     """
-    
-    # 1. Создаем фиктивный объект запроса для контекста Serializer
-    class MockRequest:
-        def __init__(self, user):
-            self.user = user
-            self.method = 'POST' 
-            
-    mock_request = MockRequest(user)
-    
-    # 2. Подготовка данных и контекста
-    data = {'text': text}
-    context = {
-        'chat_id': chat_id, # Значение для MessageSerializer.create из context
-        'request': mock_request, # Значение для получения sender_id из context['request']
-    }
-    
-    # 3. Валидация и сохранение
-    serializer = MessageSerializer(data=data, context=context)
-    
-    if serializer.is_valid(raise_exception=True):
-        serializer.save() 
-        
-        # 4. Возвращаем сериализованные данные для рассылки
-        return serializer.data
-    
-    return None
-
-# 2. Синхронная функция для проверки доступа к чату
-@database_sync_to_async
-def get_chat_and_check_access(chat_id, user):
-    """Проверяет, существует ли чат и является ли пользователь его участником."""
-    if user.is_anonymous:
-        return False
-    try:
-        # Ищем чат, в котором пользователь является участником
-        chat = Chat.objects.filter(
-            Q(pk=chat_id) & Q(participants__pk=user.pk)
-        ).first()
-        
-        return chat is not None
-        
-    except Exception:
-        return False
-
-
-class ChatConsumer(AsyncWebsocketConsumer):
+
+    async def post_message(self, chat_id, text):
+        """Проверяет сообщение, рассылает его группе чата и параллельно сохраняет."""
+        text = text.strip() if isinstance(text, str) else ''
+        if not text:
+            return
+        if len(text) > settings.CHAT_MESSAGE_MAX_LENGTH:
+            await self.send_event('message_rejected', chat_id=chat_id, error='Сообщение слишком длинное.')
+            return
+
+        message = MongoMessage(chat_id=chat_id, sender_id=self.user.id, text=text)
+        data = message_data(message, self.sender)
+
+        # Ждем только места в очереди записи (обратное давление), не саму запись
+        durable = await ingest.get_ingester().submit(message)
+        task = asyncio.create_task(self.confirm(message, durable))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+        await self.channel_layer.group_send(
+            membership.chat_group_name(chat_id),
+            {'type': 'chat_message', 'message': data},
+        )
+
+    async def confirm(self, message, durable):
+        try:
+            await durable
+        except Exception:
+            logger.exception("Сообщение %s в чат %s не сохранено", message.id, message.chat_id)
+            # Сообщение уже разослано всей группе - отзываем его у всех участников
+            chat_id = int(message.chat_id)
+            try:
+                await self.channel_layer.group_send(
+                    membership.chat_group_name(chat_id),
+                    {'type': 'message_failed', 'chat_id': chat_id, 'id': str(message.id)},
+                )
+            except Exception:
+                logger.exception("Не удалось отозвать сообщение %s в чате %s", message.id, chat_id)
+
+    async def mark_read(self, chat_id, message_id):
+        """Двигает курсор прочтения (messenger_api/receipts.py)."""
+        try:
+            await database_sync_to_async(receipts.mark_read)(chat_id, self.user.id, message_id)
+        except (InvalidId, TypeError, receipts.UnknownMessage):
+            await self.send_event('read_rejected', chat_id=chat_id, error='Неверный message_id.')
+        except ConnectionError:
+            await self.send_event('read_rejected', chat_id=chat_id, error='База сообщений недоступна.')
+
+    async def wait_pending(self):
+        # Не теряем сообщения, которые еще пишутся в базу
+        if getattr(self, 'pending', None):
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+    async def send_event(self, event_type, **fields):
+        await self.send(text_data=json.dumps({'type': event_type, **fields}))
+
+    async def message_failed(self, event):
+        """Разосланное сообщение не сохранилось - клиенты убирают его по id."""
+        await self.send_event('message_failed', chat_id=event['chat_id'], id=event['id'])
+
+    async def read_receipt(self, event):
+        """Участник прочитал чат до message_id."""
+        await self.send_event(
+            'read_receipt', chat_id=event['chat_id'], user_id=event['user_id'], message_id=event['message_id'],
+        )
+
+
+class ChatConsumer(ChatMessagingMixin, AsyncWebsocketConsumer):
+    """
+    Чат в реальном времени: ws/chat/<chat_id>/?token=<JWT>.
+
+    Сообщение получает id (ObjectId) на сервере и рассылается группе сразу, а
+    запись в MongoDB идет в фоне пачками вместе с сообщениями других чатов
+    (messenger_api/ingest.py). Если запись не удалась, всей группе
+    приходит кадр {"type": "message_failed", "id": ...}. Служебные
+    кадры всегда несут поле type, сообщения чата - нет.
+
+    Участие в чате проверяется по кэшу (messenger_api/membership.py) один раз
+    на подключение; удаленный из чата участник отключается событием members_removed.
+
+    Кадр {"type": "read", "message_id": ...} двигает курсор прочтения
+    (messenger_api/receipts.py), группа получает {"type": "read_receipt", ...}.
+
+    Для нескольких чатов сразу - MessengerConsumer (один сокет на пользователя).
+    """
+
     async def connect(self):
-        print("--- CONSUMER: Attempting connection ---")
-        
         # Аутентификация
         self.user = self.scope.get("user", AnonymousUser())
         if not self.user.is_authenticated:
-            print("--- CONSUMER: User not authenticated, closing connection ---")
-
             await self.authenticate_via_token()
-        
+
         # Получаем ID чата из URL
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.chat_group_name = f'chat_{self.chat_id}'
-        
+        self.chat_id = int(self.scope['url_route']['kwargs']['chat_id'])
+        self.chat_group_name = membership.chat_group_name(self.chat_id)
+        self.pending = set()
+
         if not self.user.is_authenticated:
-            print("--- CONSUMER: User not authenticated, closing connection ---")
+            logger.info("WS чата %s: пользователь не аутентифицирован", self.chat_id)
             await self.close(code=4003)
             return
 
         try:
-            # Проверка доступа к чату
-            chat_can_access = await get_chat_and_check_access(self.chat_id, self.user)
-            
-            if not chat_can_access:
-                print("--- CONSUMER: Chat access denied or chat does not exist ---")
+            if not await membership.ais_member(self.chat_id, self.user.id):
+                logger.info("WS чата %s: нет доступа у пользователя %s", self.chat_id, self.user.id)
                 await self.close(code=4003)
                 return
-                
-            await self.accept() 
-            print(f"--- CONSUMER: Accepted. Joining group: {self.chat_group_name} ---")
 
-            await self.channel_layer.group_add(
-                self.chat_group_name,
-                self.channel_name
-            )
-            print(f"--- CONSUMER: Successfully added to group {self.chat_group_name} ---")
-            
-        except Exception as e:
-            print(f"--- CONSUMER ERROR IN CONNECT: {e} ---")
+            # Профиль берется из пользователя подключения, без запроса к базе
+            self.sender = senders.profile(self.user)
+            await self.channel_layer.group_add(self.chat_group_name, self.channel_name)
+            await self.accept()
+        except Exception:
+            logger.exception("WS чата %s: ошибка подключения", self.chat_id)
             await self.close(code=4999)
-    
+
     async def authenticate_via_token(self):
         """Аутентификация через JWT токен из query string"""
         try:
+            # Как MediaServer._token: значения с '=' и %-кодированием разбираются верно
             query_string = self.scope.get('query_string', b'').decode('utf-8')
-            params = dict(param.split('=') for param in query_string.split('&') if '=' in param)
-            token = params.get('token')
-            
+            token = parse_qs(query_string).get('token', [None])[0]
+
             if token:
                 access_token = AccessToken(token)
                 user_id = access_token['user_id']
                 self.user = await self.get_user(user_id)
-                print(f"--- CONSUMER: Authenticated user: {self.user} ---")
             else:
                 self.user = AnonymousUser()
         except Exception as e:
-            print(f"--- CONSUMER: Token authentication failed: {e} ---")
+            logger.info("WS: токен не принят: %s", e)
             self.user = AnonymousUser()
-    
+
     @database_sync_to_async
     def get_user(self, user_id):
         try:
             return User.objects.get(id=user_id)
         except User.DoesNotExist:
             return AnonymousUser()
-            
+
     async def disconnect(self, close_code):
         if hasattr(self, 'chat_group_name'):
             await self.channel_layer.group_discard(
                 self.chat_group_name,
                 self.channel_name
             )
-        print(f"--- CONSUMER: Disconnected with code: {close_code} ---")
-    
-    # 3. Обновленный метод receive
+        await self.wait_pending()
+
     async def receive(self, text_data):
-        """Обрабатывает сообщения от клиента: сохраняет в БД, затем рассылает."""
+        try:
+            payload = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(payload, dict):
+            return
+        if payload.get('type') == 'read':
+            await self.mark_read(self.chat_id, payload.get('message_id'))
+            return
+        await self.post_message(self.chat_id, payload.get('text'))
+
+    async def chat_message(self, event):
+        """Обрабатывает сообщения из группы и отправляет клиенту"""
+        await self.send(text_data=json.dumps(event['message']))
+
+    async def members_removed(self, event):
+        """Пользователя удалили из чата - закрываем его подключение."""
+        if self.user.id in event['user_ids']:
+            await self.close(code=4003)
+
+
+class MessengerConsumer(ChatMessagingMixin, AsyncWebsocketConsumer):
+    """
+    Все чаты пользователя в одном сокете: ws/messenger/?token=<JWT>.
+
+    Пользователь аутентифицируется один раз (TokenAuthMiddleware), при
+    подключении сокет подписывается на группы его последних
+    CHAT_MUX_MAX_CHATS чатов и на личную группу user_<id>, куда приходят
+    события о добавлении в новые чаты. Каждый кадр несет chat_id.
+
+    Клиент -> сервер:
+        {"type": "subscribe" | "unsubscribe", "chat_id": ...}
+        {"type": "message", "chat_id": ..., "text": ...}
+        {"type": "read", "chat_id": ..., "message_id": ...}
+    Сервер -> клиент:
+        {"type": "message", "chat_id": ..., ...поля сообщения}
+        {"type": "subscribed" | "unsubscribed", "chat_ids": [...]}
+        read_receipt, message_failed, message_rejected, read_rejected, error
+    """
+
+    async def connect(self):
+        self.user = self.scope.get('user', AnonymousUser())
+        self.chat_ids = set()
+        self.pending = set()
         if not self.user.is_authenticated:
-            return 
-            
+            await self.close(code=4003)
+            return
+
         try:
-            text_data_json = json.loads(text_data)
-            message_text = text_data_json.get('text', '').strip()
-            
-            if not message_text:
+            self.sender = senders.profile(self.user)
+            self.user_group_name = membership.user_group_name(self.user.id)
+            await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+            await self.accept()
+
+            chat_ids = await membership.auser_chat_ids(self.user.id, settings.CHAT_MUX_MAX_CHATS)
+            await asyncio.gather(*(self.join(chat_id) for chat_id in chat_ids))
+            await self.send_event('subscribed', chat_ids=sorted(self.chat_ids))
+        except Exception:
+            logger.exception("WS мессенджера: ошибка подключения пользователя %s", self.user.id)
+            await self.close(code=4999)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'user_group_name'):
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        await asyncio.gather(*(self.leave(chat_id) for chat_id in list(self.chat_ids)))
+        await self.wait_pending()
+
+    async def join(self, chat_id):
+        self.chat_ids.add(chat_id)
+        await self.channel_layer.group_add(membership.chat_group_name(chat_id), self.channel_name)
+
+    async def leave(self, chat_id):
+        self.chat_ids.discard(chat_id)
+        await self.channel_layer.group_discard(membership.chat_group_name(chat_id), self.channel_name)
+
+    async def subscribe(self, chat_id):
+        if chat_id not in self.chat_ids:
+            if len(self.chat_ids) >= settings.CHAT_MUX_MAX_CHATS:
+                await self.send_event('error', chat_id=chat_id, error='Слишком много подписок.')
                 return
-                
-            print(f"--- CONSUMER: Attempting to save message from user {self.user.id}: {message_text} ---")
-            
-            # Главный шаг: Сохранение сообщения в MongoDB
-            response_data = await save_message_and_get_data(
-                chat_id=self.chat_id, 
-                text=message_text, 
-                user=self.user
-            )
-            
-            if response_data:
-                print(f"--- CONSUMER: Message saved. Sending to group... ---")
-                
-                # Отправляем сериализованные данные в группу
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': response_data
-                    }
-                )
-                
-        except Exception as e:
-            # Обязательно выводим ошибку, чтобы увидеть, что произошло
-            print(f"--- CONSUMER FATAL ERROR IN RECEIVE (Saving failed): {e} ---")
-    
+            if not await membership.ais_member(chat_id, self.user.id):
+                await self.send_event('error', chat_id=chat_id, error='Нет доступа к чату.')
+                return
+            await self.join(chat_id)
+        await self.send_event('subscribed', chat_ids=[chat_id])
+
+    async def receive(self, text_data):
+        try:
+            payload = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(payload, dict):
+            return
+        kind = payload.get('type')
+        try:
+            chat_id = int(payload.get('chat_id'))
+        except (TypeError, ValueError):
+            await self.send_event('error', error='Неверный chat_id.')
+            return
+
+        if kind == 'subscribe':
+            await self.subscribe(chat_id)
+        elif kind == 'unsubscribe':
+            await self.leave(chat_id)
+            await self.send_event('unsubscribed', chat_ids=[chat_id])
+        elif chat_id not in self.chat_ids:
+            # Участие проверено при подписке; без нее писать и читать нельзя
+            await self.send_event('error', chat_id=chat_id, error='Нет подписки на чат.')
+        elif kind == 'message':
+            await self.post_message(chat_id, payload.get('text'))
+        elif kind == 'read':
+            await self.mark_read(chat_id, payload.get('message_id'))
+
     async def chat_message(self, event):
-        """Обрабатывает сообщения из группы и отправляет клиенту"""
-        message = event['message']
-        # Отправляем сообщение обратно клиенту
-        await self.send(text_data=json.dumps(message))
\ No newline at end of file
+        await self.send(text_data=json.dumps({'type': 'message', **event['message']}))
+
+    async def members_removed(self, event):
+        """Пользователя удалили из чата - отписываем сокет только от этого чата."""
+        if self.user.id in event['user_ids']:
+            await self.leave(event['chat_id'])
+            await self.send_event('unsubscribed', chat_ids=[event['chat_id']])
+
+    async def chat_joined(self, event):
+        """Пользователя добавили в чат (личная группа) - подписываемся."""
+        await self.subscribe(event['chat_id'])
@@ -0,0 +1,188 @@
+"""
+Пакетная запись сообщений чатов в MongoDB.
+
+Консьюмеры всех чатов процесса кладут сообщения в общую очередь, а писатель
+собирает из нее пачки - до CHAT_INGEST_BATCH_SIZE сообщений или
+CHAT_INGEST_FLUSH_INTERVAL секунд с первого сообщения пачки - и пишет каждую
+одним insert_many(ordered=False). Каждый отправитель получает future,
+которая завершается, когда пачка с его сообщением записана.
+
+Обратное давление: очередь ограничена CHAT_INGEST_QUEUE_SIZE, одновременно
+пишется не больше CHAT_INGEST_MAX_IN_FLIGHT пачек. Если MongoDB тормозит,
+submit() ждет места в очереди, консьюмер перестает читать сокет, и клиентов
+сдерживает уже TCP.
+
+Раз в CHAT_INGEST_METRICS_INTERVAL секунд писатель логирует metrics() на
+уровне INFO. При остановке сервера (Daphne отменяет консьюмеров, не дожидаясь
+записи) drain() дописывает очередь и пачки в полете и сбрасывает последние
+сообщения чатов.
+"""
+import asyncio
+import logging
+import sys
+import time
+import weakref
+
+from django.conf import settings
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from . import last_message
+from .mongo_models import AsyncMongoConnection
+
+logger = logging.getLogger(__name__)
+
+# Ошибка записи дубликата: сообщение с этим _id уже в базе
+DUPLICATE_KEY = 11000
+
+
+class MessageIngester:
+    """Очередь и писатель пачек; по одному на событийный цикл (get_ingester)."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=settings.CHAT_INGEST_QUEUE_SIZE)
+        self.in_flight = asyncio.Semaphore(settings.CHAT_INGEST_MAX_IN_FLIGHT)
+        self.writes = set()
+        self.worker = None
+        self.reported = time.monotonic()
+        self.stats = {
+            'batches': 0, 'messages': 0, 'failed': 0,
+            'max_batch_size': 0, 'last_batch_size': 0, 'last_write_ms': 0.0,
+        }
+
+    def metrics(self):
+        """Счетчики писателя плюс текущие глубина очереди и число пишущихся пачек."""
+        batches = self.stats['batches']
+        return {
+            **self.stats,
+            'queue_depth': self.queue.qsize(),
+            'in_flight': len(self.writes),
+            'avg_batch_size': round(self.stats['messages'] / batches, 1) if batches else 0,
+        }
+
+    async def submit(self, message):
+        """
+        Ставит сообщение в очередь (ждет, если очередь полна) и возвращает
+        future, которая завершится, когда сообщение будет записано.
+        """
+        self.start()
+        durable = asyncio.get_running_loop().create_future()
+        await self.queue.put((message.to_document(), durable))
+        return durable
+
+    def start(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+    async def drain(self):
+        """Дожидается записи всего, что уже в очереди, и останавливает писателя."""
+        if not self.queue.empty():
+            self.start()
+        await self.queue.join()
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        await last_message.get_updater().drain()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + settings.CHAT_INGEST_FLUSH_INTERVAL
+            while len(batch) < settings.CHAT_INGEST_BATCH_SIZE:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Пока все пачки в полете, новые копятся в очереди (обратное давление)
+            await self.in_flight.acquire()
+            task = asyncio.create_task(self.write(batch))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    async def write(self, batch):
+        started = time.monotonic()
+        failed = {}
+        try:
+            await self.insert([document for document, _ in batch])
+        except BulkWriteError as exc:
+            for error in exc.details.get('writeErrors', []):
+                if error.get('code') != DUPLICATE_KEY:
+                    failed[error['index']] = ConnectionError(error.get('errmsg', 'Ошибка записи'))
+        except Exception as exc:
+            # Любая другая ошибка - пачка не записана; future должны завершиться в любом случае
+            if not isinstance(exc, (PyMongoError, ConnectionError)):
+                logger.exception("Сбой записи пачки сообщений")
+            failed = {index: ConnectionError(str(exc)) for index in range(len(batch))}
+        finally:
+            self.in_flight.release()
+
+        for index, (_, durable) in enumerate(batch):
+            if durable.done():
+                continue
+            if index in failed:
+                durable.set_exception(failed[index])
+            else:
+                durable.set_result(None)
+        for _ in batch:
+            self.queue.task_done()
+        last_message.get_updater().record(
+            document for index, (document, _) in enumerate(batch) if index not in failed
+        )
+
+        duration_ms = (time.monotonic() - started) * 1000
+        self.stats['batches'] += 1
+        self.stats['messages'] += len(batch)
+        self.stats['failed'] += len(failed)
+        self.stats['last_batch_size'] = len(batch)
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+        self.stats['last_write_ms'] = round(duration_ms, 2)
+        logger.debug(
+            "Пачка сообщений: size=%s failed=%s queue_depth=%s duration_ms=%.1f",
+            len(batch), len(failed), self.queue.qsize(), duration_ms,
+        )
+        if failed:
+            logger.error("Не записано %s сообщений из пачки %s", len(failed), len(batch))
+        if time.monotonic() - self.reported >= settings.CHAT_INGEST_METRICS_INTERVAL:
+            self.reported = time.monotonic()
+            logger.info("Запись сообщений: %s", self.metrics())
+
+    async def insert(self, documents):
+        collection = await AsyncMongoConnection.get_collection()
+        await collection.insert_many(documents, ordered=False)
+
+
+_ingesters = weakref.WeakKeyDictionary()
+
+
+def get_ingester():
+    """Писатель текущего событийного цикла."""
+    loop = asyncio.get_running_loop()
+    ingester = _ingesters.get(loop)
+    if ingester is None:
+        ingester = _ingesters[loop] = MessageIngester()
+        drain_on_shutdown(ingester)
+    return ingester
+
+
+def drain_on_shutdown(ingester):
+    """
+    Под Daphne дописывает очередь перед остановкой реактора Twisted: при
+    остановке Daphne отменяет консьюмеров, и их wait_pending() не выполняется.
+    """
+    if 'twisted.internet.reactor' not in sys.modules:
+        return
+    from twisted.internet import defer, reactor
+    if not reactor.running:
+        return
+
+    def drain():
+        return defer.Deferred.fromFuture(asyncio.ensure_future(ingester.drain()))
+
+    reactor.addSystemEventTrigger('before', 'shutdown', drain)
@@ -0,0 +1,120 @@
+"""
+Последнее сообщение чата (Chat.last_message_text / last_message_date).
+
+Сообщения из WebSocket не трогают строку Chat на каждое сообщение: писатель
+пачек (messenger_api/ingest.py) после записи в MongoDB отдает их
+LastMessageUpdater, который держит в памяти последнее сообщение каждого чата
+и раз в CHAT_LAST_MESSAGE_FLUSH_INTERVAL секунд переносит все накопленное в
+базу одним UPDATE (apply). Сколько бы сообщений ни пришло в чат за интервал,
+его строка обновляется не больше одного раза.
+
+UPDATE условный: более старое сообщение не затирает более новое, поэтому
+несколько процессов Daphne могут сбрасывать свои данные в любом порядке.
+"""
+import asyncio
+import logging
+import weakref
+from datetime import timezone as dt_timezone
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from .models import Chat
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = Chat._meta.get_field('last_message_text').max_length
+
+
+def preview(document):
+    """(дата, текст) для Chat из документа сообщения MongoDB."""
+    date = document['timestamp']
+    if timezone.is_naive(date):
+        # MongoMessage хранит время в UTC без зоны
+        date = timezone.make_aware(date, dt_timezone.utc)
+    return date, document['text'][:PREVIEW_LENGTH]
+
+
+def apply(latest):
+    """
+    Переносит последние сообщения в Chat одним UPDATE.
+
+    latest - {chat_id: (дата, текст)}. Строка меняется, только если ее
+    last_message_date старше. Возвращает число обновленных чатов.
+    """
+    if not latest:
+        return 0
+
+    def by_chat(index, field):
+        whens = [
+            When(pk=chat_id, last_message_date__lt=values[0], then=Value(values[index]))
+            for chat_id, values in latest.items()
+        ]
+        return Case(*whens, default=F(field), output_field=Chat._meta.get_field(field))
+
+    return Chat.objects.filter(pk__in=latest).update(
+        last_message_date=by_chat(0, 'last_message_date'),
+        last_message_text=by_chat(1, 'last_message_text'),
+    )
+
+
+class LastMessageUpdater:
+    """Последние сообщения чатов, ждущие сброса; по одному на событийный цикл."""
+
+    def __init__(self):
+        self.latest = {}
+        self.flusher = None
+
+    def record(self, documents):
+        """Запоминает записанные сообщения; сброс в базу - не позже чем через интервал."""
+        for document in documents:
+            chat_id = int(document['chat_id'])
+            date, text = preview(document)
+            current = self.latest.get(chat_id)
+            if current is None or current[0] <= date:
+                self.latest[chat_id] = (date, text)
+
+        if self.latest and (self.flusher is None or self.flusher.done()):
+            self.flusher = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.latest:
+            await asyncio.sleep(settings.CHAT_LAST_MESSAGE_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def drain(self):
+        """Сбрасывает накопленное сразу, не дожидаясь интервала."""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        if self.latest:
+            await self.flush()
+
+    async def flush(self):
+        latest, self.latest = self.latest, {}
+        try:
+            updated = await database_sync_to_async(apply)(latest)
+        except DatabaseError:
+            logger.exception("Не удалось обновить последние сообщения %s чатов", len(latest))
+            # Вернем на следующий сброс, если за это время не пришло более новое
+            for chat_id, values in latest.items():
+                current = self.latest.get(chat_id)
+                if current is None or current[0] < values[0]:
+                    self.latest[chat_id] = values
+            return
+        logger.debug("Последние сообщения: chats=%s updated=%s", len(latest), updated)
+
+
+_updaters = weakref.WeakKeyDictionary()
+
+
+def get_updater():
+    """Обновитель текущего событийного цикла."""
+    loop = asyncio.get_running_loop()
+    updater = _updaters.get(loop)
+    if updater is None:
+        updater = _updaters[loop] = LastMessageUpdater()
+    return updater
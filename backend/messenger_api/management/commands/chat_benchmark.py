@@ -0,0 +1,106 @@
+import asyncio
+import statistics
+import time
+import uuid
+from contextlib import ExitStack
+from unittest import mock
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backend.config.asgi import application
+from backend.messenger_api import ingest
+from backend.messenger_api.models import Chat
+
+User = get_user_model()
+
+# Емкость по умолчанию (100) переполняется на первой же волне рассылки
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}}}
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест ChatConsumer в одном процессе (как один Daphne): '
+        'сообщений в секунду и задержка от отправки до получения всеми участниками'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=10, help='Участников чата, каждый со своим сокетом')
+        parser.add_argument('--messages', type=int, default=100, help='Сообщений от каждого участника')
+        parser.add_argument('--redis', action='store_true', help='Слой каналов из настроек вместо InMemoryChannelLayer')
+        parser.add_argument('--no-persist', action='store_true', help='Не писать сообщения в MongoDB')
+
+    def handle(self, *args, **options):
+        prefix = f'chatbench_{uuid.uuid4().hex[:8]}'
+        users = [User.objects.create(username=f'{prefix}_{i}') for i in range(options['clients'])]
+        chat = Chat.objects.create(is_group=True, name=prefix)
+        chat.participants.set(users)
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+
+        try:
+            with ExitStack() as stack:
+                if not options['redis']:
+                    stack.enter_context(override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER))
+                if options['no_persist']:
+                    stack.enter_context(mock.patch.object(ingest.MessageIngester, 'insert', autospec=True))
+                sent, elapsed, latencies, metrics = asyncio.run(self.run(chat.pk, tokens, options['messages']))
+        finally:
+            chat.delete()
+            User.objects.filter(username__startswith=prefix).delete()
+
+        delivered = len(latencies)
+        latencies.sort()
+        self.stdout.write(f'{len(users)} участников, {sent} сообщений, {delivered} доставок за {elapsed:.2f} с')
+        self.stdout.write(f'{sent / elapsed:10.1f} сообщений/с, {delivered / elapsed:10.1f} доставок/с')
+        if latencies:
+            p50 = statistics.median(latencies)
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            p99 = latencies[int(len(latencies) * 0.99) - 1]
+            self.stdout.write(f'задержка, мс: p50={p50:.2f} p95={p95:.2f} p99={p99:.2f} max={latencies[-1]:.2f}')
+        self.stdout.write(
+            'запись: пачек={batches} сообщений={messages} ошибок={failed} '
+            'средняя пачка={avg_batch_size} максимальная={max_batch_size}'.format(**metrics)
+        )
+
+    async def run(self, chat_id, tokens, messages):
+        communicators = []
+        for token in tokens:
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{chat_id}/?token={token}')
+            connected, code = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'Подключение отклонено: {code}')
+            communicators.append(communicator)
+
+        expected = len(tokens) * messages
+        sent_at = {}
+        latencies = []
+
+        async def read(communicator):
+            received = 0
+            while received < expected:
+                frame = await communicator.receive_json_from(timeout=30)
+                if 'type' in frame:
+                    continue
+                latencies.append((time.perf_counter() - sent_at[frame['text']]) * 1000)
+                received += 1
+
+        async def write(index, communicator):
+            for seq in range(messages):
+                text = f'bench {index} {seq}'
+                sent_at[text] = time.perf_counter()
+                await communicator.send_json_to({'text': text})
+                # Отдаем цикл, как при настоящей сети
+                await asyncio.sleep(0)
+
+        started = time.perf_counter()
+        readers = [asyncio.create_task(read(communicator)) for communicator in communicators]
+        await asyncio.gather(*(write(index, communicator) for index, communicator in enumerate(communicators)))
+        await asyncio.gather(*readers)
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        return expected, elapsed, latencies, ingest.get_ingester().metrics()
@@ -0,0 +1,106 @@
+"""
+Кэш участников чатов для WebSocket-подключений.
+
+Список участников чата лежит в кэше (chat:<id>:members) и сбрасывается
+сигналом m2m_changed при любом изменении Chat.participants
+(MemberManagementViewSet, создание чата, админка). Удаленным участникам в
+группу чата уходит событие members_removed - их открытые сокеты закрываются
+(или отписываются от чата, если это общий сокет MessengerConsumer), а
+добавленным в личную группу user_<id> - chat_joined.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+from .models import Chat
+
+logger = logging.getLogger(__name__)
+
+MEMBERS_KEY = 'chat:{chat_id}:members'
+
+# Ошибки кэша и слоя каналов, при которых работаем напрямую с базой
+MEMBERSHIP_ERRORS = (RedisError, ConnectionInterrupted, OSError)
+
+
+def chat_group_name(chat_id):
+    return f'chat_{chat_id}'
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def get_member_ids(chat_id):
+    """Множество id участников чата (пустое, если чата нет)."""
+    key = MEMBERS_KEY.format(chat_id=chat_id)
+    try:
+        member_ids = cache.get(key)
+    except MEMBERSHIP_ERRORS:
+        member_ids = None
+    if member_ids is not None:
+        return member_ids
+
+    member_ids = frozenset(Chat.participants.through.objects.filter(chat_id=chat_id).values_list('customuser_id', flat=True))
+    try:
+        cache.set(key, member_ids, timeout=settings.CHAT_MEMBERS_CACHE_TIMEOUT)
+    except MEMBERSHIP_ERRORS:
+        logger.warning("Не удалось закэшировать участников чата %s", chat_id)
+    return member_ids
+
+
+def is_member(chat_id, user_id):
+    return user_id in get_member_ids(chat_id)
+
+
+ais_member = database_sync_to_async(is_member)
+
+
+def user_chat_ids(user_id, limit):
+    """id последних (по last_message_date) limit чатов пользователя, одним запросом."""
+    return list(
+        Chat.objects.filter(participants=user_id)
+        .order_by('-last_message_date', '-id')
+        .values_list('id', flat=True)[:limit]
+    )
+
+
+auser_chat_ids = database_sync_to_async(user_chat_ids)
+
+
+def invalidate(chat_ids, removed_user_ids=(), added_user_ids=()):
+    """После коммита сбрасывает кэш, отключает удаленных и оповещает добавленных участников."""
+    chat_ids = list(chat_ids)
+    removed_user_ids = list(removed_user_ids)
+    added_user_ids = list(added_user_ids)
+
+    def apply():
+        try:
+            cache.delete_many([MEMBERS_KEY.format(chat_id=chat_id) for chat_id in chat_ids])
+        except MEMBERSHIP_ERRORS:
+            logger.exception("Не удалось сбросить кэш участников чатов %s", chat_ids)
+        if not (removed_user_ids or added_user_ids):
+            return
+        channel_layer = get_channel_layer()
+        for chat_id in chat_ids:
+            try:
+                if removed_user_ids:
+                    async_to_sync(channel_layer.group_send)(
+                        chat_group_name(chat_id),
+                        {'type': 'members_removed', 'chat_id': chat_id, 'user_ids': removed_user_ids},
+                    )
+                for user_id in added_user_ids:
+                    async_to_sync(channel_layer.group_send)(
+                        user_group_name(user_id),
+                        {'type': 'chat_joined', 'chat_id': chat_id},
+                    )
+            except MEMBERSHIP_ERRORS:
+                logger.exception("Не удалось оповестить участников чата %s", chat_id)
+
+    transaction.on_commit(apply)
@@ -43,6 +43,8 @@ class Chat(models.Model):
         null=True, 
         verbose_name=_('Аватар чата/группы')
     )
+    # Уменьшенные копии аватара (см. echo_api/media.py)
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL, 
         on_delete=models.SET_NULL, 
@@ -74,4 +76,21 @@ class Chat(models.Model):
         return self.owner == user
 
     def is_admin(self, user):
-        return self.is_owner(user) or self.administrators.filter(pk=user.pk).exists()
\ No newline at end of file
+        return self.is_owner(user) or self.administrators.filter(pk=user.pk).exists()
+
+class ReadCursor(models.Model):
+    """Последнее прочитанное участником сообщение чата (см. messenger_api/receipts.py)."""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='read_cursors')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_read_cursors')
+    # ObjectId сообщения в MongoDB (24 hex-символа): строки сравниваются в том же порядке, что и id
+    last_read_id = models.CharField(max_length=24)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'messenger_api'
+        unique_together = ('chat', 'user')
+        verbose_name = _('Курсор прочтения')
+        verbose_name_plural = _('Курсоры прочтения')
+
+    def __str__(self):
+        return f"{self.user_id} прочитал чат {self.chat_id} до {self.last_read_id}"
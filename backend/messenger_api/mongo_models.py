@@ -1,6 +1,10 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import asyncio
+import weakref
+
+from pymongo import AsyncMongoClient, MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, PyMongoError
 from django.conf import settings
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from bson.objectid import ObjectId
 from builtins import ConnectionError
@@ -8,11 +12,43 @@ from builtins import ConnectionError
 logger = logging.getLogger(__name__)
 
 
+def _client_options():
+    """Общие параметры синхронного и асинхронного клиентов, включая размер пула."""
+    mongo_config = settings.MONGODB_DATABASE
+    return {
+        'host': mongo_config['host'],
+        'port': mongo_config['port'],
+        'username': mongo_config.get('username') or None,
+        'password': mongo_config.get('password') or None,
+        'serverSelectionTimeoutMS': 5000,
+        'maxPoolSize': settings.MONGODB_MAX_POOL_SIZE,
+        'minPoolSize': settings.MONGODB_MIN_POOL_SIZE,
+        'waitQueueTimeoutMS': settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+    }
+
+
+# История чата листается по _id. ObjectId назначает процесс Daphne при приеме
+# сообщения (MongoMessage.__init__), а пишется оно пачкой позже, поэтому _id
+# уникален и растет со временем, но между процессами упорядочен только до
+# секунды и в базу попадает не строго по порядку. Страница - отрезок индекса;
+# догрузка по after_id захватывает CHAT_HISTORY_OVERLAP_SECONDS до курсора
+# (см. MongoMessage._history_cursor).
+MESSAGE_INDEX = [('chat_id', ASCENDING), ('_id', DESCENDING)]
+# Прежний индекс по (chat_id, timestamp): больше не нужен
+LEGACY_MESSAGE_INDEX = 'chat_id_1_timestamp_-1'
+
+# Только поля, которые отдает MessageSerializer
+MESSAGE_PROJECTION = {'chat_id': 1, 'sender_id': 1, 'text': 1, 'timestamp': 1}
+
+
 class MongoConnection:
-    """Управление подключением к MongoDB."""
+    """
+    Синхронное подключение к MongoDB - тонкий адаптер для синхронных
+    DRF-представлений. Сообщения из WebSocket пишет ingest.py через AsyncMongoConnection.
+    """
     _client = None
     _collection = None
-    
+
     @classmethod
     def get_collection(cls):
         """Ленивая инициализация: подключается при первом запросе."""
@@ -20,88 +56,186 @@ class MongoConnection:
             return cls._collection
 
         mongo_config = settings.MONGODB_DATABASE
-        
+
         try:
-            # Парсинг настроек из settings.py (host, port, username, password, name)
-            username = mongo_config.get('username') or None
-            password = mongo_config.get('password') or None
-            
-            cls._client = MongoClient(
-                host=mongo_config['host'], 
-                port=mongo_config['port'], 
-                username=username, 
-                password=password,
-                serverSelectionTimeoutMS=5000 
-            )
-            
+            cls._client = MongoClient(**_client_options())
+
             # Проверка соединения
-            cls._client.admin.command('ping') 
-            
+            cls._client.admin.command('ping')
+
             cls._db = cls._client[mongo_config['name']]
             cls._collection = cls._db['messages']
-            
-            # Создание индекса для быстрого поиска по чату и дате
-            cls._collection.create_index([
-                ('chat_id', ASCENDING), 
-                ('timestamp', DESCENDING)
-            ], background=True)
-            
+            cls._collection.create_index(MESSAGE_INDEX, background=True)
+            try:
+                cls._collection.drop_index(LEGACY_MESSAGE_INDEX)
+            except OperationFailure:
+                pass
+
             return cls._collection
-            
+
         except Exception as e:
             logger.error(f"Ошибка подключения к MongoDB: {e}")
             cls._collection = None
             # Выбрасываем Django-исключение, которое поймает View
-            raise ConnectionError(f"Не удалось подключиться к MongoDB: {e}") 
+            raise ConnectionError(f"Не удалось подключиться к MongoDB: {e}")
+
+
+class AsyncMongoConnection:
+    """
+    Асинхронное подключение (pymongo AsyncMongoClient) для писателя пачек
+    сообщений (messenger_api/ingest.py).
+
+    Клиент привязан к событийному циклу, поэтому он свой у каждого цикла
+    (в Daphne цикл один на процесс). Запросы не занимают потоки
+    database_sync_to_async, которые нужны ORM; параллельность ограничивает
+    пул соединений MONGODB_MAX_POOL_SIZE.
+    """
+    _collections = weakref.WeakKeyDictionary()
+    _locks = weakref.WeakKeyDictionary()
+
+    @classmethod
+    async def get_collection(cls):
+        loop = asyncio.get_running_loop()
+        collection = cls._collections.get(loop)
+        if collection is not None:
+            return collection
+
+        lock = cls._locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            collection = cls._collections.get(loop)
+            if collection is not None:
+                return collection
+
+            client = AsyncMongoClient(**_client_options())
+            try:
+                await client.admin.command('ping')
+                collection = client[settings.MONGODB_DATABASE['name']]['messages']
+                await collection.create_index(MESSAGE_INDEX, background=True)
+            except PyMongoError as e:
+                logger.error("Ошибка подключения к MongoDB: %s", e)
+                await client.close()
+                raise ConnectionError(f"Не удалось подключиться к MongoDB: {e}")
+
+            cls._collections[loop] = collection
+            return collection
+
+
+def _prepare_messages(messages_list):
+    for msg in messages_list:
+        msg['id'] = str(msg.pop('_id'))
+    return messages_list
+
 
-class MongoMessage: 
+class MongoMessage:
     """Класс-структура для работы с сообщениями в коллекции MongoDB."""
     def __init__(self, chat_id, sender_id, text, attachments=None, timestamp=None):
         # Преобразуем Integer ID чата в строку для хранения в MongoDB
-        self.chat_id = str(chat_id) 
+        self.chat_id = str(chat_id)
         self.sender_id = sender_id
         self.text = text
         self.attachments = attachments if attachments is not None else []
         self.timestamp = timestamp if timestamp is not None else datetime.utcnow()
-        
-    def save(self):
-        """Сохраняет сообщение и обновляет модель Chat в PostgreSQL."""
-        messages_collection = MongoConnection.get_collection()
-        
-        data = {
+        # id назначается сервером сразу: сообщение можно разослать до записи в базу
+        self.id = ObjectId()
+
+    def to_document(self):
+        return {
+            '_id': self.id,
             'chat_id': self.chat_id,
             'sender_id': self.sender_id,
             'text': self.text,
             'attachments': self.attachments,
             'timestamp': self.timestamp,
         }
-        
-        result = messages_collection.insert_one(data)
-        return str(result.inserted_id) 
+
+    def save(self):
+        """Сохраняет сообщение (синхронно, для DRF-представлений)."""
+        messages_collection = MongoConnection.get_collection()
+        result = messages_collection.insert_one(self.to_document())
+        return str(result.inserted_id)
 
     @staticmethod
-    def get_messages_for_chat(chat_id, limit=50, before_id=None):
+    def _history_cursor(collection, chat_id, limit, before_id, after_id):
+        """
+        Курсор страницы истории по индексу MESSAGE_INDEX.
+
+        before_id - сообщения старше него, от новых к старым (листание назад).
+        after_id - сообщения новее него, от старых к новым (догрузка после
+        переподключения). Сообщение с меньшим _id может записаться уже после
+        того, как клиент получил after_id, поэтому страница начинается за
+        CHAT_HISTORY_OVERLAP_SECONDS до его времени: первые сообщения могут
+        повторять известные клиенту, он убирает их по id. Повторы занимают
+        место на странице, поэтому клиент листает дальше от самого нового
+        полученного id, пока страница не придет неполной.
+        Неверный id - bson.errors.InvalidId.
+        """
+        # chat_id - это строка, т.к. в Mongo он так хранится
+        query = {'chat_id': str(chat_id)}
+        bounds = {}
+        if before_id:
+            bounds['$lt'] = ObjectId(before_id)
+        if after_id:
+            created = ObjectId(after_id).generation_time
+            overlap = timedelta(seconds=settings.CHAT_HISTORY_OVERLAP_SECONDS)
+            bounds['$gte'] = ObjectId.from_datetime(created - overlap)
+        if bounds:
+            query['_id'] = bounds
+
+        direction = ASCENDING if after_id else DESCENDING
+        return collection.find(query, MESSAGE_PROJECTION).sort('_id', direction).limit(limit)
+
+    @staticmethod
+    def get_messages_for_chat(chat_id, limit=50, before_id=None, after_id=None):
         """Получает сообщения для данного чата с пагинацией."""
         try:
             messages_collection = MongoConnection.get_collection()
         except ConnectionError:
             return []
 
-        # chat_id - это строка, т.к. в Mongo он так хранится
-        query = {'chat_id': str(chat_id)} 
-        
-        # Логика пагинации: ищем сообщения, созданные "до" (less than - $lt) данного ID
-        if before_id:
-            try:
-                query['_id'] = {'$lt': ObjectId(before_id)}
-            except Exception:
-                pass
-                
-        cursor = messages_collection.find(query).sort('timestamp', DESCENDING).limit(limit)
-        
-        messages_list = list(cursor)
-        
-        for msg in messages_list:
-             msg['id'] = str(msg.pop('_id'))
-             
-        return messages_list
\ No newline at end of file
+        cursor = MongoMessage._history_cursor(messages_collection, chat_id, limit, before_id, after_id)
+        return _prepare_messages(list(cursor))
+
+    @staticmethod
+    def message_exists(chat_id, message_id):
+        """Есть ли в чате сообщение message_id (поиск по _id). MongoDB недоступна - ConnectionError."""
+        messages_collection = MongoConnection.get_collection()
+        try:
+            found = messages_collection.find_one({'_id': ObjectId(message_id), 'chat_id': str(chat_id)}, {'_id': 1})
+        except PyMongoError as e:
+            raise ConnectionError(f"Не удалось проверить сообщение: {e}")
+        return found is not None
+
+    @staticmethod
+    def count_unread(cursors, user_id):
+        """
+        Непрочитанные сообщения для страницы чатов одним aggregate.
+
+        cursors - {chat_id: last_read_id или None}. Каждый чат - отдельный
+        подзапрос ($unionWith) по отрезку индекса MESSAGE_INDEX после курсора,
+        свои сообщения не считаются. Подзапрос останавливается на
+        CHAT_UNREAD_COUNT_CAP + 1 сообщении, поэтому стоимость не зависит от
+        того, сколько в чате непрочитанного. Возвращает {chat_id: число};
+        число больше CHAT_UNREAD_COUNT_CAP значит "больше CAP" (клиент
+        показывает "99+").
+        """
+        if not cursors:
+            return {}
+        messages_collection = MongoConnection.get_collection()
+
+        branches = []
+        for chat_id, last_read_id in cursors.items():
+            match = {'chat_id': str(chat_id), 'sender_id': {'$ne': user_id}}
+            if last_read_id:
+                match['_id'] = {'$gt': ObjectId(last_read_id)}
+            branches.append([
+                {'$match': match},
+                {'$limit': settings.CHAT_UNREAD_COUNT_CAP + 1},
+                {'$project': {'chat_id': 1}},
+            ])
+        pipeline = branches[0] + [
+            {'$unionWith': {'coll': messages_collection.name, 'pipeline': branch}}
+            for branch in branches[1:]
+        ]
+        pipeline.append({'$group': {'_id': '$chat_id', 'count': {'$sum': 1}}})
+        counts = {int(row['_id']): row['count'] for row in messages_collection.aggregate(pipeline)}
+        return {chat_id: counts.get(chat_id, 0) for chat_id in cursors}
@@ -0,0 +1,10 @@
+from django.conf import settings
+
+from backend.echo_api.pagination import KeysetPagination
+
+
+class ChatListPagination(KeysetPagination):
+    """Список чатов: курсор по (last_message_date, id), сначала недавние."""
+    page_size = settings.CHAT_LIST_PAGE_SIZE
+    max_page_size = settings.CHAT_LIST_MAX_PAGE_SIZE
+    ordering_field = 'last_message_date'
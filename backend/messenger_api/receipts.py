@@ -0,0 +1,87 @@
+"""
+Прочтение сообщений: курсор участника и счетчики непрочитанного.
+
+У каждого участника чата есть курсор ReadCursor - id последнего прочитанного
+сообщения. Курсор двигается только вперед (mark_read: REST
+chats/<id>/read/ или кадр {"type": "read"} в сокете чата), после коммита
+группе чата уходит событие read_receipt.
+
+Курсор ставится только на сообщение, которое есть в этом чате.
+
+Непрочитанное не хранится: список чатов (read_state) считает его для всей
+страницы одним aggregate по индексу (chat_id, _id) - сообщения после курсора,
+кроме своих, не больше CHAT_UNREAD_COUNT_CAP + 1 на чат. Клиентам не нужно
+опрашивать историю каждого чата.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from bson.objectid import ObjectId
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.utils import timezone
+from pymongo.errors import PyMongoError
+
+from . import membership
+from .models import ReadCursor
+from .mongo_models import MongoMessage
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownMessage(ValueError):
+    """В чате нет сообщения, до которого просят сдвинуть курсор."""
+
+
+def mark_read(chat_id, user_id, message_id):
+    """
+    Сдвигает курсор участника до message_id. Возвращает True, если курсор
+    сдвинулся (назад он не двигается). Неверный id - bson.errors.InvalidId,
+    сообщения нет в чате - UnknownMessage, MongoDB недоступна - ConnectionError.
+    """
+    message_id = str(ObjectId(message_id))
+    if not MongoMessage.message_exists(chat_id, message_id):
+        raise UnknownMessage(message_id)
+    cursor, created = ReadCursor.objects.get_or_create(
+        chat_id=chat_id, user_id=user_id, defaults={'last_read_id': message_id},
+    )
+    if not created:
+        advanced = ReadCursor.objects.filter(pk=cursor.pk, last_read_id__lt=message_id).update(
+            last_read_id=message_id, updated_at=timezone.now(),
+        )
+        if not advanced:
+            return False
+
+    def broadcast():
+        try:
+            async_to_sync(get_channel_layer().group_send)(
+                membership.chat_group_name(chat_id),
+                {'type': 'read_receipt', 'chat_id': chat_id, 'user_id': user_id, 'message_id': message_id},
+            )
+        except membership.MEMBERSHIP_ERRORS:
+            logger.exception("Не удалось разослать прочтение чата %s", chat_id)
+
+    transaction.on_commit(broadcast)
+    return True
+
+
+def read_state(user_id, chats):
+    """
+    {chat_id: {'last_read_id': ..., 'unread_count': ...}} для страницы чатов:
+    один запрос к курсорам и один aggregate в MongoDB. Если MongoDB
+    недоступна, unread_count - None.
+    """
+    chat_ids = [chat.pk for chat in chats]
+    cursors = dict.fromkeys(chat_ids)
+    cursors.update(
+        ReadCursor.objects.filter(user_id=user_id, chat_id__in=chat_ids).values_list('chat_id', 'last_read_id')
+    )
+    try:
+        unread = MongoMessage.count_unread(cursors, user_id)
+    except (ConnectionError, PyMongoError):
+        logger.warning("Не удалось посчитать непрочитанные сообщения пользователя %s", user_id)
+        unread = {}
+    return {
+        chat_id: {'last_read_id': last_read_id, 'unread_count': unread.get(chat_id)}
+        for chat_id, last_read_id in cursors.items()
+    }
@@ -5,4 +5,6 @@ from . import consumers # Мы импортируем обработчик (Cons
 
 websocket_urlpatterns = [
     re_path(r'chat/(?P<chat_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
+    # Один сокет на пользователя для всех его чатов
+    re_path(r'messenger/$', consumers.MessengerConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""
+Кэш профилей отправителей сообщений: {"id", "username", "avatar"}.
+
+Два уровня: LRU в памяти процесса (CHAT_SENDER_CACHE_SIZE записей, каждая
+живет CHAT_SENDER_LOCAL_TIMEOUT секунд) и общий для воркеров кэш Django
+в Redis (chat:sender:<id>, CHAT_SENDER_CACHE_TIMEOUT). Промахи обоих уровней
+догружаются одним запросом id__in на всю страницу истории (get_senders).
+
+Сохранение или удаление пользователя и готовые варианты аватара сбрасывают
+запись (сигналы в messenger_api/signals.py): в Redis - сразу, в памяти
+других процессов - не позже чем через CHAT_SENDER_LOCAL_TIMEOUT.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+from backend.echo_api import media
+from backend.users_api.models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+SENDER_KEY = 'chat:sender:{user_id}'
+
+# Ошибки кэша, при которых идем в базу
+SENDER_CACHE_ERRORS = (RedisError, ConnectionInterrupted, OSError)
+
+
+def profile(user):
+    """Профиль отправителя из объекта пользователя (нужны avatar и avatar_variants)."""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'avatar': media.variant_url(user.avatar, user.avatar_variants, 'small'),
+    }
+
+
+def deleted_profile(user_id):
+    return {'id': user_id, 'username': 'Удаленный пользователь', 'avatar': None}
+
+
+class LocalCache:
+    """LRU с временем жизни записей; потокобезопасный (ORM-потоки Channels)."""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    continue
+                expires, data = entry
+                if expires <= now:
+                    del self.entries[user_id]
+                    continue
+                self.entries.move_to_end(user_id)
+                found[user_id] = data
+        return found
+
+    def set_many(self, profiles):
+        expires = time.monotonic() + settings.CHAT_SENDER_LOCAL_TIMEOUT
+        with self.lock:
+            for user_id, data in profiles.items():
+                self.entries[user_id] = (expires, data)
+                self.entries.move_to_end(user_id)
+            while len(self.entries) > settings.CHAT_SENDER_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_local = LocalCache()
+
+
+def get_senders(user_ids):
+    """{id: профиль} для всех user_ids; промахи кэшей - одним запросом к базе."""
+    user_ids = {int(user_id) for user_id in user_ids if user_id}
+    found = _local.get_many(user_ids)
+    missing = user_ids - found.keys()
+    if not missing:
+        return found
+
+    keys = {SENDER_KEY.format(user_id=user_id): user_id for user_id in missing}
+    try:
+        shared = {keys[key]: data for key, data in cache.get_many(list(keys)).items()}
+    except SENDER_CACHE_ERRORS:
+        shared = {}
+    _local.set_many(shared)
+    found.update(shared)
+    missing -= shared.keys()
+    if not missing:
+        return found
+
+    users = CustomUser.objects.filter(id__in=missing).only('id', 'username', 'avatar', 'avatar_variants')
+    loaded = {user.id: profile(user) for user in users}
+    try:
+        cache.set_many(
+            {SENDER_KEY.format(user_id=user_id): data for user_id, data in loaded.items()},
+            timeout=settings.CHAT_SENDER_CACHE_TIMEOUT,
+        )
+    except SENDER_CACHE_ERRORS:
+        logger.warning("Не удалось закэшировать профили %s отправителей", len(loaded))
+    _local.set_many(loaded)
+    found.update(loaded)
+
+    # Удаленные пользователи не кэшируются: id больше не переиспользуется
+    found.update({user_id: deleted_profile(user_id) for user_id in missing - loaded.keys()})
+    return found
+
+
+def get_sender(user_id):
+    return get_senders([user_id]).get(int(user_id)) if user_id else None
+
+
+def invalidate(user_id):
+    """После коммита убирает профиль из обоих уровней кэша."""
+    def apply():
+        _local.delete(user_id)
+        try:
+            cache.delete(SENDER_KEY.format(user_id=user_id))
+        except SENDER_CACHE_ERRORS:
+            logger.exception("Не удалось сбросить профиль отправителя %s", user_id)
+
+    transaction.on_commit(apply)
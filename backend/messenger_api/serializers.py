@@ -3,46 +3,67 @@ from builtins import ConnectionError # Используем стандартно
 from datetime import datetime
 
 from backend.config.jwt_auth_middleware import User
-from backend.echo_api import models
-from backend.users_api.serializers import UserSerializer 
-from backend.users_api.models import CustomUser 
+from backend.echo_api import media, models
+from backend.users_api.serializers import NestedUserSerializer 
 
+from . import last_message, senders
 from .models import Chat
 from .mongo_models import MongoMessage 
 
-# Кэш для избежания N+1 проблемы при загрузке истории сообщений
-USER_CACHE = {} 
 class ChatSerializer(serializers.ModelSerializer):
     """Сериализатор для модели Chat."""
-    participants = UserSerializer(many=True, read_only=True)
+    participants = NestedUserSerializer(many=True, read_only=True)
     participant_ids = serializers.ListField(child=serializers.IntegerField(), write_only=True, required=True, min_length=1)
     partner_id = serializers.SerializerMethodField()
     display_name = serializers.SerializerMethodField()
+    # Из receipts.read_state (только в списке чатов)
+    last_read_id = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Chat 
         fields = ('id', 'is_group', 'name', 'avatar', 'owner',
                   'last_message_text', 'last_message_date',
                   'participants', 'participant_ids',
-                  'partner_id', 'display_name', 'created_at',)
+                  'partner_id', 'display_name', 'created_at',
+                  'last_read_id', 'unread_count',)
         read_only_fields = ('owner',) 
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        url = media.variant_url(instance.avatar, instance.avatar_variants, 'small')
+        if url is not None:
+            request = self.context.get('request')
+            data['avatar'] = request.build_absolute_uri(url) if request is not None else url
+        return data
         
-    def get_partner_id(self, obj):
-        # Логика для личных чатов
-        if obj.is_group or obj.participants.count() != 2: return None
+    def get_partner(self, obj):
+        # Собеседник личного чата. participants.all() берется из prefetch_related
+        # (ChatListView), поэтому список чатов не делает запросов на каждый чат
+        if obj.is_group: return None
+        participants = list(obj.participants.all())
+        if len(participants) != 2: return None
         current_user = self.context['request'].user
-        partner = obj.participants.exclude(id=current_user.id).first()
+        return next((user for user in participants if user.id != current_user.id), None)
+
+    def get_partner_id(self, obj):
+        partner = self.get_partner(obj)
         return partner.id if partner else None
 
     def get_display_name(self, obj):
         # Отображаемое имя
         if obj.is_group and obj.name: return obj.name
-        partner_id = self.get_partner_id(obj)
-        if partner_id:
-            partner_username = CustomUser.objects.filter(id=partner_id).values_list('username', flat=True).first()
-            return f"Диалог с {partner_username}"
+        partner = self.get_partner(obj)
+        if partner:
+            return f"Диалог с {partner.username}"
         return f"Чат ID {obj.id}"
         
+    def get_last_read_id(self, obj):
+        return self.context.get('read_state', {}).get(obj.pk, {}).get('last_read_id')
+
+    def get_unread_count(self, obj):
+        return self.context.get('read_state', {}).get(obj.pk, {}).get('unread_count')
+
     def create(self, validated_data):
         participant_ids = validated_data.pop('participant_ids')
         current_user = self.context['request'].user
@@ -59,6 +80,13 @@ class ChatSerializer(serializers.ModelSerializer):
         if is_group: chat.administrators.add(current_user)
         return chat
 
+class MessageListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Профили всех отправителей страницы - одним обращением к кэшу/базе
+        self.child.context['senders'] = senders.get_senders(message.get('sender_id') for message in data)
+        return super().to_representation(data)
+
+
 class MessageSerializer(serializers.Serializer):
     id = serializers.CharField(read_only=True)
     chat_id = serializers.IntegerField(read_only=True)
@@ -69,28 +97,20 @@ class MessageSerializer(serializers.Serializer):
     # Поле sender будет содержать объект с id, username и avatar
     sender = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = MessageListSerializer
+
     def get_sender(self, obj):
         # Используем sender_id из данных MongoDB
         sid = obj.get('sender_id')
         if not sid:
             return None
-            
-        # Кэширование для предотвращения N+1 запросов к базе
-        if sid in USER_CACHE:
-            return USER_CACHE[sid]
-        
-        try:
-            user = CustomUser.objects.only('id', 'username', 'avatar').get(id=sid)
-            # Если avatar — это ImageField, .url вернет полный путь
-            data = {
-                "id": user.id,
-                "username": user.username,
-                "avatar": user.avatar.url if user.avatar else None
-            }
-            USER_CACHE[sid] = data
-            return data
-        except CustomUser.DoesNotExist:
-            return {"id": sid, "username": "Удаленный пользователь", "avatar": None}
+
+        # Для списка профили уже загружены MessageListSerializer
+        preloaded = self.context.get('senders', {})
+        if sid in preloaded:
+            return preloaded[sid]
+        return senders.get_sender(sid)
 
     def create(self, validated_data):
         chat_id = self.context['chat_id']
@@ -99,6 +119,8 @@ class MessageSerializer(serializers.Serializer):
 
         mongo_message = MongoMessage(chat_id=chat_id, sender_id=sender_id, text=text)
         message_id = mongo_message.save()
+        # Через REST пишут редко - обновляем чат сразу, без накопления
+        last_message.apply({chat_id: last_message.preview(mongo_message.to_document())})
 
         # Возвращаем данные, которые будут сериализованы
         return {
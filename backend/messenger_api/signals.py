@@ -0,0 +1,73 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from backend.echo_api import media, storage
+from backend.users_api.models import CustomUser
+
+from . import membership, senders
+from .models import Chat
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Сбрасывает кэш участников при любом изменении Chat.participants."""
+    if action == 'pre_clear':
+        # После clear() pk_set пуст - запоминаем, кого убирают
+        if reverse:
+            instance._cleared_ids = list(instance.chats.values_list('pk', flat=True))
+        else:
+            instance._cleared_ids = list(instance.participants.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_ids', [])
+    removed = action != 'post_add'
+    if reverse:
+        # user.chats.add/remove(...): pk_set - это чаты
+        user_ids = [instance.pk]
+        chat_ids = pk_set
+    else:
+        user_ids = pk_set
+        chat_ids = [instance.pk]
+    if removed:
+        membership.invalidate(chat_ids, removed_user_ids=user_ids)
+    else:
+        membership.invalidate(chat_ids, added_user_ids=user_ids)
+
+
+@receiver(post_delete, sender=Chat)
+def chat_deleted(sender, instance, **kwargs):
+    membership.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def user_changed(sender, instance, **kwargs):
+    """Имя или аватар могли измениться - профиль отправителя перечитается."""
+    senders.invalidate(instance.pk)
+
+
+@receiver(media.variants_ready, sender=CustomUser)
+def avatar_variants_ready(sender, pk, **kwargs):
+    senders.invalidate(pk)
+
+
+@receiver(pre_save, sender=Chat)
+def remember_old_avatar(sender, instance, update_fields=None, **kwargs):
+    storage.remember_old_file(instance, 'avatar', update_fields)
+
+
+@receiver(post_save, sender=Chat)
+def avatar_saved(sender, instance, update_fields=None, **kwargs):
+    """Новый аватар: ссылка на прежний снимается, варианты сделает воркер Django-Q."""
+    storage.release_replaced_file(instance, 'avatar')
+    # Например, save(update_fields=['name']) - аватар не менялся
+    if not update_fields or 'avatar' in update_fields:
+        media.schedule(instance)
+
+
+@receiver(post_delete, sender=Chat)
+def release_avatar(sender, instance, **kwargs):
+    storage.release_on_commit([instance.avatar.name, *media.variant_names(instance.avatar_variants)])
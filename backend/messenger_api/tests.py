@@ -1,3 +1,390 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from bson import ObjectId
+from bson.errors import InvalidId
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from pymongo import ASCENDING, DESCENDING
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backend.config.asgi import application
+from backend.users_api.models import CustomUser
+
+from . import last_message, senders
+from .models import Chat, ReadCursor
+from .serializers import MessageSerializer
+from .consumers import ChatConsumer
+from .ingest import MessageIngester
+from .mongo_models import MongoMessage
+
+
+class ChatConsumerTests(TransactionTestCase):
+    # database_sync_to_async закрывает соединение, TestCase этого не переживает
+
+    def setUp(self):
+        self.alice, self.bob, self.eve = (CustomUser.objects.create(username=name) for name in ('alice', 'bob', 'eve'))
+        self.chat = Chat.objects.create(is_group=True, name='chat')
+        self.chat.participants.set([self.alice, self.bob])
+
+    def communicator(self, user):
+        return WebsocketCommunicator(application, f'/ws/chat/{self.chat.pk}/?token={AccessToken.for_user(user)}')
+
+    def test_token_among_other_query_params(self):
+        # Запасной путь консьюмера (без пользователя от middleware): значение
+        # с '=' рядом с токеном не должно делать пользователя анонимом
+        consumer = ChatConsumer()
+        consumer.scope = {'query_string': f'next=/a?b=c&token={AccessToken.for_user(self.alice)}'.encode()}
+        async_to_sync(consumer.authenticate_via_token)()
+        self.assertEqual(consumer.user, self.alice)
+
+    def test_broadcast_before_persist(self):
+        saved = []
+
+        async def scenario():
+            alice, bob, eve = self.communicator(self.alice), self.communicator(self.bob), self.communicator(self.eve)
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+            self.assertFalse((await eve.connect())[0])
+
+            await alice.send_json_to({'text': ' привет '})
+            message = await bob.receive_json_from()
+            self.assertEqual((message['text'], message['sender']['username']), ('привет', 'alice'))
+            self.assertEqual((await alice.receive_json_from())['id'], message['id'])
+            await alice.disconnect()
+            await bob.disconnect()
+            return message
+
+        async def insert(ingester, documents):
+            saved.extend(documents)
+
+        with mock.patch.object(MessageIngester, 'insert', insert):
+            message = async_to_sync(scenario)()
+        self.assertEqual([str(document['_id']) for document in saved], [message['id']])
+
+    @mock.patch.object(MessageIngester, 'insert', mock.AsyncMock(side_effect=ConnectionError))
+    def test_failed_message_is_retracted_for_the_chat(self):
+        async def scenario():
+            alice, bob = self.communicator(self.alice), self.communicator(self.bob)
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+
+            await alice.send_json_to({'text': 'привет'})
+            message = await bob.receive_json_from()
+            await alice.receive_json_from()
+            # Отзыв получают все, кто видел сообщение, а не только отправитель
+            for communicator in (alice, bob):
+                self.assertEqual(
+                    await communicator.receive_json_from(),
+                    {'type': 'message_failed', 'chat_id': self.chat.pk, 'id': message['id']},
+                )
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    @mock.patch.object(MongoMessage, 'message_exists', return_value=True)
+    def test_read_frame_sends_receipt_to_the_chat(self, message_exists):
+        message_id = str(ObjectId())
+
+        async def scenario():
+            alice, bob = self.communicator(self.alice), self.communicator(self.bob)
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+            await bob.send_json_to({'type': 'read', 'message_id': message_id})
+            receipt = await alice.receive_json_from()
+            await alice.disconnect()
+            await bob.disconnect()
+            return receipt
+
+        receipt = async_to_sync(scenario)()
+        self.assertEqual(receipt, {
+            'type': 'read_receipt', 'chat_id': self.chat.pk, 'user_id': self.bob.id, 'message_id': message_id,
+        })
+        self.assertEqual(ReadCursor.objects.get(chat=self.chat, user=self.bob).last_read_id, message_id)
+
+    def test_removed_member_is_disconnected(self):
+        async def scenario():
+            bob = self.communicator(self.bob)
+            self.assertTrue((await bob.connect())[0])
+            await database_sync_to_async(self.chat.participants.remove)(self.bob)
+
+            self.assertEqual((await bob.receive_output())['type'], 'websocket.close')
+            # Кэш участников сброшен сигналом - новое подключение не пускает
+            self.assertFalse((await self.communicator(self.bob).connect())[0])
+
+        async_to_sync(scenario)()
+
+
+
+class MessengerConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, self.bob = (CustomUser.objects.create(username=name) for name in ('alice', 'bob'))
+        self.first, self.second, self.foreign = (Chat.objects.create(is_group=True, name=str(i)) for i in range(3))
+        self.first.participants.set([self.alice, self.bob])
+        self.second.participants.set([self.alice])
+
+    def communicator(self, user):
+        return WebsocketCommunicator(application, f'/ws/messenger/?token={AccessToken.for_user(user)}')
+
+    @mock.patch.object(MessageIngester, 'insert', mock.AsyncMock())
+    def test_one_socket_carries_all_chats(self):
+        async def scenario():
+            alice = self.communicator(self.alice)
+            self.assertTrue((await alice.connect())[0])
+            self.assertEqual(
+                await alice.receive_json_from(),
+                {'type': 'subscribed', 'chat_ids': sorted([self.first.pk, self.second.pk])},
+            )
+
+            for chat in (self.first, self.second):
+                await alice.send_json_to({'type': 'message', 'chat_id': chat.pk, 'text': chat.name})
+                frame = await alice.receive_json_from()
+                self.assertEqual((frame['type'], frame['chat_id'], frame['text']), ('message', chat.pk, chat.name))
+
+            # Чужой чат: ни подписки, ни отправки
+            await alice.send_json_to({'type': 'subscribe', 'chat_id': self.foreign.pk})
+            self.assertEqual((await alice.receive_json_from())['error'], 'Нет доступа к чату.')
+            await alice.send_json_to({'type': 'message', 'chat_id': self.foreign.pk, 'text': 'x'})
+            self.assertEqual((await alice.receive_json_from())['error'], 'Нет подписки на чат.')
+
+            # Добавление в чат подписывает открытый сокет, удаление - отписывает
+            await database_sync_to_async(self.foreign.participants.add)(self.alice)
+            self.assertEqual(await alice.receive_json_from(), {'type': 'subscribed', 'chat_ids': [self.foreign.pk]})
+            await database_sync_to_async(self.second.participants.remove)(self.alice)
+            self.assertEqual(await alice.receive_json_from(), {'type': 'unsubscribed', 'chat_ids': [self.second.pk]})
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_anonymous_is_rejected(self):
+        async def scenario():
+            self.assertFalse((await WebsocketCommunicator(application, '/ws/messenger/').connect())[0])
+
+        async_to_sync(scenario)()
+
+
+class MessageIngesterTests(SimpleTestCase):
+    def test_messages_are_written_in_one_batch(self):
+        batches = []
+
+        async def insert(ingester, documents):
+            batches.append([document['text'] for document in documents])
+            if len(batches) == 2:
+                raise ConnectionError('mongo недоступна')
+
+        async def scenario():
+            ingester = MessageIngester()
+            futures = [await ingester.submit(MongoMessage(chat_id=1, sender_id=1, text=str(i))) for i in range(5)]
+            await asyncio.gather(*futures)
+            failed = await ingester.submit(MongoMessage(chat_id=1, sender_id=1, text='x'))
+            with self.assertRaises(ConnectionError):
+                await failed
+            ingester.worker.cancel()
+            return ingester.metrics()
+
+        with mock.patch.object(MessageIngester, 'insert', insert):
+            metrics = async_to_sync(scenario)()
+        self.assertEqual(batches, [['0', '1', '2', '3', '4'], ['x']])
+        self.assertEqual((metrics['batches'], metrics['messages'], metrics['failed']), (2, 6, 1))
+
+    @override_settings(CHAT_INGEST_FLUSH_INTERVAL=1, CHAT_INGEST_METRICS_INTERVAL=0)
+    def test_drain_writes_queued_messages(self):
+        written = []
+
+        async def insert(ingester, documents):
+            written.extend(document['text'] for document in documents)
+
+        async def scenario():
+            ingester = MessageIngester()
+            futures = [await ingester.submit(MongoMessage(chat_id=1, sender_id=1, text=str(i))) for i in range(3)]
+            # Пачка еще добирается, а drain() дописывает ее и сразу сбрасывает последние сообщения
+            with mock.patch.object(last_message.LastMessageUpdater, 'flush') as flush:
+                await ingester.drain()
+            self.assertTrue(all(future.done() for future in futures))
+            self.assertIsNone(ingester.worker)
+            return flush.call_count
+
+        with mock.patch.object(MessageIngester, 'insert', insert), \
+                self.assertLogs('backend.messenger_api.ingest', 'INFO') as logs:
+            flushed = async_to_sync(scenario)()
+        self.assertEqual((written, flushed), (['0', '1', '2'], 1))
+        self.assertIn("'messages': 3", logs.output[0])
+
+
+class LastMessageTests(TransactionTestCase):
+    def setUp(self):
+        self.chat = Chat.objects.create(is_group=True, name='chat')
+
+    def document(self, text):
+        return MongoMessage(chat_id=self.chat.pk, sender_id=1, text=text).to_document()
+
+    def test_older_message_does_not_overwrite_newer(self):
+        older, newer = self.document('старое'), self.document('новое')
+        last_message.apply({self.chat.pk: last_message.preview(newer)})
+        last_message.apply({self.chat.pk: last_message.preview(older)})
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_text, 'новое')
+
+    @override_settings(CHAT_LAST_MESSAGE_FLUSH_INTERVAL=0)
+    def test_messages_are_coalesced_per_chat(self):
+        applied = []
+        apply = last_message.apply
+
+        def counting_apply(latest):
+            applied.append(dict(latest))
+            return apply(latest)
+
+        async def scenario():
+            updater = last_message.LastMessageUpdater()
+            updater.record([self.document('1'), self.document('2')])
+            updater.record([self.document('3')])
+            await updater.flusher
+
+        with mock.patch.object(last_message, 'apply', counting_apply):
+            async_to_sync(scenario)()
+        self.chat.refresh_from_db()
+        self.assertEqual((len(applied), self.chat.last_message_text), (1, '3'))
+
+
+class MessageHistoryTests(SimpleTestCase):
+    def cursor(self, **bounds):
+        collection = mock.MagicMock()
+        MongoMessage._history_cursor(collection, 7, 20, bounds.get('before_id'), bounds.get('after_id'))
+        query, projection = collection.find.call_args.args
+        sort = collection.find.return_value.sort.call_args.args
+        return query, projection, sort
+
+    def test_history_is_a_range_of_the_chat_id_index(self):
+        before = ObjectId()
+        query, projection, sort = self.cursor(before_id=str(before))
+        self.assertEqual(query, {'chat_id': '7', '_id': {'$lt': before}})
+        self.assertEqual(sort, ('_id', DESCENDING))
+        self.assertNotIn('attachments', projection)
+
+    @override_settings(CHAT_HISTORY_OVERLAP_SECONDS=5)
+    def test_after_id_overlaps_late_writes(self):
+        after = ObjectId()
+        # Записано позже after, но _id получило раньше (другой процесс)
+        late = ObjectId.from_datetime(after.generation_time - timedelta(seconds=2))
+        query, _, sort = self.cursor(after_id=str(after))
+        self.assertEqual(sort, ('_id', ASCENDING))
+        self.assertLessEqual(query['_id']['$gte'], late)
+        self.assertEqual(
+            query['_id']['$gte'].generation_time, after.generation_time - timedelta(seconds=5),
+        )
+
+    def test_invalid_cursor_is_rejected(self):
+        with self.assertRaises(InvalidId):
+            self.cursor(before_id='not-an-id')
+
+
+class SenderCacheTests(TestCase):
+    def setUp(self):
+        senders._local.clear()
+        cache.clear()
+        self.users = [CustomUser.objects.create(username=f'user{i}') for i in range(3)]
+
+    def page(self):
+        messages = [{'id': str(ObjectId()), 'chat_id': '1', 'sender_id': user.id, 'text': 'x'} for user in self.users * 2]
+        return MessageSerializer(messages, many=True).data
+
+    def test_page_loads_senders_in_one_query(self):
+        with self.assertNumQueries(1):
+            data = self.page()
+        self.assertEqual([m['sender']['username'] for m in data[:3]], ['user0', 'user1', 'user2'])
+
+        # Второй уровень (кэш Django) переживает очистку памяти процесса
+        senders._local.clear()
+        with self.assertNumQueries(0):
+            self.page()
+
+    def test_user_save_invalidates_profile(self):
+        self.page()
+        user = self.users[0]
+        user.username = 'renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save()
+        self.assertEqual(self.page()[0]['sender']['username'], 'renamed')
+
+
+class ChatListTests(TestCase):
+    def setUp(self):
+        self.me = CustomUser.objects.create(username='me')
+        self.chats = []
+        for i in range(5):
+            partner = CustomUser.objects.create(username=f'partner{i}')
+            chat = Chat.objects.create()
+            chat.participants.set([self.me, partner])
+            self.chats.append(chat)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def count_unread(self, cursors, user_id):
+        return {chat_id: 0 if last_read_id else 3 for chat_id, last_read_id in cursors.items()}
+
+    @mock.patch.object(MongoMessage, 'count_unread')
+    def test_list_is_paginated_without_per_chat_queries(self, count_unread):
+        count_unread.side_effect = self.count_unread
+        read_id = str(ObjectId())
+        ReadCursor.objects.create(chat=self.chats[-1], user=self.me, last_read_id=read_id)
+
+        # Чаты + участники + курсоры прочтения, независимо от числа чатов
+        with self.assertNumQueries(3):
+            page = self.client.get('/messenger_api/chats/', {'page_size': 3}).json()
+        self.assertEqual(len(page['results']), 3)
+        first, second = page['results'][:2]
+        self.assertEqual(first['display_name'], 'Диалог с partner4')
+        self.assertEqual((first['last_read_id'], first['unread_count']), (read_id, 0))
+        self.assertEqual((second['last_read_id'], second['unread_count']), (None, 3))
+        # Один aggregate на страницу
+        self.assertEqual(count_unread.call_count, 1)
+
+        rest = self.client.get(page['next']).json()
+        self.assertEqual(len(rest['results']), 2)
+        self.assertIsNone(rest['next'])
+
+    @mock.patch.object(MongoMessage, 'message_exists', return_value=True)
+    def test_read_cursor_only_moves_forward(self, message_exists):
+        chat = self.chats[0]
+        older, newer = str(ObjectId()), str(ObjectId())
+        url = f'/messenger_api/chats/{chat.pk}/read/'
+        self.assertTrue(self.client.post(url, {'message_id': newer}).json()['advanced'])
+        self.assertFalse(self.client.post(url, {'message_id': older}).json()['advanced'])
+        self.assertEqual(ReadCursor.objects.get(chat=chat, user=self.me).last_read_id, newer)
+        self.assertEqual(self.client.post(url, {'message_id': 'bad'}).status_code, 400)
+
+    @mock.patch.object(MongoMessage, 'message_exists', return_value=False)
+    def test_read_cursor_needs_a_message_of_the_chat(self, message_exists):
+        chat = self.chats[0]
+        message_id = str(ObjectId())
+        response = self.client.post(f'/messenger_api/chats/{chat.pk}/read/', {'message_id': message_id})
+        self.assertEqual(response.status_code, 400)
+        message_exists.assert_called_once_with(chat.pk, message_id)
+        self.assertFalse(ReadCursor.objects.filter(chat=chat).exists())
+
+    @override_settings(CHAT_UNREAD_COUNT_CAP=99)
+    def test_unread_query_is_one_capped_aggregate_over_cursors(self):
+        collection = mock.MagicMock()
+        collection.name = 'messages'
+        collection.aggregate.return_value = [{'_id': '1', 'count': 4}]
+        read_id = ObjectId()
+        with mock.patch('backend.messenger_api.mongo_models.MongoConnection.get_collection', return_value=collection):
+            counts = MongoMessage.count_unread({1: None, 2: str(read_id)}, self.me.id)
+        self.assertEqual(counts, {1: 4, 2: 0})
+        pipeline = collection.aggregate.call_args.args[0]
+        first, limit, _, union, group = pipeline
+        self.assertEqual(first['$match'], {'chat_id': '1', 'sender_id': {'$ne': self.me.id}})
+        # Каждый чат - отрезок индекса, не длиннее CAP + 1
+        self.assertEqual(limit, {'$limit': 100})
+        self.assertEqual(union['$unionWith']['coll'], 'messages')
+        self.assertEqual(union['$unionWith']['pipeline'][:2], [
+            {'$match': {'chat_id': '2', 'sender_id': {'$ne': self.me.id}, '_id': {'$gt': read_id}}},
+            {'$limit': 100},
+        ])
+        self.assertEqual(group['$group']['_id'], '$chat_id')
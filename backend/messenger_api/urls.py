@@ -1,7 +1,7 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from .views import ChatListView, MessageListView, MemberManagementViewSet
+from .views import ChatListView, ChatReadView, MessageListView, MemberManagementViewSet
 
 app_name = 'messenger_api'
 
@@ -11,6 +11,9 @@ urlpatterns = [
          
     # Сообщения внутри конкретного чата
     path('chats/<int:chat_id>/messages/', MessageListView.as_view(), name='message-list'),
+
+    # Отметка о прочтении (курсор участника)
+    path('chats/<int:chat_id>/read/', ChatReadView.as_view(), name='chat-read'),
     
     # МАРШРУТЫ ДЛЯ УПРАВЛЕНИЯ УЧАСТНИКАМИ И АДМИНАМИ
     path('chats/<int:pk>/members/add/', 
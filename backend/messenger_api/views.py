@@ -7,11 +7,15 @@ from django.shortcuts import get_object_or_404
 # Добавлен импорт для обработки ошибок MongoDB
 
 from builtins import ConnectionError
+from bson.errors import InvalidId
+from django.conf import settings
 
 from backend.config.jwt_auth_middleware import User
 from backend.users_api.serializers import UserSerializer # Используем стандартное исключение
 
+from . import receipts
 from .models import Chat
+from .pagination import ChatListPagination
 from backend.users_api.models import CustomUser 
 from .serializers import ChatSerializer, MessageSerializer 
 # Импорт сервиса для работы с MongoDB
@@ -28,14 +32,27 @@ class ChatListView(generics.ListCreateAPIView):
     """API для получения списка чатов и создания нового чата."""
     serializer_class = ChatSerializer 
     permission_classes = [IsAuthenticated]
+    pagination_class = ChatListPagination
     
     def get_queryset(self):
-        # Возвращаем чаты, в которых состоит текущий пользователь, отсортированные по дате
-        return Chat.objects.filter(participants=self.request.user).order_by('-last_message_date')
+        # Возвращаем чаты, в которых состоит текущий пользователь, отсортированные по дате.
+        # Участники всех чатов страницы - одним дополнительным запросом
+        return (
+            Chat.objects.filter(participants=self.request.user)
+            .prefetch_related('participants')
+            .order_by('-last_message_date', '-id')
+        )
     
     def get_serializer_context(self):
         # Передаем request в сериализатор для логики определения партнера/создания
-        return {'request': self.request}
+        # и состояние прочтения чатов страницы (см. paginate_queryset)
+        return {'request': self.request, 'read_state': getattr(self, 'read_state', {})}
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            self.read_state = receipts.read_state(self.request.user.id, page)
+        return page
 
     def create(self, request, *args, **kwargs):
         user = request.user
@@ -91,15 +108,21 @@ class MessageListView(generics.ListCreateAPIView):
         # Проверка доступа
         chat = self.get_chat(chat_id, current_user)
         
-        # Получаем параметры пагинации
-        try: limit = int(request.query_params.get('limit', 50))
-        except ValueError: limit = 50
+        # Получаем параметры пагинации: before_id - листание назад, after_id - догрузка новых
+        try: limit = int(request.query_params.get('limit', settings.CHAT_HISTORY_PAGE_SIZE))
+        except ValueError: limit = settings.CHAT_HISTORY_PAGE_SIZE
+        limit = min(max(limit, 1), settings.CHAT_HISTORY_MAX_PAGE_SIZE)
         before_id = request.query_params.get('before_id') 
+        after_id = request.query_params.get('after_id')
         
         # Получаем список сообщений из MongoDB
         try:
             # chat.pk - это Integer ID, который MongoMessage корректно обрабатывает
-            messages = MongoMessage.get_messages_for_chat(chat_id=chat.pk, limit=limit, before_id=before_id)
+            messages = MongoMessage.get_messages_for_chat(
+                chat_id=chat.pk, limit=limit, before_id=before_id, after_id=after_id
+            )
+        except (InvalidId, TypeError):
+            return Response({"detail": "Неверный before_id или after_id."}, status=status.HTTP_400_BAD_REQUEST)
         except ConnectionError:
              return Response({"detail": "Ошибка подключения к базе данных сообщений."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
@@ -130,6 +153,21 @@ class MessageListView(generics.ListCreateAPIView):
              return Response({"detail": "Ошибка подключения к базе данных сообщений. Сообщение не отправлено."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
+class ChatReadView(generics.GenericAPIView):
+    """POST {"message_id": ...}: участник прочитал чат до этого сообщения."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, chat_id):
+        chat = get_object_or_404(Chat.objects.filter(participants=request.user), pk=chat_id)
+        try:
+            advanced = receipts.mark_read(chat.pk, request.user.id, request.data.get('message_id'))
+        except (InvalidId, TypeError, receipts.UnknownMessage):
+            return Response({"detail": "Неверный message_id."}, status=status.HTTP_400_BAD_REQUEST)
+        except ConnectionError:
+            return Response({"detail": "Ошибка подключения к базе данных сообщений."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({"advanced": advanced}, status=status.HTTP_200_OK)
+
+
 # -------------------------------------------------------------
 # 2. VIEWSET ДЛЯ УПРАВЛЕНИЯ УЧАСТНИКАМИ И АДМИНАМИ (ВАШ КОД, НЕ ТРЕБУЕТ ИЗМЕНЕНИЙ)
 # -------------------------------------------------------------
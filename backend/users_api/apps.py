@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'backend.users_api'
\ No newline at end of file
+    name = 'backend.users_api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -17,6 +17,8 @@ class CustomUser(AbstractUser):
     date_of_birth = models.DateField(blank=True, null=True)
     nickname = models.CharField(max_length=30, blank=True, null=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    # Уменьшенные копии аватара (см. echo_api/media.py)
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     
     bio = models.TextField(blank=True, null=True)
 
@@ -3,6 +3,8 @@ from .models import CustomUser
 from datetime import date
 from django.contrib.auth.password_validation import validate_password 
 
+from backend.echo_api import media
+
 def validate_min_age(value):
     if value:
         today = date.today()
@@ -45,6 +47,8 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     avatar = serializers.SerializerMethodField()
+    # Копия аватара; вызывающий может переопределить через context['avatar_variant']
+    avatar_variant = 'large'
 
     class Meta:
         model = CustomUser
@@ -56,13 +60,20 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
     def get_avatar(self, obj):
-        if obj.avatar and hasattr(obj.avatar, 'url'):
-            request = self.context.get('request')
-            if request is not None:
-                return request.build_absolute_uri(obj.avatar.url)
-            return obj.avatar.url
-        return None
+        variant = self.context.get('avatar_variant', self.avatar_variant)
+        url = media.variant_url(obj.avatar, obj.avatar_variants, variant)
+        if url is None:
+            return None
+        request = self.context.get('request')
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
 
     # Валидация даты рождения (нужна при PUT/обновлении профиля)
     def validate_date_of_birth(self, value):
-        return validate_min_age(value)
\ No newline at end of file
+        return validate_min_age(value)
+
+
+class NestedUserSerializer(UserSerializer):
+    """Пользователь внутри другого объекта (автор поста, участник чата): хватает маленькой копии аватара."""
+    avatar_variant = 'small'
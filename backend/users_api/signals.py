@@ -0,0 +1,25 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from backend.echo_api import media, storage
+
+from .models import CustomUser
+
+
+@receiver(pre_save, sender=CustomUser)
+def remember_old_avatar(sender, instance, update_fields=None, **kwargs):
+    storage.remember_old_file(instance, 'avatar', update_fields)
+
+
+@receiver(post_save, sender=CustomUser)
+def avatar_saved(sender, instance, update_fields=None, **kwargs):
+    """Новый аватар: ссылка на прежний снимается, варианты сделает воркер Django-Q."""
+    storage.release_replaced_file(instance, 'avatar')
+    # Например, last_login при входе - аватар не менялся
+    if not update_fields or 'avatar' in update_fields:
+        media.schedule(instance)
+
+
+@receiver(post_delete, sender=CustomUser)
+def release_avatar(sender, instance, **kwargs):
+    storage.release_on_commit([instance.avatar.name, *media.variant_names(instance.avatar_variants)])
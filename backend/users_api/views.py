@@ -151,7 +151,8 @@ class UserSearchView(APIView):
             Q(phone__icontains=query)
         ).exclude(id=request.user.id)[:20]  # Исключаем себя, ограничиваем выдачу
 
-        serializer = UserSerializer(users, many=True)
+        # В результатах поиска хватает маленькой копии аватара
+        serializer = UserSerializer(users, many=True, context={'avatar_variant': 'small'})
         return Response(serializer.data, status=200)
 
 # Проверка никнейма на токсичность
@@ -69,6 +69,10 @@ python manage.py runserver 8000 > "$LOG_DIR/api.log" 2>&1 &
 # Channels/Daphne (8001)
 python manage.py runserver 8001 > "$LOG_DIR/ws.log" 2>&1 &
 
+# Воркер истечения постов (расписание в Redis)
+python manage.py post_expiry_worker --rebuild > "$LOG_DIR/scheduler.log" 2>&1 &
+SCHEDULER_PID=$!
+
 
 # Фронтенд
 if [ -d "$FRONTEND_DIR" ]; then
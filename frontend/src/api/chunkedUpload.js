@@ -0,0 +1,49 @@
+import axiosInstance from './axiosInstance';
+
+const MAX_RETRIES = 3;
+
+// Загрузка файла кусками (echo_api/uploads/): после обрыва связи
+// досылаются только куски, которых нет на сервере.
+// Возвращает id собранной загрузки для поля upload_ids поста.
+export async function uploadInChunks(file, onProgress) {
+  const { data: upload } = await axiosInstance.post('/echo_api/uploads/', {
+    filename: file.name,
+    size: file.size,
+  });
+  return resumeUpload(upload, file, onProgress);
+}
+
+export async function resumeUpload(upload, file, onProgress) {
+  const received = new Set(upload.received);
+
+  for (let index = 0; index < upload.chunks_total; index += 1) {
+    if (!received.has(index)) {
+      const start = index * upload.chunk_size;
+      const chunk = file.slice(start, start + upload.chunk_size);
+      await putChunk(upload.id, index, chunk);
+      received.add(index);
+    }
+    if (typeof onProgress === 'function') {
+      onProgress(Math.round((received.size / upload.chunks_total) * 100));
+    }
+  }
+
+  const { data } = await axiosInstance.post(`/echo_api/uploads/${upload.id}/complete/`);
+  return data.id;
+}
+
+async function putChunk(uploadId, index, chunk) {
+  for (let attempt = 1; ; attempt += 1) {
+    try {
+      await axiosInstance.put(`/echo_api/uploads/${uploadId}/chunks/${index}/`, chunk, {
+        headers: { 'Content-Type': 'application/octet-stream' },
+      });
+      return;
+    } catch (error) {
+      // Ошибки валидации (4xx) повтором не исправить
+      if (attempt >= MAX_RETRIES || (error.response && error.response.status < 500)) {
+        throw error;
+      }
+    }
+  }
+}
@@ -0,0 +1,81 @@
+// Один WebSocket на пользователя для всех чатов (ws/messenger/).
+// Сервер сам подписывает сокет на чаты пользователя; кадры с chat_id
+// раздаются слушателям этого чата.
+//
+// Сокет живет всю сессию: переход между чатами и страницами не
+// переподключает его. Закрывается при выходе (closeMessengerSocket) или
+// после IDLE_TIMEOUT_MS без открытых чатов.
+
+const WS_URL = 'ws://127.0.0.1:8001/ws/messenger/';
+const IDLE_TIMEOUT_MS = 5 * 60 * 1000;
+
+let socket = null;
+let idleTimer = null;
+const listeners = new Map(); // chatId -> Set(listener)
+
+function dispatch(event) {
+  const frame = JSON.parse(event.data);
+  if (frame.chat_id === undefined) return;
+  const chatListeners = listeners.get(String(frame.chat_id));
+  if (chatListeners) chatListeners.forEach((listener) => listener(frame));
+}
+
+function connect() {
+  if (socket && socket.readyState <= WebSocket.OPEN) return socket;
+  const token = localStorage.getItem('access_token');
+  socket = new WebSocket(`${WS_URL}?token=${encodeURIComponent(token)}`);
+  socket.onmessage = dispatch;
+  socket.onopen = () => {
+    // Чаты, открытые до (пере)подключения
+    listeners.forEach((_, chatId) => send({ type: 'subscribe', chat_id: Number(chatId) }));
+  };
+  return socket;
+}
+
+function cancelIdleClose() {
+  clearTimeout(idleTimer);
+  idleTimer = null;
+}
+
+export function closeMessengerSocket() {
+  cancelIdleClose();
+  listeners.clear();
+  if (socket) {
+    socket.close();
+    socket = null;
+  }
+}
+
+export function send(frame) {
+  if (socket?.readyState !== WebSocket.OPEN) return false;
+  socket.send(JSON.stringify(frame));
+  return true;
+}
+
+// Возвращает функцию отписки. Без слушателей сокет закрывается через IDLE_TIMEOUT_MS.
+export function subscribeChat(chatId, listener, { onOpen, onClose } = {}) {
+  cancelIdleClose();
+  const key = String(chatId);
+  if (!listeners.has(key)) listeners.set(key, new Set());
+  listeners.get(key).add(listener);
+
+  const ws = connect();
+  if (ws.readyState === WebSocket.OPEN) {
+    send({ type: 'subscribe', chat_id: Number(chatId) });
+    if (onOpen) onOpen();
+  } else if (onOpen) {
+    ws.addEventListener('open', onOpen, { once: true });
+  }
+  if (onClose) ws.addEventListener('close', onClose, { once: true });
+
+  return () => {
+    const chatListeners = listeners.get(key);
+    chatListeners?.delete(listener);
+    if (chatListeners && chatListeners.size === 0) listeners.delete(key);
+    if (onOpen) ws.removeEventListener('open', onOpen);
+    if (onClose) ws.removeEventListener('close', onClose);
+    if (listeners.size === 0 && !idleTimer) {
+      idleTimer = setTimeout(closeMessengerSocket, IDLE_TIMEOUT_MS);
+    }
+  };
+}
@@ -1,6 +1,8 @@
 import React, { useState, useEffect, useCallback } from 'react';
 
 const API_BASE_URL = 'http://127.0.0.1:8000/messenger_api';
+// CHAT_UNREAD_COUNT_CAP на сервере: больше него счетчик не считается
+const UNREAD_COUNT_CAP = 99;
 
 function ChatsList({ onChatSelect, currentSelectedChatId }) {
   const [chats, setChats] = useState([]);
@@ -24,7 +26,8 @@ function ChatsList({ onChatSelect, currentSelectedChatId }) {
         throw new Error(`Ошибка HTTP: ${response.status}`);
       }
 
-      const data = await response.json();
+      // Список чатов постраничный: { next, previous, results }
+      const data = (await response.json()).results;
       setChats(data);
       setLoading(false);
 
@@ -61,7 +64,14 @@ function ChatsList({ onChatSelect, currentSelectedChatId }) {
       <h2 style={{ padding: '10px', margin: 0, borderBottom: '1px solid #ccc' }}>Ваши Чаты</h2>
       {chats.map((chat) => (
         <div key={chat.id} style={chatItemStyle(chat.id)} onClick={() => onChatSelect(chat.id)}>
-          <div>{chat.display_name}</div>
+          <div>
+            {chat.display_name}
+            {chat.unread_count > 0 && (
+              <span style={{ marginLeft: '6px', fontSize: '12px', fontWeight: 'bold' }}>
+                {chat.unread_count > UNREAD_COUNT_CAP ? `${UNREAD_COUNT_CAP}+` : chat.unread_count}
+              </span>
+            )}
+          </div>
           <div style={{ fontSize: '12px', color: '#888' }}>
             {chat.last_message_text || 'Начните чат'}
           </div>
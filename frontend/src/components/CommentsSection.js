@@ -13,6 +13,7 @@ import {
   UpOutlined,
 } from '@ant-design/icons';
 import axiosInstance from '../api/axiosInstance';
+import getVoteAction from '../utils/voteUtils';
 import './CommentsSection.css';
 
 const { TextArea } = Input;
@@ -194,7 +195,6 @@ const CommentsSection = ({ postId, postExpired, initialCommentCount }) => {
   const [newCommentContent, setNewCommentContent] = useState('');
   const [loading, setLoading] = useState(false);
   const [isSending, setIsSending] = useState(false);
-  const [userCommentActions, setUserCommentActions] = useState({});
   const [replyTo, setReplyTo] = useState(null);
 
   const [isExpanded, setIsExpanded] = useState(false);
@@ -204,8 +204,8 @@ const CommentsSection = ({ postId, postExpired, initialCommentCount }) => {
     setLoading(true);
     try {
       const response = await axiosInstance.get(`/echo_api/posts/${postId}/comments/`);
-      setComments(response.data);
-      setCommentCount(response.data.length);
+      setComments(response.data.results);
+      setCommentCount(response.data.results.length);
     } catch (error) {
       console.error('Ошибка при загрузке комментариев:', error);
       message.error('Не удалось загрузить комментарии.');
@@ -214,28 +214,9 @@ const CommentsSection = ({ postId, postExpired, initialCommentCount }) => {
     }
   }, [postId]);
 
-  const fetchUserCommentEchos = useCallback(async () => {
-    try {
-      const response = await axiosInstance.get('/echo_api/my/echos/');
-
-      const newActions = response.data.reduce((acc, action) => {
-        if (action.content_type_model === 'comment') {
-          const type = action.is_echo ? 'echo' : 'disecho';
-          acc[action.object_id] = { type };
-        }
-        return acc;
-      }, {});
-
-      setUserCommentActions(newActions);
-    } catch (err) {
-      console.error('Ошибка при получении действий пользователя:', err);
-    }
-  }, []);
-
   useEffect(() => {
     setCommentCount(initialCommentCount);
-    fetchUserCommentEchos();
-  }, [initialCommentCount, fetchUserCommentEchos]);
+  }, [initialCommentCount]);
 
   const toggleComments = () => {
     if (isExpanded) {
@@ -293,27 +274,15 @@ const CommentsSection = ({ postId, postExpired, initialCommentCount }) => {
           : `/echo_api/comments/${commentId}/disecho/`;
 
       const response = await axiosInstance.post(endpoint);
-      const updatedComment = response.data;
-
+      // Ответ содержит только изменившиеся поля, в том числе my_vote
       setComments((prevComments) =>
-        prevComments.map((c) => (c.id === commentId ? updatedComment : c)),
+        prevComments.map((c) => (c.id === commentId ? { ...c, ...response.data } : c)),
       );
 
-      const currentAction = userCommentActions[commentId]?.type;
-      let newActions = { ...userCommentActions };
-
-      if (currentAction === actionType) {
-        delete newActions[commentId];
-      } else {
-        newActions[commentId] = { type: actionType };
-      }
-      setUserCommentActions(newActions);
-
       message.success(actionType === 'echo' ? 'Эхо комментарию!' : 'Заглушка комментарию!');
     } catch (error) {
       console.error('Ошибка при обработке действия комментария:', error);
       message.error(error.response?.data?.error || 'Ошибка действия комментария.');
-      fetchUserCommentEchos();
     }
   };
 
@@ -379,7 +348,7 @@ const CommentsSection = ({ postId, postExpired, initialCommentCount }) => {
                   <CommentCard
                     key={comment.id}
                     comment={comment}
-                    userAction={userCommentActions[comment.id]}
+                    userAction={getVoteAction(comment)}
                     onAction={handleCommentAction}
                     onReply={handleReplyClick}
                   />
@@ -1,17 +1,30 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { PaperClipOutlined, PictureOutlined, SendOutlined } from '@ant-design/icons';
+import { send, subscribeChat } from '../api/messengerSocket';
 
 const API_BASE_URL = 'http://127.0.0.1:8000/messenger_api';
 const getAuthToken = () => localStorage.getItem('access_token');
+// Страница догрузки после переподключения (CHAT_HISTORY_MAX_PAGE_SIZE на сервере)
+const CATCH_UP_PAGE_SIZE = 200;
+
+// Слияние без повторов: догрузка after_id захватывает несколько секунд до
+// курсора, а сокет мог прислать те же сообщения. id (ObjectId) растут со
+// временем, поэтому сортировка по id восстанавливает порядок.
+const mergeMessages = (prev, incoming) => {
+  const known = new Set(prev.map((m) => m.id));
+  const added = incoming.filter((m) => !known.has(m.id));
+  if (!added.length) return prev;
+  return [...prev, ...added].sort((a, b) => (a.id < b.id ? -1 : a.id > b.id ? 1 : 0));
+};
 
 function Messages({ chatId, currentUserId, onSendMessage }) {
   const [messages, setMessages] = useState([]);
   const [newMessage, setNewMessage] = useState('');
   const [connectionStatus, setConnectionStatus] = useState('disconnected');
 
-  const chatSocket = useRef(null);
   const messagesEndRef = useRef(null);
   const isUnmounting = useRef(false);
+  const lastIdRef = useRef(null);
 
   const getMyId = useCallback(() => {
     const token = getAuthToken();
@@ -32,67 +45,113 @@ function Messages({ chatId, currentUserId, onSendMessage }) {
 
   useEffect(() => {
     scrollToBottom();
+    lastIdRef.current = messages.length ? messages[messages.length - 1].id : null;
   }, [messages, scrollToBottom]);
 
+  // Отмечаем чат прочитанным до последнего чужого сообщения
+  const lastReadSent = useRef(null);
+  useEffect(() => {
+    const last = [...messages].reverse().find((m) => String(m.sender?.id) !== myId);
+    if (!last || last.id === lastReadSent.current) return;
+    if (send({ type: 'read', chat_id: Number(chatId), message_id: last.id })) {
+      lastReadSent.current = last.id;
+    }
+  }, [messages, myId, chatId]);
+
   const fetchMessages = useCallback(
-    async (token) => {
+    async (token, signal) => {
       if (!token || !chatId) return;
-      try {
-        const response = await fetch(`${API_BASE_URL}/chats/${chatId}/messages/`, {
+      const request = async (query) => {
+        const response = await fetch(`${API_BASE_URL}/chats/${chatId}/messages/${query}`, {
           headers: {
             Authorization: `Bearer ${token}`,
             'Content-Type': 'application/json',
           },
+          signal,
         });
-        if (response.ok) {
-          const data = await response.json();
-          if (!isUnmounting.current) setMessages(data.reverse());
+        return response.ok ? response.json() : null;
+      };
+      // Ответ для чата, который уже закрыли, в новый не сливаем
+      const merge = (page) => {
+        if (isUnmounting.current || signal.aborted) return false;
+        setMessages((prev) => mergeMessages(prev, page));
+        return true;
+      };
+
+      try {
+        let afterId = lastIdRef.current;
+        if (!afterId) {
+          // Первая загрузка: последняя страница, от новых к старым
+          const page = await request('');
+          if (page) merge(page.reverse());
+          return;
+        }
+        // После переподключения догружаем пропущенное страницами от старых к
+        // новым, пока страница не придет неполной. Каждая начинается на
+        // несколько секунд раньше курсора (повторы убирает mergeMessages)
+        for (;;) {
+          const page = await request(`?after_id=${afterId}&limit=${CATCH_UP_PAGE_SIZE}`);
+          if (!page || !merge(page) || page.length < CATCH_UP_PAGE_SIZE) return;
+          const newest = page[page.length - 1].id;
+          // Вся страница - уже известные сообщения: дальше курсор не сдвинуть
+          if (newest <= afterId) return;
+          afterId = newest;
         }
       } catch (error) {
-        console.error(error);
+        if (error.name !== 'AbortError') console.error(error);
       }
     },
     [chatId],
   );
 
+  useEffect(() => {
+    // Смена чата: начинаем с пустого списка, он придет из fetchMessages
+    setMessages([]);
+    lastIdRef.current = null;
+    lastReadSent.current = null;
+  }, [chatId]);
+
   useEffect(() => {
     isUnmounting.current = false;
     const token = getAuthToken();
     if (!chatId || !token) return;
 
-    if (chatSocket.current) chatSocket.current.close();
-
-    const wsUrl = `ws://127.0.0.1:8001/ws/chat/${chatId}/?token=${encodeURIComponent(token)}`;
-    const socket = new WebSocket(wsUrl);
-    chatSocket.current = socket;
-
-    socket.onopen = () => {
-      if (!isUnmounting.current) {
-        setConnectionStatus('connected');
-        fetchMessages(token);
-      }
-    };
-
-    socket.onmessage = (e) => {
+    // Общий сокет ws/messenger/ для всех чатов: здесь только кадры этого чата
+    const onFrame = (data) => {
       if (isUnmounting.current) return;
-      const data = JSON.parse(e.data);
-      setMessages((prev) => (prev.some((m) => m.id === data.id) ? prev : [...prev, data]));
-    };
-
-    socket.onclose = () => {
-      if (!isUnmounting.current) setConnectionStatus('disconnected');
+      if (data.type === 'message_failed') {
+        setMessages((prev) => prev.filter((m) => m.id !== data.id));
+      } else if (data.type === 'message') {
+        setMessages((prev) => mergeMessages(prev, [data]));
+      }
     };
 
+    // Смена чата или размонтирование отменяют загрузку истории этого чата
+    const controller = new AbortController();
+    const unsubscribe = subscribeChat(chatId, onFrame, {
+      onOpen: () => {
+        if (!isUnmounting.current) {
+          setConnectionStatus('connected');
+          fetchMessages(token, controller.signal);
+        }
+      },
+      onClose: () => {
+        if (!isUnmounting.current) setConnectionStatus('disconnected');
+      },
+    });
     return () => {
-      isUnmounting.current = true;
-      if (socket.readyState === WebSocket.OPEN) socket.close();
+      controller.abort();
+      unsubscribe();
     };
   }, [chatId, fetchMessages]);
 
+  useEffect(() => () => {
+    isUnmounting.current = true;
+  }, []);
+
   const handleSend = (e) => {
     e.preventDefault();
-    if (newMessage.trim() && chatSocket.current?.readyState === WebSocket.OPEN) {
-      chatSocket.current.send(JSON.stringify({ text: newMessage.trim() }));
+    if (newMessage.trim() && send({ type: 'message', chat_id: Number(chatId), text: newMessage.trim() })) {
       setNewMessage('');
     }
   };
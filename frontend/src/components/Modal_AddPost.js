@@ -3,6 +3,7 @@ import { Modal, Form, Input, Upload, Button, message } from 'antd';
 import { PlusOutlined, FileAddOutlined } from '@ant-design/icons';
 import { useNavigate } from 'react-router-dom';
 import axiosInstance from '../api/axiosInstance';
+import { uploadInChunks } from '../api/chunkedUpload';
 
 export default function Modal_AddPost({ isVisible, onClose, fetchPosts }) {
   const [form] = Form.useForm();
@@ -35,18 +36,17 @@ export default function Modal_AddPost({ isVisible, onClose, fetchPosts }) {
 
   const onFinish = async (values) => {
     setLoading(true);
-    const formData = new FormData();
-    formData.append('content', values.content);
-
-    if (values.file && values.file.length > 0) {
-      values.file.forEach((fileItem) => {
-        formData.append('uploaded_files', fileItem.originFileObj);
-      });
-    }
 
     try {
-      await axiosInstance.post('/echo_api/posts/', formData, {
-        headers: { 'Content-Type': 'multipart/form-data' },
+      // Файлы уходят кусками заранее, пост ссылается на них по id
+      const uploadIds = [];
+      for (const fileItem of values.file || []) {
+        uploadIds.push(await uploadInChunks(fileItem.originFileObj));
+      }
+
+      await axiosInstance.post('/echo_api/posts/', {
+        content: values.content,
+        upload_ids: uploadIds,
       });
 
       message.success('Пост успешно создан!');
@@ -1,6 +1,7 @@
 // src/contexts/AuthContext.js
 
 import React, { createContext, useContext, useState } from 'react';
+import { closeMessengerSocket } from '../api/messengerSocket';
 // import axiosInstance from '../api/axiosInstance'; // Пока не будем использовать, чтобы не вызвать новые ошибки
 
 const AuthContext = createContext(null);
@@ -29,6 +30,7 @@ export const AuthProvider = ({ children }) => {
 
   const logout = () => {
     // Логика выхода
+    closeMessengerSocket();
     setUser(null);
     setIsAuthenticated(false);
   };
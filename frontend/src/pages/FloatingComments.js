@@ -51,7 +51,7 @@ function FloatingComments() {
   const fetchFloatingComments = useCallback(async () => {
     try {
       const response = await axiosInstance.get('/echo_api/feed/floating/');
-      setFloatingComments(response.data);
+      setFloatingComments(response.data.results);
     } catch (err) {
       console.error('Ошибка при получении плавающих комментариев:', err);
     } finally {
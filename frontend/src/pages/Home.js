@@ -2,6 +2,7 @@ import React, { useState, useEffect, useCallback, memo } from 'react';
 import axiosInstance from '../api/axiosInstance';
 import CommentsSection from '../components/CommentsSection';
 import getAvatarUrl from '../utils/avatarUtils';
+import getVoteAction from '../utils/voteUtils';
 import { Progress, Typography, message, Spin, Avatar, Modal } from 'antd';
 import { SoundOutlined, SoundFilled, MutedOutlined, MutedFilled } from '@ant-design/icons';
 import './Home.css';
@@ -173,12 +174,11 @@ function Home() {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
   const [updatingPosts, setUpdatingPosts] = useState(new Set());
-  const [userActions, setUserActions] = useState({});
 
   const fetchPosts = useCallback(async () => {
     try {
       const response = await axiosInstance.get('/echo_api/feed/posts/');
-      setPosts(response.data);
+      setPosts(response.data.results);
       setLoading(false);
     } catch (err) {
       setError(err);
@@ -186,25 +186,10 @@ function Home() {
     }
   }, []);
 
-  const fetchUserEchos = useCallback(async () => {
-    try {
-      const response = await axiosInstance.get('/echo_api/my/echos/');
-      const newActions = response.data.reduce((acc, action) => {
-        if (action.content_type_model === 'post') {
-          acc[action.object_id] = { type: action.is_echo ? 'echo' : 'disecho' };
-        }
-        return acc;
-      }, {});
-      setUserActions(newActions);
-    } catch (err) {}
-  }, []);
-
+  // Оценка пользователя приходит в каждом посте (my_vote)
   useEffect(() => {
     fetchPosts();
-    fetchUserEchos();
-    const aInt = setInterval(fetchUserEchos, 15000);
-    return () => clearInterval(aInt);
-  }, [fetchPosts, fetchUserEchos]);
+  }, [fetchPosts]);
 
   const handleAction = async (postId, actionType) => {
     if (updatingPosts.has(postId)) return;
@@ -215,7 +200,10 @@ function Home() {
           ? `/echo_api/posts/${postId}/echo/`
           : `/echo_api/posts/${postId}/disecho/`;
       const response = await axiosInstance.post(endpoint);
-      setPosts((prev) => prev.map((post) => (post.id === postId ? response.data : post)));
+      // Ответ содержит только изменившиеся поля
+      setPosts((prev) =>
+        prev.map((post) => (post.id === postId ? { ...post, ...response.data } : post)),
+      );
     } catch (error) {
       message.error('Ошибка действия');
     } finally {
@@ -228,7 +216,7 @@ function Home() {
   };
 
   const getActionIcon = (postId, actionType) => {
-    const userAction = userActions[postId];
+    const userAction = getVoteAction(posts.find((post) => post.id === postId));
     if (userAction?.type === actionType) {
       return actionType === 'echo' ? <SoundFilled /> : <MutedFilled />;
     }
@@ -258,7 +246,7 @@ function Home() {
             <PostCard
               key={post.id}
               post={post}
-              userAction={userActions[post.id]}
+              userAction={getVoteAction(post)}
               isUpdating={updatingPosts.has(post.id)}
               onAction={handleAction}
               getActionIcon={getActionIcon}
@@ -28,7 +28,7 @@ function MessengerPage() {
     setLoadingChats(true);
     try {
       const response = await axiosInstance.get(API_CHATS);
-      setChats(response.data);
+      setChats(response.data.results);
       if (initialChatId && !selectedChatId) setSelectedChatId(initialChatId);
     } catch (err) {
       console.error('Ошибка загрузки чатов:', err);
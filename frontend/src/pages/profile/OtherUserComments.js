@@ -50,7 +50,7 @@ const OtherUserComments = ({
     setTabLoading(true);
     try {
       const response = await axiosInstance.get(`/echo_api/users/${userId}/comments/active/`);
-      setUserComments(response.data);
+      setUserComments(response.data.results);
     } catch (error) {
       message.error('Не удалось загрузить комментарии.');
       console.error('User comments fetch error:', error);
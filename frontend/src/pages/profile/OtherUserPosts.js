@@ -44,7 +44,7 @@ const OtherUserPosts = ({ userPosts, setUserPosts, tabLoading, setTabLoading, us
       const response = await axiosInstance.get(`/echo_api/users/${userId}/posts/`);
 
       setUserPosts(
-        response.data.map((post) => ({
+        response.data.results.map((post) => ({
           ...post,
           is_expired: new Date(post.expires_at) < new Date(),
         })),
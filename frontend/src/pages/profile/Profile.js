@@ -26,6 +26,7 @@ import {
   EditOutlined,
 } from '@ant-design/icons';
 import axiosInstance from '../../api/axiosInstance';
+import { closeMessengerSocket } from '../../api/messengerSocket';
 import { useNavigate } from 'react-router-dom';
 import getAvatarUrl from '../../utils/avatarUtils';
 import './Profile.css';
@@ -79,14 +80,14 @@ const Profile = () => {
         if (key === '2' && myPosts.length === 0) {
           const response = await axiosInstance.get('/echo_api/my/posts/');
           setMyPosts(
-            response.data.map((post) => ({
+            response.data.results.map((post) => ({
               ...post,
               is_expired: new Date(post.expires_at) < new Date(),
             })),
           );
         } else if (key === '3' && myComments.length === 0) {
           const response = await axiosInstance.get('/echo_api/my/comments/active/');
-          setMyComments(response.data);
+          setMyComments(response.data.results);
         }
       } catch (error) {
         messageApi.error(
@@ -115,6 +116,7 @@ const Profile = () => {
   };
 
   const handleLogout = () => {
+    closeMessengerSocket();
     localStorage.clear();
     messageApi.success('Вы успешно вышли из аккаунта.');
     navigate('/Welcome');
@@ -44,7 +44,7 @@ const UserPosts = ({ myPosts, setMyPosts, tabLoading, setTabLoading }) => {
       const response = await axiosInstance.get('/echo_api/my/posts/');
 
       setMyPosts(
-        response.data.map((post) => ({
+        response.data.results.map((post) => ({
           ...post,
           is_expired: new Date(post.expires_at) < new Date(),
         })),
@@ -0,0 +1,8 @@
+// my_vote из API (true - Echo, false - DisEcho, null - нет оценки) -> действие пользователя
+const getVoteAction = (item) => {
+  if (item?.my_vote === true) return { type: 'echo' };
+  if (item?.my_vote === false) return { type: 'disecho' };
+  return undefined;
+};
+
+export default getVoteAction;